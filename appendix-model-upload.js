@@ -68,7 +68,8 @@ appendixForm.addEventListener('submit', async (e) => {
       formData.append('files', file);
     }
     formData.append('exam_structure', JSON.stringify(examStructureForGcf));
-    const gcfResponse = await fetch(APPENDIX_GCF_URL, { method: 'POST', body: formData });
+    await appendUsageLabels(formData, examId);
+    const gcfResponse = await fetchPipeline(APPENDIX_GCF_URL, formData);
     if (!gcfResponse.ok) {
       const errorText = await gcfResponse.text();
       throw new Error(`Cloud function failed: ${gcfResponse.statusText} - ${errorText}`);
@@ -199,7 +200,8 @@ modelForm.addEventListener('submit', async (e) => {
       formData.append('files', file);
     }
     formData.append('exam_structure', JSON.stringify(examStructureForGcf));
-    const gcfResponse = await fetch(MODEL_GCF_URL, { method: 'POST', body: formData });
+    await appendUsageLabels(formData, examId);
+    const gcfResponse = await fetchPipeline(MODEL_GCF_URL, formData);
     if (!gcfResponse.ok) {
       const errorText = await gcfResponse.text();
       throw new Error(`Cloud function failed: ${gcfResponse.statusText} - ${errorText}`);
@@ -6,6 +6,10 @@ const APPENDIX_GCF_URL = 'https://add-appendix-232485517114.europe-west1.run.app
 const MODEL_GCF_URL = 'https://add-model-232485517114.europe-west1.run.app';
 const STUDENT_ANSWERS_GCF_URL = 'https://add-student-answers-232485517114.europe-west1.run.app';
 const GRADING_GCF_URL = 'https://generate-points-232485517114.europe-west1.run.app';
+// generate-points deployed with --entry-point=generate_points_batch; leave empty to grade per student.
+const GRADING_BATCH_GCF_URL = '';
+// Ask generate-points for NDJSON and save each question as soon as it is graded.
+const GRADING_STREAM_RESULTS = false;
 const BULK_BOUNDARY_GCF_URL = 'https://bulk-submission-boundaries-232485517114.europe-west1.run.app';
 const STORAGE_BUCKET = 'exam-visuals';
 
@@ -189,6 +193,28 @@ const updateGradingButtonText = (message) => {
   console.log(`Grading Status: ${message}`);
 };
 
+/**
+ * Ids the cloud functions attribute their LLM token usage and cost to (see usage.py).
+ * @param {string} examId
+ * @returns {Promise<{exam_id: string, teacher_id?: string}>}
+ */
+async function usageLabels(examId) {
+  const { data } = await sb.auth.getSession();
+  const teacherId = data?.session?.user?.id;
+  return teacherId ? { exam_id: examId, teacher_id: teacherId } : { exam_id: examId };
+}
+
+/**
+ * Add the usage labels (see usageLabels) to a function's form data.
+ * @param {FormData} formData
+ * @param {string} examId
+ */
+async function appendUsageLabels(formData, examId) {
+  for (const [key, value] of Object.entries(await usageLabels(examId))) {
+    formData.append(key, value);
+  }
+}
+
 /**
  * Extract a filename from a URL string.
  * @param {string} url
@@ -0,0 +1,200 @@
+"""
+Background diagnostics sink for debug reports (subject, body and attachments).
+
+Reports used to be emailed synchronously from the request, with every raw upload, the
+Gemini input log and the final ZIP attached. Now report() only decides whether the
+report is sampled and queues it; a single worker thread builds the attachments, caps
+their size and hands the report to a backend, so the response does not wait for SMTP.
+
+  - Sampling: failures are captured at DIAGNOSTICS_FAILURE_SAMPLE_RATE (default 1),
+    successes at DIAGNOSTICS_SUCCESS_SAMPLE_RATE (default 0, i.e. failures only).
+  - Attachments may be passed as a zero-argument callable, which the worker calls, so
+    unsampled reports cost nothing and serialization happens off the request path.
+  - Attachments above DIAGNOSTICS_MAX_ATTACHMENT_BYTES are replaced by a short note with
+    their size and sha256; once a report reaches DIAGNOSTICS_MAX_REPORT_BYTES the
+    remaining attachments are replaced the same way.
+  - The queue is bounded; when it is full new reports are dropped (and counted) rather
+    than holding more request data in memory.
+  - Backends: "smtp" mails the report (SENDER_EMAIL, SENDER_APP_PASSWORD,
+    RECIPIENT_EMAIL), "spool" writes it to a directory (one subdirectory per report,
+    oldest pruned beyond DIAGNOSTICS_SPOOL_MAX_REPORTS), "none" discards it.
+Reports are sent after the response, so deploy with CPU always allocated if they must
+not be delayed until the next request.
+
+Configuration:
+  DIAGNOSTICS_BACKEND               smtp (default) | spool | none
+  DIAGNOSTICS_FAILURE_SAMPLE_RATE   0..1 (default 1)
+  DIAGNOSTICS_SUCCESS_SAMPLE_RATE   0..1 (default 0)
+  DIAGNOSTICS_MAX_ATTACHMENT_BYTES  default 5 MB
+  DIAGNOSTICS_MAX_REPORT_BYTES      default 20 MB
+  DIAGNOSTICS_QUEUE_SIZE            reports waiting to be sent (default 8)
+  DIAGNOSTICS_SPOOL_DIR             default /tmp/diagnostics
+  DIAGNOSTICS_SPOOL_MAX_REPORTS     default 50
+"""
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import smtplib
+import threading
+import time
+import uuid
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+BACKEND = os.environ.get("DIAGNOSTICS_BACKEND", "smtp").strip().lower()
+FAILURE_SAMPLE_RATE = float(os.environ.get("DIAGNOSTICS_FAILURE_SAMPLE_RATE", "1"))
+SUCCESS_SAMPLE_RATE = float(os.environ.get("DIAGNOSTICS_SUCCESS_SAMPLE_RATE", "0"))
+MAX_ATTACHMENT_BYTES = int(os.environ.get("DIAGNOSTICS_MAX_ATTACHMENT_BYTES", str(5 * 1024 * 1024)))
+MAX_REPORT_BYTES = int(os.environ.get("DIAGNOSTICS_MAX_REPORT_BYTES", str(20 * 1024 * 1024)))
+QUEUE_SIZE = int(os.environ.get("DIAGNOSTICS_QUEUE_SIZE", "8"))
+SPOOL_DIR = os.environ.get("DIAGNOSTICS_SPOOL_DIR", "/tmp/diagnostics")
+SPOOL_MAX_REPORTS = int(os.environ.get("DIAGNOSTICS_SPOOL_MAX_REPORTS", "50"))
+
+
+# --- Backends ---
+
+def send_email(subject, body, attachments):
+    """Mails the report with Gmail SMTP; credentials come from environment variables."""
+    sender_email = os.environ.get("SENDER_EMAIL")
+    sender_password = os.environ.get("SENDER_APP_PASSWORD")
+    recipient_email = os.environ.get("RECIPIENT_EMAIL")
+
+    if not all([sender_email, sender_password, recipient_email]):
+        print("Email credentials not set in environment variables. Skipping email.")
+        return
+
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = recipient_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
+    for filename, content in attachments.items():
+        part = MIMEBase('application', 'octet-stream')
+        part.set_payload(content)
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', f'attachment; filename= {filename}')
+        msg.attach(part)
+
+    server = smtplib.SMTP('smtp.gmail.com', 587, timeout=60)
+    try:
+        server.starttls()
+        server.login(sender_email, sender_password)
+        server.sendmail(sender_email, recipient_email, msg.as_string())
+    finally:
+        server.quit()
+    print(f"Debug email sent successfully to {recipient_email}")
+
+
+def write_spool(subject, body, attachments):
+    """Writes the report to <SPOOL_DIR>/<time>-<id>/ and prunes the oldest reports."""
+    report_dir = os.path.join(SPOOL_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(report_dir)
+    with open(os.path.join(report_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump({"subject": subject, "body": body, "attachments": sorted(attachments)}, f, indent=2)
+    for filename, content in attachments.items():
+        safe_name = re.sub(r"[^A-Za-z0-9._-]", "_", filename) or "attachment"
+        with open(os.path.join(report_dir, safe_name), "wb") as f:
+            f.write(content)
+    reports = sorted(os.listdir(SPOOL_DIR))
+    for name in reports[:max(0, len(reports) - SPOOL_MAX_REPORTS)]:
+        shutil.rmtree(os.path.join(SPOOL_DIR, name), ignore_errors=True)
+    print(f"Diagnostics report spooled to {report_dir}")
+
+
+_BACKENDS = {"smtp": send_email, "spool": write_spool}
+
+
+# --- Sink ---
+
+def _as_bytes(content):
+    return content if isinstance(content, bytes) else str(content).encode("utf-8")
+
+
+def cap_attachments(attachments, max_attachment_bytes=MAX_ATTACHMENT_BYTES, max_report_bytes=MAX_REPORT_BYTES):
+    """The attachments with oversized ones (or those past the report budget) replaced by a note."""
+    capped, total = {}, 0
+    for filename, content in attachments.items():
+        content = _as_bytes(content)
+        if len(content) > max_attachment_bytes or total + len(content) > max_report_bytes:
+            capped[f"{filename}.omitted.txt"] = (
+                f"{filename} omitted: {len(content)} bytes, sha256 {hashlib.sha256(content).hexdigest()}\n"
+            ).encode("utf-8")
+            continue
+        capped[filename] = content
+        total += len(content)
+    return capped
+
+
+class DiagnosticsSink:
+    def __init__(self, backend=BACKEND, failure_rate=FAILURE_SAMPLE_RATE, success_rate=SUCCESS_SAMPLE_RATE,
+                 queue_size=QUEUE_SIZE):
+        self.send = _BACKENDS.get(backend)
+        if self.send is None and backend != "none":
+            print(f"Warning: Unknown DIAGNOSTICS_BACKEND '{backend}'. Diagnostics are disabled.")
+        self.failure_rate = failure_rate
+        self.success_rate = success_rate
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        self._lock = threading.Lock()
+        self.stats = {"queued": 0, "sent": 0, "unsampled": 0, "dropped": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def sampled(self, failure):
+        rate = self.failure_rate if failure else self.success_rate
+        return self.send is not None and random.random() < rate
+
+    def report(self, subject, body, attachments=None, failure=False):
+        """
+        Queues a report if it is sampled and returns whether it was queued. `attachments`
+        is a {filename: bytes or str} dict or a callable returning one.
+        """
+        if not self.sampled(failure):
+            self._count("unsampled")
+            return False
+        try:
+            self._queue.put_nowait((subject, body, attachments))
+        except queue.Full:
+            print(f"Diagnostics queue full; dropping report '{subject}'.")
+            self._count("dropped")
+            return False
+        self._count("queued")
+        self._ensure_worker()
+        return True
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="diagnostics", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            subject, body, attachments = self._queue.get()
+            try:
+                if callable(attachments):
+                    attachments = attachments()
+                self.send(subject, body, cap_attachments(attachments or {}))
+                self._count("sent")
+            except Exception as e:
+                print(f"Failed to send diagnostics report '{subject}': {e}")
+                self._count("errors")
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=None):
+        """Waits until queued reports have been handled; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
@@ -1,26 +1,39 @@
 import os
 import json
-import base64
 import io
+import time
 import zipfile
+import concurrent.futures
 import requests
 import functions_framework
 from flask import request, send_file, make_response
-from google import genai
 from google.genai import types
 
-# TEMP LOGGING IMPORTS
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+import checkpoints
+import diagnostics
+import inprocess_parser
+import job_queue
+import llm_clients
+import tracing
+import usage
 
 # Configuration
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 IMAGE_PARSER_URL = os.environ.get("IMAGE_PARSER_URL")
+# "http" (default): call the image-parser function at IMAGE_PARSER_URL; "inprocess": run
+# the image_parsing package inside this function (see inprocess_parser.py).
+IMAGE_PARSER_MODE = os.environ.get("IMAGE_PARSER_MODE", "http").strip().lower()
+if IMAGE_PARSER_MODE == "inprocess":
+    inprocess_parser.require()  # fail the cold start rather than parse over HTTP
 GEMINI_MODEL = "gemini-2.5-pro"
 
+# Background runs of the pipeline for clients that poll instead of waiting (mode=job).
+JOBS = job_queue.queue_from_env("add-model")
+# Completed stages of failed runs, so a retry with the same inputs resumes (see checkpoints.py).
+CHECKPOINTS = checkpoints.store_from_env()
+# Debug reports (uploads, Gemini input/output), sent in the background (see diagnostics.py).
+DIAGNOSTICS = diagnostics.DiagnosticsSink()
+
 # System prompt for Gemini (remains the same)
 SYSTEM_PROMPT = """###INPUT EXPLANATION:
 The user will give you two types of input:
@@ -280,56 +293,6 @@ CRUCIAL: It is imperative that you do not skip over anything relevant from the i
 If the input document does not contain any of these relevant types of rules, you only have to output: There are no specified grading rules for this exam.
 """
 
-# --- TEMP LOGGING FUNCTION ---
-def send_debug_email(subject, body, attachments=None):
-    """
-    Sends an email with a subject, body, and optional attachments.
-    Reads configuration from environment variables.
-    """
-    sender_email = os.environ.get("SENDER_EMAIL")
-    sender_password = os.environ.get("SENDER_APP_PASSWORD")
-    recipient_email = os.environ.get("RECIPIENT_EMAIL")
-
-    if not all([sender_email, sender_password, recipient_email]):
-        print("Email credentials not set in environment variables. Skipping email.")
-        return
-
-    try:
-        # Create the email message
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = recipient_email
-        msg['Subject'] = subject
-
-        # Attach the body of the email
-        msg.attach(MIMEText(body, 'plain'))
-
-        # Attach files
-        if attachments:
-            for filename, content in attachments.items():
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(content)
-                encoders.encode_base64(part)
-                part.add_header(
-                    'Content-Disposition',
-                    f'attachment; filename= {filename}',
-                )
-                msg.attach(part)
-
-        # Connect to Gmail's SMTP server and send the email
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        text = msg.as_string()
-        server.sendmail(sender_email, recipient_email, text)
-        server.quit()
-        print(f"Debug email sent successfully to {recipient_email}")
-
-    except Exception as e:
-        print(f"Failed to send debug email: {e}")
-
-# --- END OF NEW FUNCTION ---
-
 def call_image_parser(files):
     """Call the image parser function with the uploaded files."""
     print("Calling image parser function...")
@@ -339,7 +302,9 @@ def call_image_parser(files):
         for file in files:
             files_data.append(('files', (file.filename, file.stream, file.content_type)))
         
-        response = requests.post(IMAGE_PARSER_URL, files=files_data, timeout=1000)
+        with tracing.span("http.image_parser", url=IMAGE_PARSER_URL, files=len(files_data)) as hop:
+            response = requests.post(IMAGE_PARSER_URL, files=files_data, headers={**tracing.headers(), **usage.headers()}, timeout=1000)
+            hop.set(**{"http.status_code": response.status_code, "response_bytes": len(response.content)})
         
         if response.status_code == 200:
             print("Image parser completed successfully")
@@ -353,16 +318,25 @@ def call_image_parser(files):
         return None
 
 def extract_files_from_zip(zip_content):
-    """Extract files from the zip returned by image parser."""
+    """
+    Extract files from the zip returned by image parser. Returns None when its manifest
+    reports an error (no output at all; the streamed response is still a 200).
+    """
     text_files = []
     image_files = []
+    parser_error = None
     
     try:
         with zipfile.ZipFile(io.BytesIO(zip_content), 'r') as zip_file:
             for filename in zip_file.namelist():
                 file_content = zip_file.read(filename)
                 
-                if filename.endswith('.txt'):
+                if filename == 'parser_manifest.json':
+                    manifest = json.loads(file_content)
+                    # The image parser's own LLM usage, passed on in this function's summary
+                    usage.merge(manifest.get('usage'), 'image-parser')
+                    parser_error = manifest.get('error')
+                elif filename.endswith('.txt'):
                     text_files.append({
                         'filename': filename,
                         'content': file_content.decode('utf-8')
@@ -373,22 +347,38 @@ def extract_files_from_zip(zip_content):
                         'content': file_content
                     })
         
+        if parser_error:
+            print(f"Image parser failed: {parser_error}")
+            return None
         print(f"Extracted {len(text_files)} text files and {len(image_files)} image files")
         return text_files, image_files
     except Exception as e:
         print(f"Error extracting files from zip: {e}")
         return [], []
 
+
+def parse_files(files):
+    """
+    Runs the image parser on the uploaded files and returns (text_files, image_files),
+    or None on failure. POSTs to IMAGE_PARSER_URL and unpacks the zip, or runs the
+    vendored image_parsing package when IMAGE_PARSER_MODE is "inprocess".
+    """
+    if IMAGE_PARSER_MODE == "inprocess":
+        return inprocess_parser.parse_files(files)
+    parser_result = call_image_parser(files)
+    if not parser_result:
+        return None
+    return extract_files_from_zip(parser_result)
+
 # Replace this function
 def create_gemini_content(text_files, image_files, json_content=None):
     """Create content parts for Gemini API call."""
     parts = []
     
     for text_file in text_files:
-        text_content_b64 = base64.b64encode(text_file['content'].encode('utf-8')).decode('utf-8')
         parts.append(types.Part.from_bytes(
             mime_type="text/plain",
-            data=base64.b64decode(text_content_b64)
+            data=text_file['content'].encode('utf-8')
         ))
     
     # Add the user-provided JSON content if it exists
@@ -398,10 +388,9 @@ def create_gemini_content(text_files, image_files, json_content=None):
 
     for image_file in image_files:
         parts.append(types.Part.from_text(text=image_file['filename']))
-        image_content_b64 = base64.b64encode(image_file['content']).decode('utf-8')
         parts.append(types.Part.from_bytes(
             mime_type="image/png",
-            data=base64.b64decode(image_content_b64)
+            data=image_file['content']
         ))
     
     return parts
@@ -430,7 +419,7 @@ def call_gemini_api(text_files, image_files, json_content=None):
     # --- END: LOGGING CAPTURE ---
 
     try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        client = llm_clients.gemini_client(GEMINI_API_KEY)
         content_parts = create_gemini_content(text_files, image_files, json_content)
         contents = [types.Content(role="user", parts=content_parts)]
 
@@ -444,11 +433,14 @@ def call_gemini_api(text_files, image_files, json_content=None):
         )
 
         print("Calling Gemini API...")
-        response = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=contents,
-            config=generate_content_config
-        )
+        with tracing.span("llm.gemini", task="structure", model=GEMINI_MODEL, parts=len(content_parts)), \
+                usage.call("gemini", GEMINI_MODEL, "structure", images=len(image_files)) as metered:
+            response = client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=generate_content_config
+            )
+            metered.record(response)
 
         # Return both the response text and the logged input
         return response.text, gemini_input_log
@@ -467,7 +459,7 @@ def call_gemini_for_grading_rules(files):
         return "Error: GEMINI_API_KEY not set."
 
     try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        client = llm_clients.gemini_client(GEMINI_API_KEY)
 
         # Create content parts from the original uploaded files
         parts = []
@@ -491,11 +483,15 @@ def call_gemini_for_grading_rules(files):
         )
 
         print("Calling Gemini API for grading rules...")
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=contents,
-            config=generate_content_config
-        )
+        images = sum(1 for file in files if (file.content_type or "").startswith("image/"))
+        with tracing.span("llm.gemini", task="grading_rules", model="gemini-2.5-flash", parts=len(parts)), \
+                usage.call("gemini", "gemini-2.5-flash", "grading_rules", images=images) as metered:
+            response = client.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=contents,
+                config=generate_content_config
+            )
+            metered.record(response)
 
         return response.text
     except Exception as e:
@@ -503,126 +499,223 @@ def call_gemini_for_grading_rules(files):
         # Return a default message in case of failure so the main process doesn't crash
         return "Failed to extract grading rules due to an API error."
 
+def _grading_rules_extracted(text):
+    """False for the placeholder texts call_gemini_for_grading_rules returns on errors."""
+    return bool(text) and not text.startswith(("Error:", "Failed to extract grading rules"))
+
+# --- Stage DAG ---
+
+def run_stages(stages, timings):
+    """
+    Runs `stages` ({name: (dependencies, fn)}) on a thread pool, starting each stage as
+    soon as all its dependencies have finished; fn gets the {name: output} of the
+    finished stages. Records {"start_s", "end_s"} per stage in `timings`, in seconds
+    since the call. Returns all outputs, or raises the first stage exception without
+    waiting for the stages that are still running.
+    """
+    started = time.monotonic()
+    outputs, pending, running = {}, dict(stages), {}
+
+    def timed(name, fn, inputs):
+        timings[name] = {"start_s": round(time.monotonic() - started, 3)}
+        try:
+            with tracing.span(f"stage.{name}"):
+                return fn(inputs)
+        finally:
+            timings[name]["end_s"] = round(time.monotonic() - started, 3)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix="stage")
+    try:
+        while pending or running:
+            for name, (dependencies, fn) in list(pending.items()):
+                if all(d in outputs for d in dependencies):
+                    del pending[name]
+                    running[executor.submit(tracing.bind(timed), name, fn, dict(outputs))] = name
+            if not running:
+                raise ValueError(f"Stages with unsatisfiable dependencies: {sorted(pending)}")
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                outputs[running.pop(future)] = future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return outputs
+
+def run_pipeline(uploads, json_content):
+    """
+    The answer model pipeline on plain inputs, shared by the synchronous endpoint and jobs.
+    `uploads` is a list of (filename, bytes, content_type), `json_content` the
+    exam_structure JSON string. Returns a job_queue.PipelineResult with the ZIP (the
+    per-stage timings in X-Stage-Timings, the LLM usage in X-Usage-Summary) or raises
+    job_queue.PipelineError. Stages that completed in an earlier failed run with the
+    same inputs are loaded from their checkpoints.
+
+    Grading-rules extraction only needs the original files, so it runs concurrently with
+    the image parser and the structuring call; only the output zip waits for both.
+    """
+    checkpoint = checkpoints.Checkpoints(CHECKPOINTS, checkpoints.fingerprint(
+        "add-model", uploads, json_content, GEMINI_MODEL, SYSTEM_PROMPT, GRADING_RULES_SYSTEM_PROMPT))
+
+    # --- START: LOGGING CAPTURE (1/3) - Raw Uploaded Files ---
+    uploaded_files_data = {filename: data for filename, data, _ in uploads}
+    # --- END: LOGGING CAPTURE (1/3) ---
+
+    def grading_rules_stage(_):
+        # Call Gemini to extract grading rules from the original documents
+        print("Step 0: Calling Gemini API for grading rules...")
+        grading_rules_text = checkpoint.stage(
+            "grading_rules",
+            lambda: call_gemini_for_grading_rules(job_queue.as_files(uploads)),
+            keep=_grading_rules_extracted,
+        )
+        return grading_rules_text or "No grading rules were extracted or an error occurred."
+
+    def parser_stage(_):
+        print("Step 1: Running image parser...")
+        parsed = checkpoint.stage(
+            "parser",
+            lambda: parse_files(job_queue.as_files(uploads)),
+            encode=checkpoints.encode_parsed,
+            decode=checkpoints.decode_parsed,
+            keep=lambda result: result is not None and any(result),
+        )
+        if parsed is None:
+            # Send email on this specific failure
+            DIAGNOSTICS.report("GCP Function FAILED - Image Parser", "The function failed during the image parser call.",
+                               uploaded_files_data, failure=True)
+            raise job_queue.PipelineError("Failed to process files with image parser.", 500)
+
+        print("Step 2: Collecting parser output...")
+        text_files, image_files = parsed
+        if not text_files and not image_files:
+            print("Warning: No text or image files extracted from parser. This might be okay if the appendix was text-only and the parser had nothing to do.")
+        return text_files, image_files
+
+    def structuring_stage(outputs):
+        print("Step 3: Calling Gemini API...")
+        text_files, image_files = outputs["parser"]
+        # The call returns two values; the input log is not checkpointed, only the output
+        gemini_input_log = None
+        def structure():
+            nonlocal gemini_input_log
+            output, gemini_input_log = call_gemini_api(text_files, image_files, json_content)
+            return output
+        structured_exam = checkpoint.stage("structuring", structure)
+
+        if not structured_exam:
+            # --- START: Report failure ---
+            def fail_attachments():
+                attachments = uploaded_files_data.copy()
+                if gemini_input_log:
+                    attachments['gemini_input_log.json'] = json.dumps(gemini_input_log, indent=2).encode('utf-8')
+                return attachments
+            DIAGNOSTICS.report("GCP Function FAILED - Gemini API", "The GCP function failed during the Gemini API call.",
+                               fail_attachments, failure=True)
+            # --- END: Report failure ---
+            raise job_queue.PipelineError("Failed to structure exam with Gemini.", 500)
+        return structured_exam, gemini_input_log
+
+    def zip_stage(outputs):
+        print("Step 4: Creating output zip...")
+        _, image_files = outputs["parser"]
+        structured_exam, _ = outputs["structuring"]
+        zip_buffer = io.BytesIO()
+        with tracing.span("zip.build") as zip_span:
+            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr('structured_exam.json', structured_exam.encode('utf-8'))
+                zf.writestr('grading_rules.txt', outputs["grading_rules"].encode('utf-8'))
+                for image_file in image_files:
+                    zf.writestr(image_file['filename'], image_file['content'])
+            zip_span.set(bytes=zip_buffer.tell())
+        return zip_buffer.getvalue()
+
+    timings = {}
+    try:
+        outputs = run_stages({
+            "grading_rules": ((), grading_rules_stage),
+            "parser": ((), parser_stage),
+            "structuring": (("parser",), structuring_stage),
+            "zip": (("grading_rules", "structuring"), zip_stage),
+        }, timings)
+    finally:
+        print(f"Stage timings (s): {json.dumps(dict(timings))}")
+    structured_exam, gemini_input_log = outputs["structuring"]
+
+    # --- START: LOGGING CAPTURE (3/3) - Final Report (sampled, sent in the background) ---
+    final_zip_content = outputs["zip"] # Get the bytes of the final zip
+
+    def all_attachments():
+        # Combine all captured data into one attachments dictionary
+        attachments = uploaded_files_data.copy()
+        attachments['gemini_input.json'] = json.dumps(gemini_input_log, indent=2).encode('utf-8')
+        attachments['gemini_output.json'] = structured_exam.encode('utf-8')
+        attachments['final_response.zip'] = final_zip_content
+        return attachments
+    DIAGNOSTICS.report("GCP Function Log", "GCP function execution completed. See attachments for details.",
+                       all_attachments)
+    # --- END: LOGGING CAPTURE (3/3) ---
+    
+    checkpoint.clear()
+    print("Processing completed successfully!")
+    return job_queue.PipelineResult(
+        final_zip_content, 'application/zip', 'structured_exam.zip',
+        headers=usage.response_headers({'X-Stage-Timings': json.dumps(timings),
+                                        'Access-Control-Expose-Headers': 'X-Stage-Timings'}),
+    )
+
 # Replace this function
 
 @functions_framework.http
+@tracing.traced_request("add-model")
+@usage.metered_request("add-model")
 def add_model(request):
     """
     HTTP Cloud Function entry point.
     Accepts files, calls image parser, then structures exam with Gemini.
+    With mode=job the pipeline runs as a background job (see job_queue.py).
     """
     # === CORS HANDLING (remains the same) ===
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
             'Access-Control-Allow-Headers': 'Content-Type',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
     headers = {'Access-Control-Allow-Origin': '*'}
+
+    job_response = job_queue.handle_job_route(request, JOBS, headers)
+    if job_response is not None:
+        return job_response
     
     if request.method != 'POST':
         return ('Please use POST request with multipart/form-data.', 405, headers)
 
-    # --- START: LOGGING CAPTURE (1/3) - Raw Uploaded Files ---
-    uploaded_files_data = {}
     files_for_parser = request.files.getlist('files')
-    if files_for_parser:
-        for file in files_for_parser:
-            file.stream.seek(0)
-            uploaded_files_data[file.filename] = file.stream.read()
-            # IMPORTANT: Reset stream so it can be read again by other functions
-            file.stream.seek(0)
-    # --- END: LOGGING CAPTURE (1/3) ---
-
     if not files_for_parser:
         return ('No appendix files uploaded. Please upload files with the key "files".', 400, headers)
     
-    # Call Gemini to extract grading rules from the original documents
-    print("Step 0: Calling Gemini API for grading rules...")
-    grading_rules_text = call_gemini_for_grading_rules(files_for_parser)
-    if not grading_rules_text:
-        grading_rules_text = "No grading rules were extracted or an error occurred."
-
-    # Reset streams again after the grading rules call
-    for file in files_for_parser:
-        file.stream.seek(0)
-    
     json_content = request.form.get('exam_structure')
     if not json_content:
         return ('The "exam_structure" JSON data is missing from the request.', 400, headers)
     
     print(f"Successfully received exam structure JSON containing {len(json_content)} characters.")
-    
-    # --- FIX START: THIS BLOCK WAS MISSING AND IS NOW RESTORED ---
-    text_files, image_files = [], []
-    
-    print("Step 1: Calling image parser...")
-    parser_result = call_image_parser(files_for_parser)
-    if not parser_result:
-        # Send email on this specific failure
-        send_debug_email("GCP Function FAILED - Image Parser", "The function failed during the image parser call.", uploaded_files_data)
-        return ("Failed to process files with image parser.", 500, headers)
-    
-    print("Step 2: Extracting files from parser result...")
-    text_files, image_files = extract_files_from_zip(parser_result)
-    if not text_files and not image_files:
-        print("Warning: No text or image files extracted from parser. This might be okay if the appendix was text-only and the parser had nothing to do.")
-    # --- FIX END ---
-
-    print("Step 3: Calling Gemini API...")
-    # The call now returns two values
-    structured_exam, gemini_input_log = call_gemini_api(text_files, image_files, json_content)
-
-    if not structured_exam:
-        # --- START: Send email on failure ---
-        email_body_on_fail = "The GCP function failed during the Gemini API call."
-        fail_attachments = uploaded_files_data.copy()
-        if gemini_input_log:
-            fail_attachments['gemini_input_log.json'] = json.dumps(gemini_input_log, indent=2).encode('utf-8')
-        send_debug_email("GCP Function FAILED - Gemini API", email_body_on_fail, fail_attachments)
-        # --- END: Send email on failure ---
-        return ("Failed to structure exam with Gemini.", 500, headers)
-    
-    print("Step 4: Creating output zip...")
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        zf.writestr('structured_exam.json', structured_exam.encode('utf-8'))
-        zf.writestr('grading_rules.txt', grading_rules_text.encode('utf-8'))
-        for image_file in image_files:
-            zf.writestr(image_file['filename'], image_file['content'])
-    
-    zip_buffer.seek(0)
-    
-    # --- START: LOGGING CAPTURE (3/3) - Final Return & Email Send ---
-    final_zip_content = zip_buffer.getvalue() # Get the bytes of the final zip
-    
-    email_body = "GCP function execution completed. See attachments for details."
-    
-    # Combine all captured data into one attachments dictionary
-    all_attachments = uploaded_files_data.copy()
-    all_attachments['gemini_input.json'] = json.dumps(gemini_input_log, indent=2).encode('utf-8')
-    all_attachments['gemini_output.json'] = structured_exam.encode('utf-8')
-    all_attachments['final_response.zip'] = final_zip_content
-    
-    # Send the email in a try-except block so it doesn't crash the main function
-    try:
-        send_debug_email("GCP Function Log", email_body, all_attachments)
-    except Exception as e:
-        print(f"An error occurred in the final email sending block: {e}")
-    # --- END: LOGGING CAPTURE (3/3) ---
 
-    # Reset buffer position again before sending the file
-    zip_buffer.seek(0)
-    
-    print("Processing completed successfully!")
+    uploads = job_queue.read_uploads(files_for_parser)
+    if job_queue.wants_job(request):
+        return job_queue.accepted_response(JOBS.submit(tracing.bind(usage.detached(run_pipeline)), uploads, json_content), headers)
+
+    try:
+        result = run_pipeline(uploads, json_content)
+    except job_queue.PipelineError as e:
+        return (e.message, e.status, headers)
     
     response = make_response(send_file(
-        zip_buffer,
-        mimetype='application/zip',
+        io.BytesIO(result.data),
+        mimetype=result.mimetype,
         as_attachment=True,
-        download_name='structured_exam.zip'
+        download_name=result.filename
     ))
     response.headers.extend(headers)
+    response.headers.extend(result.headers)
     return response
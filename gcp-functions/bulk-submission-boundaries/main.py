@@ -7,6 +7,10 @@ from flask import Request
 from google import genai
 from google.genai import types
 
+import llm_clients
+import tracing
+import usage
+
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 GEMINI_MODEL = "gemini-2.5-pro"
 
@@ -33,7 +37,7 @@ def _error(message: str, status: int = 400):
 def _get_client() -> genai.Client:
     if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY environment variable is not set.")
-    return genai.Client(api_key=GEMINI_API_KEY)
+    return llm_clients.gemini_client(GEMINI_API_KEY)
 
 
 def _build_user_instruction(students: List[Dict[str, Any]]) -> str:
@@ -66,6 +70,8 @@ def _build_user_instruction(students: List[Dict[str, Any]]) -> str:
 
 
 @functions_framework.http
+@tracing.traced_request("bulk-submission-boundaries")
+@usage.metered_request("bulk-submission-boundaries")
 def detect_submission_boundaries(request: Request):
     if request.method == "OPTIONS":
         return "", 204, _cors_headers()
@@ -113,11 +119,14 @@ def detect_submission_boundaries(request: Request):
     )
 
     try:
-        response = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=contents,
-            config=config,
-        )
+        with tracing.span("llm.gemini", task="submission_boundaries", model=GEMINI_MODEL, pdf_bytes=len(pdf_bytes)), \
+                usage.call("gemini", GEMINI_MODEL, "submission_boundaries") as metered:
+            response = client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=config,
+            )
+            metered.record(response)
     except Exception as exc:
         return _error(f"Gemini API call failed: {exc}", 500)
 
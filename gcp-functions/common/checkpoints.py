@@ -0,0 +1,226 @@
+"""
+Durable stage checkpoints for the pipeline functions, so a retry resumes instead of
+restarting.
+
+Each pipeline stage whose output is expensive to recompute (grading-rules extraction,
+the image parser's output, the Gemini structuring output) is saved under a fingerprint
+of the request: a hash of the function, its model and prompts, the uploaded files and
+the other form inputs. A retried request with the same inputs finds the stages that
+already completed and only runs the rest. Once the pipeline succeeds its checkpoints
+are cleared, so a deliberate re-submission still produces a fresh result.
+
+  - Only successful stage outputs are saved; a failed stage is recomputed on retry.
+  - Checkpoint errors are logged and never fail the pipeline; it then just recomputes.
+  - LocalCheckpointStore keeps one directory per fingerprint (default
+    /tmp/pipeline-checkpoints). It is per instance, so it helps retries that land on
+    the same instance (and background jobs, see job_queue.py).
+  - GCSCheckpointStore keeps objects under a bucket prefix and is shared by all
+    instances; expire abandoned checkpoints with a bucket lifecycle rule.
+
+Configuration:
+  CHECKPOINTS              1 (default) | 0
+  CHECKPOINT_BACKEND       local (default) | gcs
+  CHECKPOINT_DIR           directory for the local backend
+  CHECKPOINT_BUCKET        bucket for the gcs backend (CHECKPOINT_PREFIX optional)
+  CHECKPOINT_TTL_SECONDS   local checkpoints are dropped after this long (default 86400)
+"""
+import hashlib
+import io
+import os
+import shutil
+import threading
+import time
+import zipfile
+
+CHECKPOINTS_ENABLED = os.environ.get("CHECKPOINTS", "1").strip().lower() not in ("0", "false", "no", "off")
+DEFAULT_CHECKPOINT_DIR = "/tmp/pipeline-checkpoints"
+DEFAULT_TTL_SECONDS = 24 * 3600
+
+
+def fingerprint(kind, uploads, *inputs):
+    """
+    Hash identifying one pipeline request. `uploads` is a list of (filename, bytes,
+    content_type); `inputs` are the other strings the stages depend on (model names,
+    prompts, form fields). None and "" are distinct.
+    """
+    digest = hashlib.sha256()
+    digest.update(kind.encode("utf-8"))
+    for filename, data, content_type in uploads:
+        digest.update(b"\x00file\x00")
+        digest.update(f"{filename}\x00{content_type}\x00".encode("utf-8"))
+        digest.update(hashlib.sha256(data).digest())
+    for value in inputs:
+        digest.update(b"\x00none\x00" if value is None else b"\x00input\x00" + str(value).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# --- Stores ---
+
+class LocalCheckpointStore:
+    """<directory>/<fingerprint>/<stage>.ckpt, written atomically."""
+
+    def __init__(self, directory=DEFAULT_CHECKPOINT_DIR, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, fingerprint, stage):
+        return os.path.join(self.directory, fingerprint, f"{stage}.ckpt")
+
+    def get(self, fingerprint, stage):
+        try:
+            with open(self._path(fingerprint, stage), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, fingerprint, stage, data):
+        self.purge()
+        path = self._path(fingerprint, stage)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def clear(self, fingerprint):
+        shutil.rmtree(os.path.join(self.directory, fingerprint), ignore_errors=True)
+
+    def purge(self):
+        cutoff = time.time() - self.ttl_seconds
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+
+class GCSCheckpointStore:
+    """<prefix><fingerprint>/<stage>.ckpt objects in a bucket; shared by all instances."""
+
+    def __init__(self, bucket_name, prefix="pipeline-checkpoints/"):
+        from google.cloud import storage  # optional dependency, only needed for this backend
+
+        self._bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix
+
+    def get(self, fingerprint, stage):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return self._bucket.blob(f"{self.prefix}{fingerprint}/{stage}.ckpt").download_as_bytes()
+        except NotFound:
+            return None
+
+    def put(self, fingerprint, stage, data):
+        self._bucket.blob(f"{self.prefix}{fingerprint}/{stage}.ckpt").upload_from_string(data)
+
+    def clear(self, fingerprint):
+        for blob in self._bucket.list_blobs(prefix=f"{self.prefix}{fingerprint}/"):
+            blob.delete()
+
+
+def store_from_env():
+    """The configured store, or None when checkpoints are disabled."""
+    if not CHECKPOINTS_ENABLED:
+        return None
+    backend = os.environ.get("CHECKPOINT_BACKEND", "local").strip().lower()
+    if backend == "gcs":
+        bucket = os.environ.get("CHECKPOINT_BUCKET")
+        if not bucket:
+            print("Error: CHECKPOINT_BACKEND=gcs but CHECKPOINT_BUCKET is not set. Using local checkpoints.")
+        else:
+            try:
+                return GCSCheckpointStore(bucket, os.environ.get("CHECKPOINT_PREFIX", "pipeline-checkpoints/"))
+            except Exception as e:
+                print(f"Error: could not initialize the GCS checkpoint store ({e}). Using local checkpoints.")
+    elif backend != "local":
+        print(f"Warning: Unknown CHECKPOINT_BACKEND '{backend}'. Using local checkpoints.")
+    try:
+        return LocalCheckpointStore(
+            os.environ.get("CHECKPOINT_DIR", DEFAULT_CHECKPOINT_DIR),
+            int(os.environ.get("CHECKPOINT_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+        )
+    except OSError as e:
+        print(f"Error: could not create the checkpoint directory ({e}). Checkpoints are disabled.")
+        return None
+
+
+# --- Stage encodings ---
+
+def encode_text(text):
+    return text.encode("utf-8")
+
+
+def decode_text(data):
+    return data.decode("utf-8")
+
+
+def encode_parsed(parsed):
+    """(text_files, image_files) from parse_files() as a ZIP, keeping their order."""
+    text_files, image_files = parsed
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+        for text_file in text_files:
+            zf.writestr(f"text/{text_file['filename']}", text_file["content"].encode("utf-8"))
+        for image_file in image_files:
+            zf.writestr(f"image/{image_file['filename']}", image_file["content"])
+    return buffer.getvalue()
+
+
+def decode_parsed(data):
+    text_files, image_files = [], []
+    with zipfile.ZipFile(io.BytesIO(data), "r") as zf:
+        for name in zf.namelist():
+            kind, filename = name.split("/", 1)
+            if kind == "text":
+                text_files.append({"filename": filename, "content": zf.read(name).decode("utf-8")})
+            else:
+                image_files.append({"filename": filename, "content": zf.read(name)})
+    return text_files, image_files
+
+
+# --- Per-request view ---
+
+class Checkpoints:
+    """The checkpoints of one request (one fingerprint) in `store`, which may be None."""
+
+    def __init__(self, store, fingerprint):
+        self.store = store
+        self.fingerprint = fingerprint
+        self.resumed = []
+
+    def stage(self, name, compute, encode=encode_text, decode=decode_text, keep=bool):
+        """
+        The saved output of stage `name`, or compute() saved for the next retry when
+        keep(output) is true. Unreadable checkpoints are ignored and recomputed.
+        """
+        if self.store is not None:
+            try:
+                data = self.store.get(self.fingerprint, name)
+                if data is not None:
+                    output = decode(data)
+                    self.resumed.append(name)
+                    print(f"Resuming stage '{name}' from checkpoint {self.fingerprint[:12]}.")
+                    return output
+            except Exception as e:
+                print(f"Warning: could not read checkpoint '{name}' ({e}); recomputing.")
+
+        output = compute()
+        if self.store is not None and keep(output):
+            try:
+                self.store.put(self.fingerprint, name, encode(output))
+            except Exception as e:
+                print(f"Warning: could not save checkpoint '{name}': {e}")
+        return output
+
+    def clear(self):
+        """Drops this request's checkpoints once its pipeline has succeeded."""
+        if self.store is None:
+            return
+        try:
+            self.store.clear(self.fingerprint)
+        except Exception as e:
+            print(f"Warning: could not clear checkpoints {self.fingerprint[:12]}: {e}")
@@ -0,0 +1,219 @@
+"""
+Payload-size-aware image encoding for LLM requests.
+
+A 300 DPI page saved as PNG and base64-inflated into a data URL is several MB per
+request, most of it spent on scanner noise that no model needs. `encode_for_llm`
+picks a format per image instead:
+
+  - grayscale pages (scans of black-on-white text) are encoded as single-channel,
+  - photos and noisy scans are encoded lossily (JPEG by default, or WebP),
+  - PNG is only used when the image has few distinct tones (born-digital renders,
+    line art) and the lossless encoding is not meaningfully larger than the lossy one,
+  - if the result is still over the byte target, quality and then resolution are
+    stepped down until it fits (never below IMAGE_ENCODE_MIN_DIMENSION).
+
+Encodings are cached per PIL image object (weakly, so they disappear with the
+image), which means retries and hedged calls of the same page never re-encode.
+
+Configuration:
+  IMAGE_ENCODE_MODE            auto (default) | png (previous behaviour: always PNG)
+  IMAGE_ENCODE_TARGET_BYTES    byte target per image before base64 (default 1,500,000)
+  IMAGE_ENCODE_LOSSY_FORMAT    JPEG (default) | WEBP
+  IMAGE_ENCODE_QUALITY         starting lossy quality (default 85)
+  IMAGE_ENCODE_MIN_DIMENSION   smallest longest-side allowed when downscaling (default 1600)
+"""
+import base64
+import io
+import os
+import threading
+import weakref
+
+from PIL import Image
+
+ENCODE_MODE = os.environ.get("IMAGE_ENCODE_MODE", "auto").strip().lower()
+TARGET_BYTES = int(os.environ.get("IMAGE_ENCODE_TARGET_BYTES", "1500000"))
+LOSSY_FORMAT = os.environ.get("IMAGE_ENCODE_LOSSY_FORMAT", "JPEG").strip().upper()
+START_QUALITY = int(os.environ.get("IMAGE_ENCODE_QUALITY", "85"))
+MIN_DIMENSION = int(os.environ.get("IMAGE_ENCODE_MIN_DIMENSION", "1600"))
+
+QUALITY_FLOOR = 55
+QUALITY_STEP = 10
+DOWNSCALE_STEP = 0.8
+# PNG is kept when it is at most this much larger than the lossy candidate.
+PNG_PREFERENCE_RATIO = 1.25
+# Analysis thumbnail and thresholds for the per-image decision.
+THUMBNAIL_SIZE = 256
+GRAYSCALE_SATURATION_LIMIT = 24   # 99th percentile HSV saturation (0-255)
+PNG_MAX_TONES = 48                 # distinct (coarsely quantized) colors in the thumbnail
+
+_MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class EncodedImage:
+    """Encoded bytes plus what was chosen, ready for a data URL or a Gemini Part."""
+
+    def __init__(self, data, image_format, size, grayscale, quality=None):
+        self.data = data
+        self.format = image_format
+        self.size = size
+        self.grayscale = grayscale
+        self.quality = quality
+
+    @property
+    def mime_type(self):
+        return _MIME_TYPES[self.format]
+
+    @property
+    def base64(self):
+        return base64.b64encode(self.data).decode("utf-8")
+
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+    def describe(self):
+        detail = f"q{self.quality}" if self.quality else "lossless"
+        mode = "gray" if self.grayscale else "color"
+        return f"{self.format} {mode} {detail} {self.size[0]}x{self.size[1]}, {len(self.data)} bytes"
+
+
+# --- Analysis ---
+
+def _is_grayscale(thumbnail):
+    saturation = thumbnail.convert("HSV").getchannel("S")
+    histogram = saturation.histogram()
+    cutoff = 0.99 * sum(histogram)
+    running = 0
+    for value, count in enumerate(histogram):
+        running += count
+        if running >= cutoff:
+            return value <= GRAYSCALE_SATURATION_LIMIT
+    return True
+
+
+def _has_few_tones(thumbnail):
+    # Quantize each channel to 32 levels so anti-aliasing noise does not count as new colors.
+    coarse = thumbnail.point(lambda v: v & 0xF8)
+    return coarse.getcolors(maxcolors=PNG_MAX_TONES) is not None
+
+
+def _analyse(pil_image):
+    thumbnail = pil_image.convert("RGB")
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    grayscale = _is_grayscale(thumbnail)
+    few_tones = _has_few_tones(thumbnail.convert("L") if grayscale else thumbnail)
+    return grayscale, few_tones
+
+
+# --- Encoding ---
+
+def _save(image, image_format, quality=None):
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, format="PNG", optimize=False, compress_level=6)
+    elif image_format == "WEBP":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _encode(pil_image, target_bytes):
+    if ENCODE_MODE == "png":
+        image = pil_image if pil_image.mode in ("RGB", "RGBA", "L") else pil_image.convert("RGB")
+        return EncodedImage(_save(image, "PNG"), "PNG", image.size, image.mode == "L")
+
+    grayscale, few_tones = _analyse(pil_image)
+    image = pil_image.convert("L" if grayscale else "RGB")
+    lossy_format = LOSSY_FORMAT if LOSSY_FORMAT in ("JPEG", "WEBP") else "JPEG"
+
+    while True:
+        quality = START_QUALITY
+        lossy = _save(image, lossy_format, quality)
+        if few_tones:
+            lossless = _save(image, "PNG")
+            if len(lossless) <= target_bytes and len(lossless) <= PNG_PREFERENCE_RATIO * len(lossy):
+                return EncodedImage(lossless, "PNG", image.size, grayscale)
+
+        while len(lossy) > target_bytes and quality - QUALITY_STEP >= QUALITY_FLOOR:
+            quality -= QUALITY_STEP
+            lossy = _save(image, lossy_format, quality)
+        if len(lossy) <= target_bytes:
+            return EncodedImage(lossy, lossy_format, image.size, grayscale, quality)
+
+        longest = max(image.size)
+        if longest * DOWNSCALE_STEP < MIN_DIMENSION:
+            # Cannot shrink further without hurting legibility; send the smallest we have.
+            return EncodedImage(lossy, lossy_format, image.size, grayscale, quality)
+        new_size = (max(1, int(image.size[0] * DOWNSCALE_STEP)), max(1, int(image.size[1] * DOWNSCALE_STEP)))
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+
+# --- Cache and stats ---
+
+# PIL images define __eq__ and are therefore unhashable, so entries are keyed by id()
+# and dropped by a weakref finalizer when the image is garbage-collected.
+_cache = {}
+_cache_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"encodings": 0, "cache_hits": 0, "calls": 0, "bytes_sent": 0, "raw_bytes": 0, "formats": {}}
+
+
+def _forget(image_id):
+    with _cache_lock:
+        _cache.pop(image_id, None)
+
+
+def encode_for_llm(pil_image, target_bytes=None):
+    """
+    Returns the EncodedImage for `pil_image`, encoding it at most once per target.
+    The same image object passed again (e.g. on a retry) is served from the cache.
+    """
+    target_bytes = target_bytes or TARGET_BYTES
+    with _cache_lock:
+        entry = _cache.get(id(pil_image))
+        cached = entry[1].get(target_bytes) if entry is not None and entry[0]() is pil_image else None
+    if cached is not None:
+        with _stats_lock:
+            _stats["cache_hits"] += 1
+        return cached
+
+    encoded = _encode(pil_image, target_bytes)
+    with _cache_lock:
+        entry = _cache.get(id(pil_image))
+        if entry is None or entry[0]() is not pil_image:
+            entry = (weakref.ref(pil_image), {})
+            _cache[id(pil_image)] = entry
+            weakref.finalize(pil_image, _forget, id(pil_image))
+        entry[1][target_bytes] = encoded
+    with _stats_lock:
+        _stats["encodings"] += 1
+        _stats["formats"][encoded.format] = _stats["formats"].get(encoded.format, 0) + 1
+    return encoded
+
+
+def record_sent(task_name, encoded_images, base64_encoded=False):
+    """Logs and accumulates the bytes one call uploads (base64 adds ~33% for data URLs)."""
+    images = list(encoded_images)
+    sent = sum(len(img.data) for img in images)
+    if base64_encoded:
+        sent = sum(4 * ((len(img.data) + 2) // 3) for img in images)
+    raw = sum(img.size[0] * img.size[1] * (1 if img.grayscale else 3) for img in images)
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats["bytes_sent"] += sent
+        _stats["raw_bytes"] += raw
+    formats = ", ".join(img.describe() for img in images[:3]) + (" ..." if len(images) > 3 else "")
+    print(f"'{task_name}' upload: {sent} bytes for {len(images)} image(s) [{formats}]")
+
+
+def config_signature():
+    """Identifies the encoding settings, so cached model outputs are keyed by what the model saw."""
+    return f"enc:{ENCODE_MODE}:{LOSSY_FORMAT}:{START_QUALITY}:{TARGET_BYTES}:{MIN_DIMENSION}"
+
+
+def stats():
+    with _stats_lock:
+        snapshot = dict(_stats, formats=dict(_stats["formats"]))
+    if snapshot["raw_bytes"]:
+        snapshot["sent_vs_raw_ratio"] = round(snapshot["bytes_sent"] / snapshot["raw_bytes"], 4)
+    return snapshot
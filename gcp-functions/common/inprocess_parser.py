@@ -0,0 +1,77 @@
+"""
+Runs the image parser inside a pipeline function instead of calling it over HTTP.
+
+The pipeline functions (exam-structurer, add-appendix, add-model, add-student-answers)
+call the image-parser function at IMAGE_PARSER_URL by default. With
+IMAGE_PARSER_MODE=inprocess they import the image_parsing package instead, which
+saves the upload and ZIP round trip. The package is not part of a function's
+directory; it is vendored in at build time together with its requirements:
+
+    python deploy.py deploy exam-structurer --with-image-parser -- <gcloud args>
+
+An in-process parser then runs with this function's environment and resources:
+  - it needs DASHSCOPE_API_KEY (and GEMINI_API_KEY) set on this function,
+  - its process-wide LLM scheduler and page cache are shared by all concurrent requests
+    on the instance, next to this function's own LLM calls, so size the instance (and
+    the scheduler limits) for both.
+
+require() fails the cold start when in-process mode is configured but not deployed
+that way, instead of silently parsing over HTTP.
+"""
+import os
+
+import tracing
+import usage
+
+_PACKAGE = None
+
+
+def require():
+    """Imports image_parsing, raising RuntimeError when it or its API keys are missing."""
+    global _PACKAGE
+    if _PACKAGE is None:
+        try:
+            import image_parsing
+        except ImportError as e:
+            raise RuntimeError(
+                "IMAGE_PARSER_MODE=inprocess, but the image_parsing package is not deployed with this "
+                f"function ({e}). Build it with `deploy.py ... --with-image-parser` or use IMAGE_PARSER_MODE=http."
+            ) from e
+        missing = [key for key in ("DASHSCOPE_API_KEY", "GEMINI_API_KEY") if not os.environ.get(key)]
+        if missing:
+            raise RuntimeError(f"IMAGE_PARSER_MODE=inprocess needs {', '.join(missing)} set on this function.")
+        _PACKAGE = image_parsing
+    return _PACKAGE
+
+
+def parse_files(files):
+    """
+    Parses uploaded werkzeug FileStorage objects in-process. Returns (text_files,
+    image_files) in the shape extract_files_from_zip gives, or None on failure
+    (including a run whose manifest reports an error because nothing was produced).
+    """
+    parser = require()
+    print("Running image parser in-process...")
+    try:
+        uploads = []
+        for file in files:
+            file.stream.seek(0)
+            uploads.append((file.filename, file.stream.read()))
+            file.stream.seek(0)
+        # The package traces with its own copy of tracing.py; hand it this trace.
+        with tracing.span("image_parser.inprocess", files=len(uploads)), \
+                parser.tracing.continue_from(tracing.headers()):
+            result = parser.parse_uploads(uploads)
+    except Exception as e:
+        print(f"Error running image parser in-process: {e}")
+        return None
+
+    # The parser ran in this process, so its LLM calls count as this function's own.
+    usage.merge(result.manifest.get("usage"), "image-parser", own=True)
+    if result.manifest.get("error"):
+        print(f"Image parser failed: {result.manifest['error']}")
+        return None
+    text_files = [{'filename': f.name, 'content': f.text()} for f in result.text_files]
+    image_files = [{'filename': f.name, 'content': f.data} for f in result.image_files]
+    print(f"Parsed {len(result.pages)} pages into {len(text_files)} text files and {len(image_files)} image files")
+    return text_files, image_files
@@ -0,0 +1,450 @@
+"""
+Asynchronous job API for the long-running pipeline functions.
+
+Instead of holding one HTTP request open for the whole pipeline, a client can submit
+with `mode=job` (form field or query parameter) and gets 202 with a job id right away.
+The pipeline then runs on this instance's worker pool and the client polls:
+
+  GET <function-url>/jobs/<job_id>          {"job_id", "status", "error", ...}
+  GET <function-url>/jobs/<job_id>/result   the pipeline's response body once "succeeded"
+
+Status goes queued -> running -> succeeded | failed.
+
+Job records and results live in a pluggable JobStore:
+  - SQLiteJobStore:     one SQLite file (default /tmp/pipeline-jobs.sqlite3).
+  - FilesystemJobStore: a JSON record and a result file per job in one directory.
+  - GCSJobStore:        JSON record and result blob per job in a bucket.
+The local stores only see jobs of the same instance: with several instances the poll
+for a job lands on an instance that never saw it. So on Cloud Functions (K_SERVICE is
+set) the default backend is gcs (expire old jobs with a bucket lifecycle rule), and a
+local store is only used with JOB_STORE_SINGLE_INSTANCE=1 for a deployment limited to
+one instance. Without a usable store there, mode=job requests are refused with 503
+and the synchronous endpoint keeps working. Locally the default is sqlite.
+
+Work continues after the 202 response, so deploy with CPU always allocated. A job
+whose instance was shut down stays "running"; clients should give up once
+`updated_at` is older than their own timeout.
+
+Configuration:
+  JOB_STORE_BACKEND          gcs (default on Cloud Functions) | sqlite (default locally) | filesystem
+  JOB_STORE_BUCKET           bucket for the gcs backend (JOB_STORE_PREFIX optional)
+  JOB_STORE_PATH             SQLite file or directory for the local stores
+  JOB_STORE_SINGLE_INSTANCE  1 | 0 (default): allow a local store on Cloud Functions
+  JOB_WORKERS        pipeline runs in parallel per instance (default 2)
+  JOB_TTL_SECONDS    local stores drop finished jobs after this long (default 86400)
+"""
+import concurrent.futures
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from flask import jsonify
+from werkzeug.datastructures import FileStorage
+
+DEFAULT_SQLITE_PATH = "/tmp/pipeline-jobs.sqlite3"
+DEFAULT_JOB_DIR = "/tmp/pipeline-jobs"
+DEFAULT_WORKERS = 2
+DEFAULT_TTL_SECONDS = 24 * 3600
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+
+class PipelineError(Exception):
+    """A pipeline failure with the HTTP status the synchronous endpoint returns for it."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class PipelineResult:
+    """
+    A pipeline's response body, returned as-is by the sync endpoint and the result route,
+    with optional extra response headers (e.g. timing reports).
+    """
+
+    def __init__(self, data, mimetype="application/zip", filename=None, headers=None):
+        self.data = data
+        self.mimetype = mimetype
+        self.filename = filename
+        self.headers = headers or {}
+
+
+# --- Stores ---
+
+class JobStore:
+    """Persists job records (plain dicts) and result bodies."""
+
+    def create(self, job):
+        raise NotImplementedError
+
+    def update(self, job_id, **fields):
+        raise NotImplementedError
+
+    def get(self, job_id):
+        raise NotImplementedError
+
+    def put_result(self, job_id, data):
+        raise NotImplementedError
+
+    def get_result(self, job_id):
+        raise NotImplementedError
+
+    def purge(self, older_than):
+        """Drops finished jobs last updated before `older_than` (epoch seconds)."""
+
+
+class SQLiteJobStore(JobStore):
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY, updated_at REAL, status TEXT, record TEXT, result BLOB)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create(self, job):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, updated_at, status, record) VALUES (?, ?, ?, ?)",
+                (job["job_id"], job["updated_at"], job["status"], json.dumps(job)),
+            )
+
+    def update(self, job_id, **fields):
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(json.loads(row[0]), **fields)
+            conn.execute(
+                "UPDATE jobs SET updated_at = ?, status = ?, record = ? WHERE job_id = ?",
+                (job["updated_at"], job["status"], json.dumps(job), job_id),
+            )
+            return job
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_result(self, job_id, data):
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE jobs SET result = ? WHERE job_id = ?", (sqlite3.Binary(data), job_id))
+
+    def get_result(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bytes(row[0]) if row and row[0] is not None else None
+
+    def purge(self, older_than):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE updated_at < ? AND status IN (?, ?)",
+                (older_than, SUCCEEDED, FAILED),
+            )
+
+
+class FilesystemJobStore(JobStore):
+    """<directory>/<job_id>.json holds the record, <job_id>.result the result body."""
+
+    def __init__(self, directory=DEFAULT_JOB_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.directory, f"{job_id}.{suffix}")
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def create(self, job):
+        self._write(self._path(job["job_id"], "json"), json.dumps(job).encode("utf-8"))
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self.get(job_id)
+            if job is None:
+                return None
+            job.update(fields)
+            self._write(self._path(job_id, "json"), json.dumps(job).encode("utf-8"))
+            return job
+
+    def get(self, job_id):
+        try:
+            with open(self._path(job_id, "json"), "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def put_result(self, job_id, data):
+        self._write(self._path(job_id, "result"), data)
+
+    def get_result(self, job_id):
+        try:
+            with open(self._path(job_id, "result"), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def purge(self, older_than):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            job = self.get(name[:-len(".json")])
+            if job and job["status"] in (SUCCEEDED, FAILED) and job["updated_at"] < older_than:
+                for suffix in ("json", "result"):
+                    try:
+                        os.remove(self._path(job["job_id"], suffix))
+                    except FileNotFoundError:
+                        pass
+
+
+class GCSJobStore(JobStore):
+    """Records and results as objects under `prefix`; shared by all instances."""
+
+    def __init__(self, bucket_name, prefix="pipeline-jobs/"):
+        from google.cloud import storage  # optional dependency, only needed for this backend
+
+        self._bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix
+        self._lock = threading.Lock()
+
+    def _blob(self, job_id, suffix):
+        return self._bucket.blob(f"{self.prefix}{job_id}.{suffix}")
+
+    def create(self, job):
+        self._blob(job["job_id"], "json").upload_from_string(json.dumps(job), content_type="application/json")
+
+    def update(self, job_id, **fields):
+        with self._lock:  # records are only updated by the instance running the job
+            job = self.get(job_id)
+            if job is None:
+                return None
+            job.update(fields)
+            self.create(job)
+            return job
+
+    def get(self, job_id):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return json.loads(self._blob(job_id, "json").download_as_bytes())
+        except NotFound:
+            return None
+
+    def put_result(self, job_id, data):
+        self._blob(job_id, "result").upload_from_string(data)
+
+    def get_result(self, job_id):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return self._blob(job_id, "result").download_as_bytes()
+        except NotFound:
+            return None
+
+
+def running_on_cloud():
+    """True on Cloud Functions (and Cloud Run), which set K_SERVICE; False when run locally."""
+    return bool(os.environ.get("K_SERVICE"))
+
+
+def store_from_env():
+    """
+    The configured store, or None when jobs cannot be accepted: on Cloud Functions
+    without a working GCS store, unless JOB_STORE_SINGLE_INSTANCE allows a local one.
+    """
+    on_cloud = running_on_cloud()
+    local_allowed = not on_cloud or os.environ.get("JOB_STORE_SINGLE_INSTANCE", "0").strip().lower() in (
+        "1", "true", "yes", "on")
+    fallback = "Using SQLite." if local_allowed else "mode=job requests will be refused."
+    backend = os.environ.get("JOB_STORE_BACKEND", "gcs" if on_cloud else "sqlite").strip().lower()
+    path = os.environ.get("JOB_STORE_PATH")
+    if backend == "gcs":
+        bucket = os.environ.get("JOB_STORE_BUCKET")
+        if not bucket:
+            print(f"Error: JOB_STORE_BACKEND=gcs but JOB_STORE_BUCKET is not set. {fallback}")
+        else:
+            try:
+                return GCSJobStore(bucket, os.environ.get("JOB_STORE_PREFIX", "pipeline-jobs/"))
+            except Exception as e:
+                print(f"Error: could not initialize the GCS job store ({e}). {fallback}")
+    elif not local_allowed:
+        print(f"Error: JOB_STORE_BACKEND={backend} is not a shared job store; set JOB_STORE_SINGLE_INSTANCE=1 "
+              f"if this function runs on one instance only. {fallback}")
+    elif backend == "filesystem":
+        return FilesystemJobStore(path or DEFAULT_JOB_DIR)
+    elif backend != "sqlite":
+        print(f"Warning: Unknown JOB_STORE_BACKEND '{backend}'. Using SQLite.")
+    return SQLiteJobStore(path or DEFAULT_SQLITE_PATH) if local_allowed else None
+
+
+# --- Queue ---
+
+class JobQueue:
+    """
+    Runs submitted pipeline calls on a thread pool and records their outcome in `store`
+    (None when jobs cannot be accepted, see store_from_env).
+    """
+
+    def __init__(self, kind, store, workers=DEFAULT_WORKERS, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.kind = kind
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{kind}-job")
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs), which returns a PipelineResult or raises; returns the job record."""
+        try:
+            self.store.purge(time.time() - self.ttl_seconds)
+        except Exception as e:
+            print(f"Warning: could not purge old jobs: {e}")
+        now = time.time()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "kind": self.kind,
+            "status": QUEUED,
+            "created_at": now,
+            "updated_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "error_status": None,
+            "result_mimetype": None,
+            "result_filename": None,
+            "result_bytes": None,
+            "result_headers": {},
+        }
+        self.store.create(job)
+        self._executor.submit(self._run, job["job_id"], fn, args, kwargs)
+        print(f"Queued {self.kind} job {job['job_id']}.")
+        return job
+
+    def _run(self, job_id, fn, args, kwargs):
+        started = time.time()
+        self.store.update(job_id, status=RUNNING, started_at=started, updated_at=started)
+        try:
+            result = fn(*args, **kwargs)
+        except PipelineError as e:
+            self._fail(job_id, e.message, e.status)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self._fail(job_id, f"Unexpected error: {e}", 500)
+            return
+        try:
+            self.store.put_result(job_id, result.data)
+        except Exception as e:
+            self._fail(job_id, f"Could not store the result: {e}", 500)
+            return
+        finished = time.time()
+        self.store.update(
+            job_id, status=SUCCEEDED, finished_at=finished, updated_at=finished,
+            result_mimetype=result.mimetype, result_filename=result.filename, result_bytes=len(result.data),
+            result_headers=result.headers,
+        )
+        print(f"{self.kind} job {job_id} succeeded in {finished - started:.1f}s.")
+
+    def _fail(self, job_id, message, status):
+        finished = time.time()
+        self.store.update(job_id, status=FAILED, finished_at=finished, updated_at=finished,
+                          error=message, error_status=status)
+        print(f"{self.kind} job {job_id} failed: {message}")
+
+
+def queue_from_env(kind):
+    return JobQueue(
+        kind,
+        store_from_env(),
+        workers=int(os.environ.get("JOB_WORKERS", DEFAULT_WORKERS)),
+        ttl_seconds=int(os.environ.get("JOB_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+    )
+
+
+# --- HTTP helpers ---
+
+def read_uploads(files):
+    """Plain (filename, bytes, content_type) tuples for uploaded FileStorage objects."""
+    uploads = []
+    for file in files:
+        file.stream.seek(0)
+        uploads.append((file.filename, file.stream.read(), file.content_type))
+        file.stream.seek(0)
+    return uploads
+
+
+def as_files(uploads):
+    """FileStorage objects for (filename, bytes, content_type) tuples, as the parser helpers expect."""
+    return [
+        FileStorage(stream=io.BytesIO(data), filename=filename, content_type=content_type)
+        for filename, data, content_type in uploads
+    ]
+
+
+def wants_job(request):
+    return "job" in (request.args.get("mode"), request.form.get("mode"))
+
+
+def accepted_response(job, headers):
+    body = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "status_path": f"/jobs/{job['job_id']}",
+        "result_path": f"/jobs/{job['job_id']}/result",
+    }
+    return (json.dumps(body), 202, {**headers, "Content-Type": "application/json",
+                                    "Location": body["status_path"]})
+
+
+def handle_job_route(request, queue, headers):
+    """
+    Response for GET /jobs/<id>[/result], 503 for a mode=job submission when `queue`
+    has no store, or None when the request is neither.
+    """
+    parts = [p for p in request.path.split("/") if p]
+    if request.method != "GET" or len(parts) not in (2, 3) or parts[0] != "jobs" \
+            or (len(parts) == 3 and parts[2] != "result"):
+        if queue.store is None and request.method == "POST" and wants_job(request):
+            return ("mode=job is not available: this function has no shared job store "
+                    "(set JOB_STORE_BUCKET). Submit without mode=job.", 503, headers)
+        return None
+    if queue.store is None:
+        return ("Unknown job id.", 404, headers)
+
+    job = queue.store.get(parts[1]) if re.fullmatch(r"[0-9a-f]{32}", parts[1]) else None
+    if job is None or job.get("kind") != queue.kind:
+        return ("Unknown job id.", 404, headers)
+
+    if len(parts) == 2:
+        response = jsonify(job)
+        response.headers.extend(headers)
+        return response
+
+    if job["status"] == FAILED:
+        return (job["error"] or "Job failed.", job["error_status"] or 500, headers)
+    if job["status"] != SUCCEEDED:
+        return (json.dumps({"job_id": job["job_id"], "status": job["status"]}), 409,
+                {**headers, "Content-Type": "application/json"})
+    data = queue.store.get_result(job["job_id"])
+    if data is None:
+        return ("The job result is no longer available.", 410, headers)
+    result_headers = {**headers, **(job.get("result_headers") or {}),
+                      "Content-Type": job["result_mimetype"] or "application/octet-stream"}
+    if job["result_filename"]:
+        result_headers["Content-Disposition"] = f'attachment; filename="{job["result_filename"]}"'
+    return (data, 200, result_headers)
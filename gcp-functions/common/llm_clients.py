@@ -0,0 +1,145 @@
+"""
+Process-wide registry of LLM API clients.
+
+Building a `genai.Client` or `OpenAI` client per call means a fresh connection
+pool, and so a fresh TCP + TLS handshake, on every request. Clients here are
+created lazily on first use, shared by all threads and all requests on a warm
+instance, and keep their HTTP connections alive between calls.
+
+    client = llm_clients.gemini_client(GEMINI_API_KEY)
+    client = llm_clients.openai_client(DASHSCOPE_API_KEY, DASHSCOPE_BASE_URL, name="dashscope")
+
+The one exception is google-genai's async client (`client.aio`): its connection pool
+binds to the event loop that first uses it, so it cannot outlive an `asyncio.run()`.
+Async callers open one per event loop with `gemini_async_client()` instead.
+
+`stats()` reports, per client, when it was created and how many times it was
+handed out, i.e. how often a call reused an existing connection pool instead of
+building a new one.
+
+Pool sizing (OpenAI-compatible clients):
+  LLM_HTTP_MAX_CONNECTIONS  (default 32)
+  LLM_HTTP_MAX_KEEPALIVE    (default 16)
+  LLM_HTTP_KEEPALIVE_EXPIRY (seconds, default 120)
+"""
+import contextlib
+import hashlib
+import os
+import threading
+import time
+
+DASHSCOPE_BASE_URL = "https://dashscope-intl.aliyuncs.com/compatible-mode/v1"
+
+MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "32"))
+MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", "16"))
+KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", "120"))
+
+
+class _ClientEntry:
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.created_at = time.time()
+        self.uses = 0
+
+
+class ClientRegistry:
+    """Thread-safe map of lazily created clients, keyed by provider name and credentials."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.acquired = 0
+
+    def get(self, name, credential, factory):
+        # The key only holds a digest of the credential, so keys never appear in stats or logs.
+        key = (name, hashlib.sha256((credential or "").encode("utf-8")).hexdigest()[:16])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Created under the lock: concurrent first calls must not each build a pool.
+                entry = _ClientEntry(name, factory())
+                self._entries[key] = entry
+                self.created += 1
+                print(f"Created shared LLM client '{name}'.")
+            entry.uses += 1
+            self.acquired += 1
+            return entry.client
+
+    def reset(self):
+        """Drops every cached client (e.g. after an API key rotation)."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            clients = {}
+            for (name, key_digest), entry in self._entries.items():
+                label = name if name not in clients else f"{name}:{key_digest[:6]}"
+                clients[label] = {
+                    "uses": entry.uses,
+                    "reuses": entry.uses - 1,
+                    "age_s": round(now - entry.created_at, 1),
+                }
+            return {
+                "clients_created": self.created,
+                "acquisitions": self.acquired,
+                "reuse_ratio": round(1 - self.created / self.acquired, 3) if self.acquired else 0.0,
+                "clients": clients,
+            }
+
+
+REGISTRY = ClientRegistry()
+
+
+def gemini_client(api_key):
+    """Returns the shared google-genai client for `api_key`."""
+    def factory():
+        from google import genai
+
+        return genai.Client(api_key=api_key)
+
+    return REGISTRY.get("gemini", api_key, factory)
+
+
+@contextlib.asynccontextmanager
+async def gemini_async_client(api_key):
+    """
+    Yields a google-genai async client (`genai.Client(...).aio`) for the running event
+    loop and closes it on exit. Not shared: see the module docstring.
+    """
+    from google import genai
+
+    client = genai.Client(api_key=api_key)
+    try:
+        yield client.aio
+    finally:
+        await client.aio.aclose()
+        client.close()
+
+
+def openai_client(api_key, base_url=None, name="openai"):
+    """
+    Returns the shared OpenAI-compatible client for (`api_key`, `base_url`), backed by a
+    keep-alive httpx pool sized from the LLM_HTTP_* environment variables.
+    """
+    def factory():
+        import httpx
+        from openai import DefaultHttpxClient, OpenAI
+
+        http_client = DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            )
+        )
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+    return REGISTRY.get(name, f"{base_url}|{api_key}", factory)
+
+
+def stats():
+    return REGISTRY.stats()
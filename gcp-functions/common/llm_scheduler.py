@@ -0,0 +1,174 @@
+"""
+Process-wide, provider-aware scheduler for outbound LLM calls.
+
+Every call to an external model goes through `SCHEDULER.submit(provider, fn, ...)`.
+Each provider (e.g. "gemini", "dashscope") gets:
+  - a fixed number of worker threads (its concurrency limit),
+  - a token bucket limiting the request start rate,
+  - a bound on queued calls; `submit` blocks once it is reached (backpressure).
+
+Because the scheduler lives at module level it is shared by all concurrent HTTP
+requests on the same instance, unlike the per-request thread pools it replaces.
+Queue wait (submit -> start) is measured per call and aggregated per provider.
+"""
+import concurrent.futures
+import os
+import threading
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `burst` stored."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class _ProviderLane:
+    def __init__(self, name, concurrency, rate, burst, max_queued):
+        self.name = name
+        self.concurrency = concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix=f"llm-{name}"
+        )
+        self.bucket = TokenBucket(rate, burst)
+        # Bounds calls that are queued or running; `submit` blocks when exhausted.
+        self.slots = threading.BoundedSemaphore(concurrency + max_queued)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits = deque(maxlen=500)
+
+    def record_wait(self, wait):
+        with self.lock:
+            self.completed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.recent_waits.append(wait)
+
+    def snapshot(self):
+        with self.lock:
+            waits = sorted(self.recent_waits)
+            p95 = waits[int(0.95 * (len(waits) - 1))] if waits else 0.0
+            return {
+                "concurrency": self.concurrency,
+                "rate_per_s": self.bucket.rate,
+                "pending": self.pending,
+                "completed": self.completed,
+                "avg_queue_wait_ms": round(1000 * self.total_wait / self.completed, 1) if self.completed else 0.0,
+                "p95_queue_wait_ms": round(1000 * p95, 1),
+                "max_queue_wait_ms": round(1000 * self.max_wait, 1),
+            }
+
+
+class LLMScheduler:
+    def __init__(self, limits):
+        """
+        limits: {provider: {"concurrency": int, "rate": float, "burst": int, "max_queued": int}}
+        """
+        self._lanes = {
+            name: _ProviderLane(
+                name,
+                concurrency=max(1, int(cfg.get("concurrency", 4))),
+                rate=cfg.get("rate", 0),
+                burst=cfg.get("burst", cfg.get("concurrency", 4)),
+                max_queued=max(0, int(cfg.get("max_queued", 64))),
+            )
+            for name, cfg in limits.items()
+        }
+
+    def submit(self, provider, fn, *args, **kwargs):
+        """
+        Schedules fn(*args, **kwargs) on the provider's lane and returns a Future.
+        Blocks while the lane's queue is full. The returned future carries
+        `queue_wait_s` and `started_at` (monotonic) attributes once the call has started.
+        """
+        lane = self._lanes[provider]
+        lane.slots.acquire()
+        with lane.lock:
+            lane.pending += 1
+        enqueued = time.monotonic()
+        future = concurrent.futures.Future()
+        future.queue_wait_s = None
+        future.started_at = None
+
+        def release():
+            with lane.lock:
+                lane.pending -= 1
+            lane.slots.release()
+
+        def run():
+            try:
+                if not future.set_running_or_notify_cancel():
+                    return
+                lane.bucket.acquire()
+                wait = time.monotonic() - enqueued
+                lane.record_wait(wait)
+                future.queue_wait_s = wait
+                future.started_at = time.monotonic()
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+            finally:
+                release()
+
+        try:
+            lane.executor.submit(run)
+        except Exception:
+            release()
+            raise
+        return future
+
+    def stats(self):
+        return {name: lane.snapshot() for name, lane in self._lanes.items()}
+
+
+def _env_number(name, default, cast=int):
+    value = os.environ.get(name)
+    try:
+        return cast(value) if value not in (None, "") else default
+    except ValueError:
+        print(f"Warning: invalid value for {name}: {value!r}; using {default}.")
+        return default
+
+
+def build_scheduler_from_env(defaults):
+    """
+    defaults: {provider: {"concurrency", "rate", "burst", "max_queued"}}. Each value can be
+    overridden with LLM_<PROVIDER>_CONCURRENCY / _RATE / _BURST / _MAX_QUEUED.
+    """
+    limits = {}
+    for provider, cfg in defaults.items():
+        env_prefix = f"LLM_{provider.upper()}_"
+        limits[provider] = {
+            "concurrency": _env_number(f"{env_prefix}CONCURRENCY", cfg["concurrency"]),
+            "rate": _env_number(f"{env_prefix}RATE", cfg["rate"], float),
+            "burst": _env_number(f"{env_prefix}BURST", cfg.get("burst", cfg["concurrency"])),
+            "max_queued": _env_number(f"{env_prefix}MAX_QUEUED", cfg.get("max_queued", 64)),
+        }
+    print(f"LLM scheduler limits: {limits}")
+    return LLMScheduler(limits)
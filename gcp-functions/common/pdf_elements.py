@@ -0,0 +1,117 @@
+"""
+Local element pass for born-digital PDF pages, used by both image parsers.
+
+Visual elements are located from the positions of embedded images and clusters of
+vector drawings, without any network call. The boxes come back in the same shape as
+the Gemini element response, so callers crop them the same way and only ask Gemini
+when this pass finds nothing usable. Both parsers import this one copy, so the
+thresholds below are tuned in one place.
+
+Configuration:
+  LOCAL_ELEMENT_PASS  1 (default) | 0
+"""
+import os
+
+LOCAL_ELEMENT_PASS = os.environ.get("LOCAL_ELEMENT_PASS", "1").strip().lower() not in ("0", "false", "no", "off")
+LOCAL_ELEMENT_MIN_AREA = 0.015  # fraction of the page
+LOCAL_ELEMENT_MAX_AREA = 0.8    # larger images are scanned page backgrounds
+LOCAL_ELEMENT_MIN_SIDE = 40     # points
+LOCAL_DRAWING_MIN_PATHS = 8
+LOCAL_DRAWING_MERGE_TOLERANCE = 12  # points
+
+
+def _clamp_box(box, page_rect):
+    """Clamps an (x0, y0, x1, y1) box to the page. Zero-width/height boxes (lines) are kept."""
+    x0, y0, x1, y1 = box
+    return (
+        min(max(x0, page_rect.x0), page_rect.x1),
+        min(max(y0, page_rect.y0), page_rect.y1),
+        min(max(x1, page_rect.x0), page_rect.x1),
+        min(max(y1, page_rect.y0), page_rect.y1),
+    )
+
+
+def _merge_boxes(boxes, tolerance=0):
+    """
+    Repeatedly unions (x0, y0, x1, y1) boxes that are at most `tolerance` points apart.
+    Returns [box, member_count] pairs. Plain tuples are used on purpose: PyMuPDF treats
+    zero-height rectangles (rules, axes) as empty and drops them from unions.
+    """
+    clusters = [[tuple(box), 1] for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for box, count in clusters:
+            for entry in result:
+                other = entry[0]
+                if (box[0] - other[2] <= tolerance and other[0] - box[2] <= tolerance
+                        and box[1] - other[3] <= tolerance and other[1] - box[3] <= tolerance):
+                    entry[0] = (min(box[0], other[0]), min(box[1], other[1]),
+                                max(box[2], other[2]), max(box[3], other[3]))
+                    entry[1] += count
+                    merged = True
+                    break
+            else:
+                result.append([box, count])
+        clusters = result
+    return clusters
+
+
+def _is_usable_element_box(box, page_area):
+    width, height = box[2] - box[0], box[3] - box[1]
+    coverage = (width * height) / page_area
+    return (LOCAL_ELEMENT_MIN_AREA <= coverage <= LOCAL_ELEMENT_MAX_AREA
+            and min(width, height) >= LOCAL_ELEMENT_MIN_SIDE)
+
+
+def find_local_elements(page):
+    """
+    Locates visual elements on a born-digital PDF page without any network call, using the
+    positions of embedded images and clusters of vector drawings. Returns a list in the same
+    shape as the Gemini element response ({"box_2d": [y_min, x_min, y_max, x_max] on a 0-1000
+    grid, "label": ...}), or [] when nothing usable is found.
+
+    Images covering most of the page are treated as a scanned background and ignored, as are
+    small logos, rules, underlines and sparse drawings.
+    """
+    page_rect = page.rect
+    page_area = (page_rect.width * page_rect.height) or 1
+
+    image_boxes = []
+    for info in page.get_image_info():
+        box = _clamp_box(info["bbox"], page_rect)
+        if _is_usable_element_box(box, page_area):
+            image_boxes.append(box)
+
+    drawing_boxes = []
+    drawing_items = [_clamp_box(tuple(drawing["rect"]), page_rect) for drawing in page.get_drawings()]
+    for box, path_count in _merge_boxes(drawing_items, tolerance=LOCAL_DRAWING_MERGE_TOLERANCE):
+        if path_count >= LOCAL_DRAWING_MIN_PATHS and _is_usable_element_box(box, page_area):
+            drawing_boxes.append(box)
+
+    if not image_boxes and not drawing_boxes:
+        return []
+
+    # An image inside a drawn frame (or a chart built from both) becomes one element.
+    merged = _merge_boxes(image_boxes + drawing_boxes)
+    merged.sort(key=lambda entry: (entry[0][2] - entry[0][0]) * (entry[0][3] - entry[0][1]), reverse=True)
+
+    elements = []
+    for box, _ in merged[:5]:
+        contains_image = any(
+            box[0] <= img[0] and box[1] <= img[1] and img[2] <= box[2] and img[3] <= box[3]
+            for img in image_boxes
+        )
+        elements.append({
+            "box_2d": [
+                round((box[1] - page_rect.y0) / page_rect.height * 1000),
+                round((box[0] - page_rect.x0) / page_rect.width * 1000),
+                round((box[3] - page_rect.y0) / page_rect.height * 1000),
+                round((box[2] - page_rect.x0) / page_rect.width * 1000),
+            ],
+            "label": "image" if contains_image else "drawing",
+        })
+    # Reading order (top to bottom, then left to right) keeps filenames stable.
+    elements.sort(key=lambda element: (element["box_2d"][0], element["box_2d"][1]))
+    return elements
@@ -0,0 +1,394 @@
+"""
+Lightweight tracing for the Cloud Functions: spans, header propagation and export.
+
+A span measures one step (PDF rendering, resizing, encoding, an LLM call, building a
+ZIP, the call to another function) and records its name, timing, attributes and
+error. Spans nest through a context variable; work handed to thread pools keeps its
+parent with bind().
+
+  - Propagation: outgoing calls send W3C `traceparent` and `X-Correlation-ID` headers
+    (headers()); traced_request() continues an incoming trace, or starts one, and
+    echoes the correlation id on the response. The correlation id defaults to the
+    trace id, so one id finds a request across every function it touched.
+  - Export: spans are batched by a background thread. With an OTLP endpoint they are
+    POSTed as OTLP/HTTP JSON to <endpoint>/v1/traces. Without one, or when a POST
+    fails, they go to the TRACE_FALLBACK_EXPORT:
+      log    one structured JSON log line per span on stdout, which Cloud Logging
+             parses (the default on Cloud Functions, where K_SERVICE is set: /tmp is
+             memory-backed there, so a trace file would count against instance memory),
+      jsonl  appended as JSON lines to TRACE_JSONL_PATH for offline inspection, rotated
+             to <path>.1 beyond TRACE_JSONL_MAX_BYTES (the default when run locally),
+      none   dropped.
+  - A full export queue drops spans instead of blocking requests.
+The image_parsing package gets its own copy of this module (see deploy.py); hosts
+running it in-process pass their trace on with `continue_from(tracing.headers())`.
+
+Configuration:
+  TRACING                              1 (default) | 0
+  OTEL_EXPORTER_OTLP_TRACES_ENDPOINT   full traces URL, or
+  OTEL_EXPORTER_OTLP_ENDPOINT          base URL (/v1/traces is appended)
+  OTEL_EXPORTER_OTLP_HEADERS           k1=v1,k2=v2 sent with every export
+  OTEL_SERVICE_NAME                    defaults to K_SERVICE, then the traced entry point
+  TRACE_FALLBACK_EXPORT                log (default on Cloud Functions) | jsonl (default locally) | none
+  TRACE_JSONL_PATH                     default /tmp/traces.jsonl
+  TRACE_JSONL_MAX_BYTES                default 20 MB
+"""
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
+
+TRACING_ENABLED = os.environ.get("TRACING", "1").strip().lower() not in ("0", "false", "no", "off")
+OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT") or (
+    os.environ["OTEL_EXPORTER_OTLP_ENDPOINT"].rstrip("/") + "/v1/traces"
+    if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT") else None
+)
+OTLP_HEADERS = dict(
+    item.split("=", 1) for item in os.environ.get("OTEL_EXPORTER_OTLP_HEADERS", "").split(",") if "=" in item
+)
+_DEFAULT_FALLBACK_EXPORT = "log" if os.environ.get("K_SERVICE") else "jsonl"
+FALLBACK_EXPORT = os.environ.get("TRACE_FALLBACK_EXPORT", _DEFAULT_FALLBACK_EXPORT).strip().lower()
+if FALLBACK_EXPORT not in ("log", "jsonl", "none"):
+    print(f"Warning: Unknown TRACE_FALLBACK_EXPORT '{FALLBACK_EXPORT}'. Using {_DEFAULT_FALLBACK_EXPORT}.")
+    FALLBACK_EXPORT = _DEFAULT_FALLBACK_EXPORT
+JSONL_PATH = os.environ.get("TRACE_JSONL_PATH", "/tmp/traces.jsonl")
+JSONL_MAX_BYTES = int(os.environ.get("TRACE_JSONL_MAX_BYTES", str(20 * 1024 * 1024)))
+EXPORT_BATCH_SIZE = 256
+EXPORT_INTERVAL_S = 2.0
+EXPORT_QUEUE_SIZE = 10000
+OTLP_TIMEOUT_S = 5
+
+CORRELATION_HEADER = "X-Correlation-ID"
+_TRACEPARENT_RE = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+_service_name = os.environ.get("OTEL_SERVICE_NAME") or os.environ.get("K_SERVICE")
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class _RemoteParent:
+    """A parent span in another function (or another copy of this module)."""
+
+    def __init__(self, trace_id, span_id, correlation_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.correlation_id = correlation_id or trace_id
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.correlation_id = parent.correlation_id if parent else self.trace_id
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        """Ends the span once (later calls are ignored) and queues it for export."""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        _EXPORTER.export(self)
+
+    def record(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "correlation_id": self.correlation_id,
+            "service": _service_name,
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    trace_id = span_id = parent_span_id = correlation_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+# --- Spans ---
+
+def current():
+    """The active span (or remote parent) of this context, or None."""
+    return _current.get()
+
+
+def start_span(name, parent=None, **attributes):
+    """
+    A span that is not made current, for work that outlives a `with` block (e.g. a
+    streamed response). The caller must end() it. Defaults to the current parent.
+    """
+    if not TRACING_ENABLED:
+        return _NOOP_SPAN
+    return Span(name, parent if parent is not None else _current.get(), attributes)
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """Runs the block as a child span of `parent` (default: the current span)."""
+    if not TRACING_ENABLED:
+        yield _NOOP_SPAN
+        return
+    active = Span(name, parent if parent is not None else _current.get(), attributes)
+    token = _current.set(active)
+    try:
+        yield active
+    except BaseException as e:
+        active.end(error=e)
+        raise
+    finally:
+        _current.reset(token)
+        active.end()
+
+
+def bind(fn, parent=None):
+    """
+    `fn` running under `parent` (default: the current span) in whatever thread calls
+    it, with the other context variables of the caller of bind() (e.g. the usage ledger).
+    """
+    parent = parent if parent is not None else _current.get()
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        _current.set(parent)
+        return fn(*args, **kwargs)
+
+    @functools.wraps(fn)
+    def bound(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so each call gets a copy.
+        return context.copy().run(run, *args, **kwargs)
+    return bound
+
+
+# --- Propagation ---
+
+def headers():
+    """Headers that continue the current trace in another function."""
+    active = _current.get()
+    if active is None or active.trace_id is None:
+        return {}
+    if active.span_id is None:
+        return {CORRELATION_HEADER: active.correlation_id}
+    return {
+        "traceparent": f"00-{active.trace_id}-{active.span_id}-01",
+        CORRELATION_HEADER: active.correlation_id,
+    }
+
+
+def _parent_from_headers(incoming):
+    match = _TRACEPARENT_RE.match((incoming.get("traceparent") or "").strip().lower())
+    correlation_id = (incoming.get(CORRELATION_HEADER) or "").strip()[:128] or None
+    if match:
+        return _RemoteParent(match.group(1), match.group(2), correlation_id)
+    if correlation_id:
+        return _RemoteParent(os.urandom(16).hex(), None, correlation_id)
+    return None
+
+
+@contextlib.contextmanager
+def continue_from(incoming):
+    """Makes the trace in `incoming` headers (see headers()) the parent of spans in the block."""
+    token = _current.set(_parent_from_headers(incoming or {}))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def traced_request(name):
+    """
+    Decorator for an HTTP entry point: continues the caller's trace from the request
+    headers in a span named `name` and sets X-Correlation-ID on the response. Streamed
+    bodies are still being produced after this span ends.
+    """
+    global _service_name
+    _service_name = _service_name or name
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(request, *args, **kwargs):
+            from flask import make_response
+
+            with continue_from(request.headers), \
+                    span(name, **{"http.method": request.method, "http.target": request.path}) as active:
+                response = make_response(handler(request, *args, **kwargs))
+                active.set(**{"http.status_code": response.status_code})
+                if active.correlation_id:
+                    response.headers[CORRELATION_HEADER] = active.correlation_id
+                    exposed = ", ".join(response.headers.getlist("Access-Control-Expose-Headers"))
+                    response.headers["Access-Control-Expose-Headers"] = (
+                        f"{exposed}, {CORRELATION_HEADER}" if exposed else CORRELATION_HEADER
+                    )
+                return response
+        return wrapper
+    return decorator
+
+
+# --- Export ---
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": value if isinstance(value, str) else json.dumps(value, default=str)}
+
+
+def _otlp_span(record):
+    attributes = dict(record["attributes"], **{"correlation.id": record["correlation_id"]})
+    otlp = {
+        "traceId": record["trace_id"],
+        "spanId": record["span_id"],
+        "name": record["name"],
+        "kind": 1,
+        "startTimeUnixNano": str(record["start_time_unix_nano"]),
+        "endTimeUnixNano": str(record["end_time_unix_nano"]),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None],
+        "status": {"code": 2, "message": record["error"]} if record["error"] else {"code": 1},
+    }
+    if record["parent_span_id"]:
+        otlp["parentSpanId"] = record["parent_span_id"]
+    return otlp
+
+
+def otlp_payload(records):
+    """OTLP/HTTP JSON body (ExportTraceServiceRequest) for span records."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": _service_name or "unknown_service"}},
+        ]},
+        "scopeSpans": [{"scope": {"name": "gcf-tracing"}, "spans": [_otlp_span(r) for r in records]}],
+    }]}
+
+
+class _Exporter:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._worker = None
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self.stats = {"exported_otlp": 0, "exported_jsonl": 0, "exported_log": 0, "dropped": 0, "otlp_errors": 0}
+
+    def export(self, finished_span):
+        try:
+            self._queue.put_nowait(finished_span)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + EXPORT_INTERVAL_S
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._send([s.record() for s in batch])
+            except Exception as e:
+                print(f"Warning: could not export {len(batch)} trace span(s): {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send(self, records):
+        if OTLP_ENDPOINT:
+            try:
+                body = json.dumps(otlp_payload(records), default=str).encode("utf-8")
+                post = urllib.request.Request(
+                    OTLP_ENDPOINT, data=body, method="POST",
+                    headers={"Content-Type": "application/json", **OTLP_HEADERS},
+                )
+                with urllib.request.urlopen(post, timeout=OTLP_TIMEOUT_S):
+                    pass
+                self.stats["exported_otlp"] += len(records)
+                return
+            except Exception as e:
+                print(f"Warning: OTLP trace export failed ({e}); sending {len(records)} span(s) to "
+                      f"the {FALLBACK_EXPORT} fallback.")
+                self.stats["otlp_errors"] += 1
+        if FALLBACK_EXPORT == "log":
+            self._write_log(records)
+        elif FALLBACK_EXPORT == "jsonl":
+            self._write_jsonl(records)
+        else:
+            self.stats["dropped"] += len(records)
+
+    def _write_log(self, records):
+        lines = "".join(
+            json.dumps({
+                "severity": "ERROR" if r["status"] == "error" else "DEBUG",
+                "message": f"span {r['name']} {r['duration_ms']} ms",
+                "span": r,
+            }, default=str) + "\n"
+            for r in records
+        )
+        print(lines, end="", flush=True)
+        self.stats["exported_log"] += len(records)
+
+    def _write_jsonl(self, records):
+        lines = "".join(json.dumps(r, default=str) + "\n" for r in records)
+        with self._file_lock:
+            try:
+                if os.path.getsize(JSONL_PATH) > JSONL_MAX_BYTES:
+                    os.replace(JSONL_PATH, f"{JSONL_PATH}.1")
+            except OSError:
+                pass
+            with open(JSONL_PATH, "a", encoding="utf-8") as f:
+                f.write(lines)
+        self.stats["exported_jsonl"] += len(records)
+
+    def flush(self, timeout=None):
+        """Waits until queued spans have been exported; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+_EXPORTER = _Exporter()
+# Spans of the last requests before an instance shuts down would otherwise be lost.
+atexit.register(_EXPORTER.flush, EXPORT_INTERVAL_S + OTLP_TIMEOUT_S)
+
+
+def flush(timeout=None):
+    return _EXPORTER.flush(timeout)
@@ -0,0 +1,431 @@
+"""
+Token, image, latency and cost accounting for LLM calls.
+
+Every Gemini and Qwen call runs inside call(), which times it and reads the token
+counts the provider reports (Gemini `usage_metadata`, OpenAI-compatible `usage`).
+Calls are collected in a Ledger per request, or per background job / streamed body.
+
+  - Per call: input, output, thinking and cached tokens, images sent, latency and
+    the estimated cost. Failed calls count with their latency and whatever tokens
+    were reported.
+  - summary() aggregates the calls per step (the call's task) and model, most
+    expensive first, plus totals. Functions return it as an X-Usage-Summary header,
+    or as a "usage" entry in their manifest / summary record when the response is
+    streamed. latency_s is the summed call time, so concurrent calls add up.
+  - Usage of another function this one called over HTTP (the image parser) is
+    merged from that function's summary, so a client sees the whole pipeline. Each
+    function logs and totals only the calls it made itself (including the image
+    parser when it runs in-process), so summing the logs never double counts.
+  - When a ledger finishes, its summary is logged as one "LLM usage:" JSON line
+    labelled with the function, exam and teacher, together with this instance's
+    running totals for that exam and teacher (totals()).
+  - Exam and teacher come from X-Exam-ID / X-Teacher-ID headers, exam_id /
+    teacher_id query or form fields, or label() for JSON bodies.
+
+Costs use the USD per 1M token list prices in PRICES (prompts up to 200k tokens);
+thinking tokens are billed as output and cached tokens at the cached rate. A model
+is priced by its longest matching prefix; unknown models have no cost. The
+image_parsing package gets its own copy of this module (see deploy.py), separate from
+the one of a function hosting it in-process.
+
+Configuration:
+  USAGE_ACCOUNTING    1 (default) | 0
+  USAGE_PRICES_JSON   {"<model>": {"input": .., "output": .., "cached": ..}} added to PRICES
+  USAGE_MAX_TRACKED   exams and teachers kept in the running totals (default 1000)
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+USAGE_ENABLED = os.environ.get("USAGE_ACCOUNTING", "1").strip().lower() not in ("0", "false", "no", "off")
+MAX_TRACKED = int(os.environ.get("USAGE_MAX_TRACKED", "1000"))
+
+SUMMARY_HEADER = "X-Usage-Summary"
+LABEL_HEADERS = {"exam_id": "X-Exam-ID", "teacher_id": "X-Teacher-ID"}
+
+# USD per 1M tokens; keep current with USAGE_PRICES_JSON.
+PRICES = {
+    "gemini-2.5-pro": {"input": 1.25, "output": 10.0, "cached": 0.31},
+    "gemini-2.5-flash": {"input": 0.30, "output": 2.50, "cached": 0.075},
+    "qwen3-vl-235b-a22b-instruct": {"input": 0.70, "output": 2.80},
+    "qwen3-vl-32b-instruct": {"input": 0.16, "output": 0.64},
+}
+try:
+    PRICES.update(json.loads(os.environ.get("USAGE_PRICES_JSON") or "{}"))
+except (ValueError, TypeError) as e:
+    print(f"Warning: could not parse USAGE_PRICES_JSON ({e}); using the built-in prices.")
+
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "thinking_tokens", "cached_tokens")
+_COUNT_FIELDS = ("calls", "errors", "images") + TOKEN_FIELDS
+
+_current = contextvars.ContextVar("usage_ledger", default=None)
+
+
+def price_for(model):
+    """The PRICES entry for `model` (exact, else longest prefix), or None."""
+    if model in PRICES:
+        return PRICES[model]
+    matches = [name for name in PRICES if model and model.startswith(name)]
+    return PRICES[max(matches, key=len)] if matches else None
+
+
+def cost_usd(model, input_tokens=0, output_tokens=0, thinking_tokens=0, cached_tokens=0):
+    price = price_for(model)
+    if price is None:
+        return None
+    uncached = max(0, input_tokens - cached_tokens)
+    return (
+        uncached * price["input"]
+        + cached_tokens * price.get("cached", price["input"])
+        + (output_tokens + thinking_tokens) * price["output"]
+    ) / 1e6
+
+
+def tokens_from(response):
+    """
+    Token counts reported with a Gemini response or an OpenAI-compatible completion
+    (or the final chunk of a stream), or None if it carries none. Output tokens
+    exclude thinking tokens for both providers.
+    """
+    meta = getattr(response, "usage_metadata", None)
+    if meta is not None:
+        return {
+            "input_tokens": meta.prompt_token_count or 0,
+            "output_tokens": meta.candidates_token_count or 0,
+            "thinking_tokens": getattr(meta, "thoughts_token_count", None) or 0,
+            "cached_tokens": getattr(meta, "cached_content_token_count", None) or 0,
+        }
+    reported = getattr(response, "usage", None)
+    if reported is not None and getattr(reported, "prompt_tokens", None) is not None:
+        thinking = getattr(getattr(reported, "completion_tokens_details", None), "reasoning_tokens", None) or 0
+        return {
+            "input_tokens": reported.prompt_tokens or 0,
+            "output_tokens": max(0, (reported.completion_tokens or 0) - thinking),
+            "thinking_tokens": thinking,
+            "cached_tokens": getattr(getattr(reported, "prompt_tokens_details", None), "cached_tokens", None) or 0,
+        }
+    return None
+
+
+# --- Aggregation ---
+
+def _new_aggregate(step, model):
+    aggregate = {"step": step, "model": model}
+    aggregate.update({field: 0 for field in _COUNT_FIELDS})
+    aggregate.update({"latency_s": 0.0, "max_latency_s": 0.0, "cost_usd": 0.0 if price_for(model) else None})
+    return aggregate
+
+
+def _accumulate(aggregate, entry):
+    """Adds one call (from call()) or one step of a summary() to `aggregate`."""
+    for field in _COUNT_FIELDS:
+        aggregate[field] += entry.get(field, 0) or 0
+    aggregate["latency_s"] += entry.get("latency_s", 0.0)
+    aggregate["max_latency_s"] = max(aggregate["max_latency_s"], entry.get("max_latency_s", entry.get("latency_s", 0.0)))
+    if aggregate["cost_usd"] is not None:
+        cost = entry.get("cost_usd")
+        if cost is None and "cost_usd" not in entry:
+            cost = cost_usd(aggregate["model"], **{field: entry.get(field, 0) for field in TOKEN_FIELDS})
+        aggregate["cost_usd"] += cost or 0.0
+
+
+def _rounded(aggregate):
+    rounded = dict(aggregate)
+    for field in ("latency_s", "max_latency_s"):
+        if field in rounded:
+            rounded[field] = round(rounded[field], 3)
+    if rounded.get("cost_usd") is not None:
+        rounded["cost_usd"] = round(rounded["cost_usd"], 6)
+    return rounded
+
+
+def _totals(steps):
+    totals = {field: 0 for field in _COUNT_FIELDS}
+    totals.update({"latency_s": 0.0, "cost_usd": 0.0, "unpriced_calls": 0})
+    for step in steps:
+        for field in _COUNT_FIELDS:
+            totals[field] += step[field]
+        totals["latency_s"] += step["latency_s"]
+        if step["cost_usd"] is None:
+            totals["unpriced_calls"] += step["calls"]
+        else:
+            totals["cost_usd"] += step["cost_usd"]
+    return totals
+
+
+class Ledger:
+    """
+    The LLM calls of one request (or job). Calls are kept aggregated per (step, model),
+    so a ledger stays small however many calls it sees.
+    """
+
+    def __init__(self, function=None, exam_id=None, teacher_id=None):
+        self.labels = {"function": function, "exam_id": exam_id, "teacher_id": teacher_id}
+        self.detached = False
+        self._own = {}
+        self._imported = {}
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def label(self, **labels):
+        """Sets labels (exam_id, teacher_id) that are not set yet; empty values are ignored."""
+        with self._lock:
+            for key, value in labels.items():
+                if value and not self.labels.get(key):
+                    self.labels[key] = str(value).strip()[:128]
+
+    def add(self, entry):
+        with self._lock:
+            key = (entry["step"], entry["model"])
+            if key not in self._own:
+                self._own[key] = _new_aggregate(*key)
+            _accumulate(self._own[key], entry)
+
+    def merge(self, summary, source, own=False):
+        """
+        Adds the steps of another ledger's summary() (e.g. from the image parser's
+        manifest) as "<source>/<step>". `own` counts them as this function's calls, for
+        a parser that ran in-process; otherwise they are only reported, not logged.
+        """
+        target = self._own if own else self._imported
+        with self._lock:
+            for step in (summary or {}).get("steps") or []:
+                key = (f"{source}/{step.get('step')}", step.get("model"))
+                if key not in target:
+                    target[key] = _new_aggregate(*key)
+                _accumulate(target[key], step)
+
+    @property
+    def empty(self):
+        return not self._own and not self._imported
+
+    def summary(self, include_imported=True):
+        with self._lock:
+            merged = {key: dict(aggregate) for key, aggregate in self._own.items()}
+            for key, aggregate in (self._imported.items() if include_imported else ()):
+                if key in merged:
+                    _accumulate(merged[key], aggregate)
+                else:
+                    merged[key] = dict(aggregate)
+            labels = dict(self.labels)
+        steps = sorted(merged.values(), key=lambda s: (s["cost_usd"] or 0.0, s["latency_s"]), reverse=True)
+        return {**labels, "totals": _rounded(_totals(steps)), "steps": [_rounded(step) for step in steps]}
+
+    def finish(self):
+        """Logs this ledger's own calls and adds them to the running totals, once."""
+        with self._lock:
+            if self._finished or not self._own:
+                self._finished = True
+                return
+            self._finished = True
+        summary = self.summary(include_imported=False)
+        TOTALS.add(summary)
+        print(f"LLM usage: {json.dumps({**summary, 'running_totals': TOTALS.get(summary)})}")
+
+
+class RunningTotals:
+    """Per-instance totals of finished ledgers per exam and per teacher (LRU-bounded)."""
+
+    def __init__(self, max_tracked=MAX_TRACKED):
+        self.max_tracked = max_tracked
+        self._entries = OrderedDict()  # ("exam_id" | "teacher_id", id) -> totals
+        self._lock = threading.Lock()
+
+    def add(self, summary):
+        with self._lock:
+            for key in self._keys(summary):
+                entry = self._entries.pop(key, None) or {"requests": 0, **{f: 0 for f in _COUNT_FIELDS},
+                                                         "latency_s": 0.0, "cost_usd": 0.0}
+                entry["requests"] += 1
+                for field in _COUNT_FIELDS + ("latency_s", "cost_usd"):
+                    entry[field] += summary["totals"][field]
+                self._entries[key] = entry
+            while len(self._entries) > self.max_tracked:
+                self._entries.popitem(last=False)
+
+    def get(self, summary):
+        with self._lock:
+            return {key[0]: _rounded(self._entries[key]) for key in self._keys(summary) if key in self._entries}
+
+    def snapshot(self):
+        with self._lock:
+            return {f"{kind}:{value}": _rounded(entry) for (kind, value), entry in self._entries.items()}
+
+    @staticmethod
+    def _keys(summary):
+        return [(kind, summary[kind]) for kind in ("exam_id", "teacher_id") if summary.get(kind)]
+
+
+TOTALS = RunningTotals()
+
+
+def totals():
+    return TOTALS.snapshot()
+
+
+# --- Recording ---
+
+def current():
+    """The ledger calls are recorded in, or None."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def recording(ledger):
+    """Records calls in the block (and in work bound to it) in `ledger`."""
+    token = _current.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _current.reset(token)
+
+
+class _Call:
+    def __init__(self, provider, model, step, images):
+        self.entry = {"provider": provider, "model": model, "step": step, "images": images, "calls": 1}
+
+    def record(self, response):
+        """Takes the token counts from `response` if it reports any (see tokens_from())."""
+        tokens = tokens_from(response)
+        if tokens:
+            self.entry.update(tokens)
+
+
+@contextlib.contextmanager
+def call(provider, model, step, images=0):
+    """
+    Meters the LLM call in the block; pass its response to record(). The call is
+    added to the current ledger when the block exits, also when it raises.
+    """
+    metered = _Call(provider, model, step, images)
+    started = time.monotonic()
+    try:
+        yield metered
+    except BaseException:
+        metered.entry["errors"] = 1
+        raise
+    finally:
+        metered.entry["latency_s"] = time.monotonic() - started
+        ledger = _current.get()
+        if ledger is not None and USAGE_ENABLED:
+            ledger.add(metered.entry)
+
+
+def label(**labels):
+    """Labels the current ledger, e.g. with the exam_id of a JSON request body."""
+    ledger = _current.get()
+    if ledger is not None:
+        ledger.label(**labels)
+
+
+def merge(summary, source, own=False):
+    """Merges another ledger's summary() into the current ledger (see Ledger.merge)."""
+    ledger = _current.get()
+    if ledger is not None and USAGE_ENABLED:
+        ledger.merge(summary, source, own=own)
+
+
+def summary():
+    """The current ledger's summary(), or None when it has no calls."""
+    ledger = _current.get()
+    return None if ledger is None or ledger.empty else ledger.summary()
+
+
+def summary_header():
+    """The X-Usage-Summary value for the current ledger, or None when it has no calls."""
+    current_summary = summary()
+    return json.dumps(current_summary, separators=(",", ":")) if current_summary else None
+
+
+def response_headers(headers=None):
+    """`headers` (a dict) plus X-Usage-Summary, exposed to browsers, when there were calls."""
+    headers = dict(headers or {})
+    value = summary_header()
+    if value:
+        headers[SUMMARY_HEADER] = value
+        exposed = headers.get("Access-Control-Expose-Headers")
+        headers["Access-Control-Expose-Headers"] = f"{exposed}, {SUMMARY_HEADER}" if exposed else SUMMARY_HEADER
+    return headers
+
+
+def headers():
+    """Label headers that attribute another function's calls to the same exam and teacher."""
+    ledger = _current.get()
+    if ledger is None:
+        return {}
+    return {header: ledger.labels[key] for key, header in LABEL_HEADERS.items() if ledger.labels.get(key)}
+
+
+# --- Requests, jobs and streams ---
+
+def detach():
+    """
+    For work that outlives the request (a streamed body): the request no longer
+    finishes the current ledger, the caller must finish() the returned ledger.
+    """
+    ledger = _current.get()
+    if ledger is not None:
+        ledger.detached = True
+    return ledger
+
+
+def detached(fn):
+    """`fn` for a background job: it records in the current ledger and finishes it on return."""
+    ledger = detach()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        token = _current.set(ledger)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+            if ledger is not None:
+                ledger.finish()
+    return run
+
+
+def _labels_from(request):
+    labels = {}
+    for key, header in LABEL_HEADERS.items():
+        value = request.headers.get(header) or request.args.get(key) or request.form.get(key)
+        labels[key] = (value or "").strip()[:128] or None
+    return labels
+
+
+def _expose(response_headers, name):
+    exposed = ", ".join(response_headers.getlist("Access-Control-Expose-Headers"))
+    if name not in exposed:
+        response_headers["Access-Control-Expose-Headers"] = f"{exposed}, {name}" if exposed else name
+
+
+def metered_request(name):
+    """
+    Decorator for an HTTP entry point: records the request's LLM calls in a Ledger
+    labelled `name`, sets X-Usage-Summary on the response when there were any (unless
+    the handler already did) and finishes the ledger unless it was detached.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(request, *args, **kwargs):
+            from flask import make_response
+
+            ledger = Ledger(name, **_labels_from(request))
+            with recording(ledger):
+                try:
+                    response = make_response(handler(request, *args, **kwargs))
+                finally:
+                    if not ledger.detached:
+                        ledger.finish()
+                if not ledger.detached and not ledger.empty and SUMMARY_HEADER not in response.headers:
+                    response.headers[SUMMARY_HEADER] = summary_header()
+                if SUMMARY_HEADER in response.headers:
+                    _expose(response.headers, SUMMARY_HEADER)
+                return response
+        return wrapper
+    return decorator
@@ -0,0 +1,183 @@
+"""
+Assembles and deploys the Cloud Functions in this directory.
+
+Modules used by several functions (LLM clients, tracing, usage accounting, the job API,
+checkpoints, image encoding, the LLM scheduler, the local PDF element pass) live once in
+common/. A function directory only holds its own code; the shared modules it imports
+(SHARED below) are copied next to its main.py, or into the image_parsing package for
+image-parser. The copies are gitignored and start with a "Generated by deploy.py" line,
+so edit the common/ original instead.
+
+    python deploy.py sync                       copy the shared modules into every function
+                                                directory, for running functions locally
+    python deploy.py check                      exit 1 if a copy is missing or differs
+                                                from common/ (run before deploying from a
+                                                working tree, e.g. in CI)
+    python deploy.py build FUNCTION OUT_DIR [--with-image-parser]
+                                                assemble FUNCTION's deployable source
+    python deploy.py deploy FUNCTION [--name NAME] [--with-image-parser] [-- GCLOUD_ARGS...]
+                                                build into a temporary directory, then run
+                                                `gcloud functions deploy NAME --source <dir>
+                                                GCLOUD_ARGS...` (NAME defaults to FUNCTION)
+
+build and deploy work from common/ directly and never read the local copies, and
+leave a function's tests/ directory out of the deployed source.
+--with-image-parser vendors the image_parsing package and the image parser's
+requirements into a pipeline function, for IMAGE_PARSER_MODE=inprocess (see
+common/inprocess_parser.py).
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+COMMON_DIR = os.path.join(ROOT, "common")
+
+_PIPELINE = ("checkpoints", "inprocess_parser", "job_queue", "llm_clients", "tracing", "usage")
+_LLM_ONLY = ("llm_clients", "tracing", "usage")
+_PARSER = ("image_encoding", "llm_clients", "llm_scheduler", "pdf_elements", "tracing", "usage")
+
+# Function directory -> shared modules it imports.
+SHARED = {
+    "add-appendix": _PIPELINE,
+    "add-model": _PIPELINE,
+    "add-student-answers": _PIPELINE,
+    "exam-structurer": _PIPELINE,
+    "bulk-submission-boundaries": _LLM_ONLY,
+    "generate-points": _LLM_ONLY,
+    "image-parser": _PARSER,
+    "student-image-parser": _PARSER,
+}
+
+# Functions whose shared modules go into a package instead of next to main.py.
+PACKAGE_DIRS = {
+    "image-parser": "image_parsing",
+}
+
+# Functions that can run the image parser in-process (--with-image-parser).
+IMAGE_PARSER_HOSTS = ("add-appendix", "add-model", "add-student-answers", "exam-structurer")
+
+
+def _generated_source(module):
+    with open(os.path.join(COMMON_DIR, f"{module}.py"), encoding="utf-8") as f:
+        source = f.read()
+    return f"# Generated by gcp-functions/deploy.py from common/{module}.py; edit that file instead.\n{source}"
+
+
+def _module_dir(function, base):
+    return os.path.join(base, PACKAGE_DIRS[function]) if function in PACKAGE_DIRS else base
+
+
+def write_shared(function, base):
+    """Writes FUNCTION's shared modules into `base`, a copy of the function directory."""
+    target = _module_dir(function, base)
+    for module in SHARED[function]:
+        with open(os.path.join(target, f"{module}.py"), "w", encoding="utf-8") as f:
+            f.write(_generated_source(module))
+
+
+def stale_copies():
+    """Paths (relative to this directory) of shared-module copies that are missing or out of date."""
+    stale = []
+    for function in SHARED:
+        target = _module_dir(function, os.path.join(ROOT, function))
+        for module in SHARED[function]:
+            path = os.path.join(target, f"{module}.py")
+            try:
+                with open(path, encoding="utf-8") as f:
+                    current = f.read()
+            except FileNotFoundError:
+                current = None
+            if current != _generated_source(module):
+                stale.append(os.path.relpath(path, ROOT))
+    return stale
+
+
+def _requirement_name(line):
+    return re.split(r"[\s\[<>=!~;]", line.strip(), maxsplit=1)[0].lower().replace("_", "-")
+
+
+def vendor_image_parser(out_dir):
+    """Adds the image_parsing package (with its shared modules) and its requirements to `out_dir`."""
+    package_dir = os.path.join(out_dir, "image_parsing")
+    shutil.copytree(os.path.join(ROOT, "image-parser", "image_parsing"), package_dir,
+                    ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+    write_shared("image-parser", out_dir)  # PACKAGE_DIRS puts them into image_parsing/
+
+    requirements_path = os.path.join(out_dir, "requirements.txt")
+    with open(requirements_path, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    present = {_requirement_name(line) for line in lines if line.strip()}
+    with open(os.path.join(ROOT, "image-parser", "requirements.txt"), encoding="utf-8") as f:
+        added = [line.strip() for line in f if line.strip() and _requirement_name(line) not in present]
+    with open(requirements_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines + added) + "\n")
+    print(f"Vendored image_parsing (added requirements: {', '.join(added) or 'none'})")
+
+
+def build(function, out_dir, with_image_parser=False):
+    """Copies FUNCTION's own files and its shared modules into `out_dir`, which must not exist."""
+    if with_image_parser and function not in IMAGE_PARSER_HOSTS:
+        raise SystemExit(f"--with-image-parser only applies to {', '.join(IMAGE_PARSER_HOSTS)}.")
+    source = os.path.join(ROOT, function)
+    shutil.copytree(source, out_dir, ignore=shutil.ignore_patterns("__pycache__", "*.pyc", "tests"))
+    write_shared(function, out_dir)
+    if with_image_parser:
+        vendor_image_parser(out_dir)
+    print(f"Built {function} into {out_dir}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Assemble and deploy the Cloud Functions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("sync", help="copy shared modules into every function directory")
+    commands.add_parser("check", help="fail if a copied shared module is missing or stale")
+    build_cmd = commands.add_parser("build", help="assemble one function's deployable source")
+    build_cmd.add_argument("function", choices=sorted(SHARED))
+    build_cmd.add_argument("out_dir")
+    build_cmd.add_argument("--with-image-parser", action="store_true",
+                           help="vendor image_parsing for IMAGE_PARSER_MODE=inprocess")
+    deploy_cmd = commands.add_parser("deploy", help="build one function and deploy it with gcloud")
+    deploy_cmd.add_argument("function", choices=sorted(SHARED))
+    deploy_cmd.add_argument("--name", help="deployed function name (default: the directory name)")
+    deploy_cmd.add_argument("--with-image-parser", action="store_true",
+                            help="vendor image_parsing for IMAGE_PARSER_MODE=inprocess")
+    deploy_cmd.add_argument("gcloud_args", nargs=argparse.REMAINDER,
+                            help="passed to `gcloud functions deploy` after `--`")
+    args = parser.parse_args(argv)
+
+    if args.command == "sync":
+        for function in SHARED:
+            write_shared(function, os.path.join(ROOT, function))
+        print(f"Copied shared modules into {len(SHARED)} function directories.")
+        return 0
+
+    if args.command == "check":
+        stale = stale_copies()
+        for path in stale:
+            print(f"Out of date: {path}")
+        if stale:
+            print("Run `python deploy.py sync` to refresh the copies from common/.")
+            return 1
+        print("All shared-module copies match common/.")
+        return 0
+
+    if args.command == "build":
+        build(args.function, args.out_dir, args.with_image_parser)
+        return 0
+
+    gcloud_args = args.gcloud_args[1:] if args.gcloud_args[:1] == ["--"] else args.gcloud_args
+    with tempfile.TemporaryDirectory(prefix=f"{args.function}-") as tmp:
+        out_dir = os.path.join(tmp, args.function)
+        build(args.function, out_dir, args.with_image_parser)
+        command = ["gcloud", "functions", "deploy", args.name or args.function, "--source", out_dir, *gcloud_args]
+        print("Running: " + " ".join(command))
+        return subprocess.run(command).returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
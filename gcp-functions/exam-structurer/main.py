@@ -1,19 +1,34 @@
 import os
 import json
-import base64
 import io
 import zipfile
 import requests
 import functions_framework
 from flask import request, send_file, make_response
-from google import genai
 from google.genai import types
 
+import checkpoints
+import inprocess_parser
+import job_queue
+import llm_clients
+import tracing
+import usage
+
 # Configuration
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 IMAGE_PARSER_URL = os.environ.get("IMAGE_PARSER_URL")
+# "http" (default): call the image-parser function at IMAGE_PARSER_URL; "inprocess": run
+# the image_parsing package inside this function (see inprocess_parser.py).
+IMAGE_PARSER_MODE = os.environ.get("IMAGE_PARSER_MODE", "http").strip().lower()
+if IMAGE_PARSER_MODE == "inprocess":
+    inprocess_parser.require()  # fail the cold start rather than parse over HTTP
 GEMINI_MODEL = "gemini-2.5-pro-preview-06-05"
 
+# Background runs of the pipeline for clients that poll instead of waiting (mode=job).
+JOBS = job_queue.queue_from_env("exam-structurer")
+# Completed stages of failed runs, so a retry with the same inputs resumes (see checkpoints.py).
+CHECKPOINTS = checkpoints.store_from_env()
+
 # System prompt for Gemini (remains the same)
 SYSTEM_PROMPT = """###TASK:
 These are exam questions. Output JSON with the questions ordered in this specific way, with these specific element titles.
@@ -98,7 +113,9 @@ def call_image_parser(files):
         for file in files:
             files_data.append(('files', (file.filename, file.stream, file.content_type)))
         
-        response = requests.post(IMAGE_PARSER_URL, files=files_data, timeout=600)
+        with tracing.span("http.image_parser", url=IMAGE_PARSER_URL, files=len(files_data)) as hop:
+            response = requests.post(IMAGE_PARSER_URL, files=files_data, headers={**tracing.headers(), **usage.headers()}, timeout=600)
+            hop.set(**{"http.status_code": response.status_code, "response_bytes": len(response.content)})
         
         if response.status_code == 200:
             print("Image parser completed successfully")
@@ -112,16 +129,25 @@ def call_image_parser(files):
         return None
 
 def extract_files_from_zip(zip_content):
-    """Extract files from the zip returned by image parser."""
+    """
+    Extract files from the zip returned by image parser. Returns None when its manifest
+    reports an error (no output at all; the streamed response is still a 200).
+    """
     text_files = []
     image_files = []
+    parser_error = None
     
     try:
         with zipfile.ZipFile(io.BytesIO(zip_content), 'r') as zip_file:
             for filename in zip_file.namelist():
                 file_content = zip_file.read(filename)
                 
-                if filename.endswith('.txt'):
+                if filename == 'parser_manifest.json':
+                    manifest = json.loads(file_content)
+                    # The image parser's own LLM usage, passed on in this function's summary
+                    usage.merge(manifest.get('usage'), 'image-parser')
+                    parser_error = manifest.get('error')
+                elif filename.endswith('.txt'):
                     text_files.append({
                         'filename': filename,
                         'content': file_content.decode('utf-8')
@@ -132,29 +158,43 @@ def extract_files_from_zip(zip_content):
                         'content': file_content
                     })
         
+        if parser_error:
+            print(f"Image parser failed: {parser_error}")
+            return None
         print(f"Extracted {len(text_files)} text files and {len(image_files)} image files")
         return text_files, image_files
     except Exception as e:
         print(f"Error extracting files from zip: {e}")
         return [], []
 
+def parse_files(files):
+    """
+    Runs the image parser on the uploaded files and returns (text_files, image_files),
+    or None on failure. POSTs to IMAGE_PARSER_URL and unpacks the zip, or runs the
+    vendored image_parsing package when IMAGE_PARSER_MODE is "inprocess".
+    """
+    if IMAGE_PARSER_MODE == "inprocess":
+        return inprocess_parser.parse_files(files)
+    parser_result = call_image_parser(files)
+    if not parser_result:
+        return None
+    return extract_files_from_zip(parser_result)
+
 def create_gemini_content(text_files, image_files):
     """Create content parts for Gemini API call."""
     parts = []
     
     for text_file in text_files:
-        text_content_b64 = base64.b64encode(text_file['content'].encode('utf-8')).decode('utf-8')
         parts.append(types.Part.from_bytes(
             mime_type="text/plain",
-            data=base64.b64decode(text_content_b64)
+            data=text_file['content'].encode('utf-8')
         ))
     
     for image_file in image_files:
         parts.append(types.Part.from_text(text=image_file['filename']))
-        image_content_b64 = base64.b64encode(image_file['content']).decode('utf-8')
         parts.append(types.Part.from_bytes(
             mime_type="image/png",
-            data=base64.b64decode(image_content_b64)
+            data=image_file['content']
         ))
     
     return parts
@@ -166,7 +206,7 @@ def call_gemini_api(text_files, image_files):
         return None
     
     try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        client = llm_clients.gemini_client(GEMINI_API_KEY)
         content_parts = create_gemini_content(text_files, image_files)
         contents = [types.Content(role="user", parts=content_parts)]
         
@@ -177,29 +217,82 @@ def call_gemini_api(text_files, image_files):
         )
         
         print("Calling Gemini API...")
-        response = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=contents,
-            config=generate_content_config
-        )
+        with tracing.span("llm.gemini", task="structure", model=GEMINI_MODEL, parts=len(content_parts)), \
+                usage.call("gemini", GEMINI_MODEL, "structure", images=len(image_files)) as metered:
+            response = client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=generate_content_config
+            )
+            metered.record(response)
         
         return response.text
     except Exception as e:
         print(f"Error calling Gemini API: {e}")
         return None
 
+def run_pipeline(uploads):
+    """
+    The exam structuring pipeline on plain inputs, shared by the synchronous endpoint and
+    jobs. `uploads` is a list of (filename, bytes, content_type). Returns a
+    job_queue.PipelineResult with the ZIP (the LLM usage in X-Usage-Summary) or raises
+    job_queue.PipelineError.
+    Stages that completed in an earlier failed run with the same inputs are loaded from
+    their checkpoints.
+    """
+    checkpoint = checkpoints.Checkpoints(CHECKPOINTS, checkpoints.fingerprint(
+        "exam-structurer", uploads, GEMINI_MODEL, SYSTEM_PROMPT))
+
+    print("Step 1: Running image parser...")
+    parsed = checkpoint.stage(
+        "parser",
+        lambda: parse_files(job_queue.as_files(uploads)),
+        encode=checkpoints.encode_parsed,
+        decode=checkpoints.decode_parsed,
+        keep=lambda result: result is not None and any(result),
+    )
+    if parsed is None:
+        raise job_queue.PipelineError("Failed to process files with image parser.", 500)
+    
+    print("Step 2: Collecting parser output...")
+    text_files, image_files = parsed
+    if not text_files and not image_files:
+        raise job_queue.PipelineError("No valid files extracted from parser result.", 500)
+    
+    print("Step 3: Calling Gemini API...")
+    structured_exam = checkpoint.stage("structuring", lambda: call_gemini_api(text_files, image_files))
+    if not structured_exam:
+        raise job_queue.PipelineError("Failed to structure exam with Gemini.", 500)
+    
+    print("Step 4: Creating output zip...")
+    zip_buffer = io.BytesIO()
+    with tracing.span("zip.build") as zip_span:
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('structured_exam.json', structured_exam.encode('utf-8'))
+            for image_file in image_files:
+                zf.writestr(image_file['filename'], image_file['content'])
+        zip_span.set(bytes=zip_buffer.tell())
+    
+    checkpoint.clear()
+    print("Processing completed successfully!")
+    return job_queue.PipelineResult(zip_buffer.getvalue(), 'application/zip', 'structured_exam.zip',
+                                    headers=usage.response_headers())
+
 @functions_framework.http
+@tracing.traced_request("exam-structurer")
+@usage.metered_request("exam-structurer")
 def exam_structurer(request):
     """
     HTTP Cloud Function entry point.
     Accepts files, calls image parser, then structures exam with Gemini.
+    With mode=job the pipeline runs as a background job (see job_queue.py).
     """
     # === START OF CORS HANDLING ===
     # Set CORS headers for the preflight request
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
             'Access-Control-Allow-Headers': 'Content-Type',
             'Access-Control-Max-Age': '3600'
         }
@@ -211,45 +304,33 @@ def exam_structurer(request):
     }
     # === END OF CORS HANDLING ===
 
+    job_response = job_queue.handle_job_route(request, JOBS, headers)
+    if job_response is not None:
+        return job_response
+
     if request.method != 'POST':
         return ('Please use POST request with multipart/form-data.', 405, headers)
     
     uploaded_files = request.files.getlist('files')
     if not uploaded_files:
         return ('No files uploaded. Please upload files with the key "files".', 400, headers)
-    
-    print("Step 1: Calling image parser...")
-    parser_result = call_image_parser(uploaded_files)
-    if not parser_result:
-        return ("Failed to process files with image parser.", 500, headers)
-    
-    print("Step 2: Extracting files from parser result...")
-    text_files, image_files = extract_files_from_zip(parser_result)
-    if not text_files and not image_files:
-        return ("No valid files extracted from parser result.", 500, headers)
-    
-    print("Step 3: Calling Gemini API...")
-    structured_exam = call_gemini_api(text_files, image_files)
-    if not structured_exam:
-        return ("Failed to structure exam with Gemini.", 500, headers)
-    
-    print("Step 4: Creating output zip...")
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        zf.writestr('structured_exam.json', structured_exam.encode('utf-8'))
-        for image_file in image_files:
-            zf.writestr(image_file['filename'], image_file['content'])
-    
-    zip_buffer.seek(0)
-    
-    print("Processing completed successfully!")
+    uploads = job_queue.read_uploads(uploaded_files)
+
+    if job_queue.wants_job(request):
+        return job_queue.accepted_response(JOBS.submit(tracing.bind(usage.detached(run_pipeline)), uploads), headers)
+
+    try:
+        result = run_pipeline(uploads)
+    except job_queue.PipelineError as e:
+        return (e.message, e.status, headers)
     
     # Create a Flask response object to attach the headers
     response = make_response(send_file(
-        zip_buffer,
-        mimetype='application/zip',
+        io.BytesIO(result.data),
+        mimetype=result.mimetype,
         as_attachment=True,
-        download_name='structured_exam.zip'
+        download_name=result.filename
     ))
     response.headers.extend(headers)
+    response.headers.extend(result.headers)
     return response
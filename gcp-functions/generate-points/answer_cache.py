@@ -0,0 +1,217 @@
+"""
+Cross-student cache of grading results for identical answers.
+
+Short answers (numbers, single words, formulas) are often textually identical across a
+cohort. A sub-question's result only depends on the grading rules, the question (text,
+context, extra comments), the sub-question's model alternatives and the student's
+answer, so the result is cached under a hash of exactly those and reused for the next
+student who gives the same answer.
+
+  - Answers are normalized with Unicode NFKC and whitespace collapsing only; case is
+    kept because it matters in formulas and units.
+  - Answers with an answer_visual are never cached.
+  - By default (ANSWER_CACHE_SCOPE=question) the key of a sub-question in a question with
+    several sub-questions also holds the student's answers to its siblings, since a later
+    part may be graded with follow-through from an earlier wrong answer. Such a key only
+    hits for a student who answered the whole question the same way; a sibling with an
+    answer_visual makes it uncacheable. ANSWER_CACHE_SCOPE=sub_question keys on the one
+    answer only, for a higher hit rate where the rules grade every part independently.
+  - Concurrent requests for the same key (a cohort batch) wait for the first one to
+    finish instead of grading the same answer in parallel (single flight).
+  - Only well-formed results are stored; failed gradings are released so the next
+    request grades the answer itself.
+  - Hits and lookups are counted per sub-question id for reporting.
+
+Configuration:
+  ANSWER_CACHE              1 (default) | 0
+  ANSWER_CACHE_SCOPE        question (default) | sub_question
+  ANSWER_CACHE_MAX_ENTRIES  LRU size (default 20000)
+  ANSWER_CACHE_WAIT_S       how long to wait for a concurrent grading (default 300)
+"""
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+CACHE_ENABLED = os.environ.get("ANSWER_CACHE", "1").strip().lower() not in ("0", "false", "no", "off")
+KEY_SCOPE = os.environ.get("ANSWER_CACHE_SCOPE", "question").strip().lower()
+MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "20000"))
+WAIT_SECONDS = int(os.environ.get("ANSWER_CACHE_WAIT_S", "300"))
+MAX_REPORTED_SUB_QUESTIONS = 2000
+
+
+def normalize_answer(text):
+    return " ".join(unicodedata.normalize("NFKC", str(text or "")).split())
+
+
+def _first_answer(sub_question):
+    answers = sub_question.get("student_answers") or []
+    return answers[0] if answers else {}
+
+
+def answer_key(grading_rules, question_for_ai, sub_question, scope=None):
+    """
+    Hash of everything that determines one sub-question's grade, or None if it is not
+    cacheable. With scope "question" (default KEY_SCOPE) it includes the sibling answers.
+    """
+    answer = _first_answer(sub_question)
+    if answer.get("answer_visual"):
+        return None
+    siblings = []
+    sub_questions = question_for_ai.get("sub_questions", [])
+    if (scope or KEY_SCOPE) != "sub_question" and len(sub_questions) > 1:
+        for sibling in sub_questions:
+            sibling_answer = _first_answer(sibling)
+            if sibling_answer.get("answer_visual"):
+                return None
+            siblings.append(normalize_answer(sibling_answer.get("answer_text")))
+    question_fields = {k: v for k, v in question_for_ai.items() if k != "sub_questions"}
+    sub_question_fields = {k: v for k, v in sub_question.items() if k not in ("student_answers", "sub_question_id")}
+    digest = hashlib.sha256()
+    for part in (grading_rules or "", question_fields, sub_question_fields, normalize_answer(answer.get("answer_text")),
+                 siblings):
+        digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def _valid(result):
+    return (
+        isinstance(result, dict)
+        and isinstance(result.get("sub_points_awarded"), (int, float))
+        and isinstance(result.get("feedback_comment"), str)
+        and not result["feedback_comment"].startswith("ERROR")
+    )
+
+
+class _Pending:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class Lookup:
+    """
+    One question's view of the cache:
+      hits     sub_question_id -> cached student_answers
+      owned    sub_question_id -> key this request grades and must publish()
+      waiting  sub_question_id -> key another request is grading right now
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.hits = {}
+        self.owned = {}
+        self.waiting = {}
+
+    def publish(self, llm_result):
+        """Stores the owned sub-questions' results from the LLM's answer (None on failure)."""
+        by_id = {
+            sq.get("sub_question_id"): sq.get("student_answers")
+            for sq in (llm_result or {}).get("sub_questions", [])
+        }
+        for sq_id, key in self.owned.items():
+            self._cache._publish(key, by_id.get(sq_id))
+        self.owned = {}
+
+    def wait(self, timeout=WAIT_SECONDS):
+        """Results of the `waiting` sub-questions whose concurrent grading succeeded."""
+        results = {}
+        for sq_id, key in self.waiting.items():
+            result = self._cache._wait(key, sq_id, timeout)
+            if result is not None:
+                results[sq_id] = result
+        return results
+
+
+class AnswerCache:
+    def __init__(self, enabled=CACHE_ENABLED, max_entries=MAX_ENTRIES, scope=KEY_SCOPE):
+        if scope not in ("question", "sub_question"):
+            print(f"Warning: Unknown ANSWER_CACHE_SCOPE '{scope}'. Using 'question'.")
+            scope = "question"
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.scope = scope
+        self._entries = OrderedDict()   # key -> student_answers
+        self._pending = {}              # key -> _Pending
+        self._per_sub_question = OrderedDict()  # sub_question_id -> {"hits", "lookups"}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "waited": 0, "uncacheable": 0, "stored": 0, "wait_failed": 0}
+
+    def _record(self, sq_id, hit):
+        entry = self._per_sub_question.pop(sq_id, None) or {"hits": 0, "lookups": 0}
+        entry["lookups"] += 1
+        entry["hits"] += int(hit)
+        self._per_sub_question[sq_id] = entry
+        while len(self._per_sub_question) > MAX_REPORTED_SUB_QUESTIONS:
+            self._per_sub_question.popitem(last=False)
+
+    def lookup(self, question_for_ai, grading_rules, skip=()):
+        """Classifies the question's sub-questions (except `skip`) into hits, owned and waiting."""
+        lookup = Lookup(self)
+        if not self.enabled:
+            return lookup
+        for sq in question_for_ai.get("sub_questions", []):
+            sq_id = sq.get("sub_question_id")
+            if sq_id in skip:
+                continue
+            key = answer_key(grading_rules, question_for_ai, sq, self.scope)
+            with self._lock:
+                if key is None:
+                    self.stats["uncacheable"] += 1
+                    continue
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    lookup.hits[sq_id] = self._entries[key]
+                    self.stats["hits"] += 1
+                    self._record(sq_id, True)
+                elif key in self._pending:
+                    lookup.waiting[sq_id] = key
+                else:
+                    self._pending[key] = _Pending()
+                    lookup.owned[sq_id] = key
+                    self.stats["misses"] += 1
+                    self._record(sq_id, False)
+        return lookup
+
+    def _publish(self, key, result):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+            if _valid(result):
+                self._entries[key] = result
+                self._entries.move_to_end(key)
+                self.stats["stored"] += 1
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                result = None
+        if pending is not None:
+            pending.result = result
+            pending.event.set()
+
+    def _wait(self, key, sq_id, timeout):
+        with self._lock:
+            pending = self._pending.get(key)
+            result = self._entries.get(key) if pending is None else None
+        if pending is not None:
+            pending.event.wait(timeout)
+            result = pending.result
+        with self._lock:
+            self.stats["waited" if result is not None else "wait_failed"] += 1
+            self._record(sq_id, result is not None)
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            per_sub_question = {
+                sq_id: dict(entry, hit_rate=round(entry["hits"] / entry["lookups"], 3))
+                for sq_id, entry in self._per_sub_question.items()
+            }
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["waited"] + stats["wait_failed"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["waited"]) / lookups, 3) if lookups else None
+        stats["per_sub_question"] = per_sub_question
+        return stats
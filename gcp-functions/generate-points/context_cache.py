@@ -0,0 +1,208 @@
+"""
+Gemini explicit context caching for the exam-invariant part of a grading request.
+
+For one question, everything except the student's attempt is the same for every
+student: the system prompt with the grading rules, the question text, the model
+alternatives and the context/component visuals. That prefix is stored once as a
+Gemini cached-content entry and every student's request only sends its own answer.
+
+  - Keys are content hashes (model + system prompt + exam-invariant JSON, which holds
+    the visual URLs), so editing the answer model or rules produces a new entry. The
+    superseded entry for the same question is deleted instead of waiting for its TTL.
+  - Entries expire after GEMINI_CONTEXT_CACHE_TTL seconds and are recreated on demand.
+  - Concurrent requests for the same key wait for a single creation (single flight).
+  - Other instances' entries are found by display name before creating a new one, in
+    a listing of the project's caches that is refreshed at most once a minute and
+    bounded in size. An adopted entry is used until its own expire_time, not one TTL.
+  - If creation is rejected as invalid (400, typically a prefix below the model's
+    minimum cacheable size, which no retry changes) the key is remembered as
+    uncacheable for as long as it stays in memory; other failures are retried after
+    one TTL. Callers of an uncacheable key send the full request without an API call.
+  - Entries and question scopes are kept in LRUs of GEMINI_CONTEXT_CACHE_MAX_ENTRIES
+    keys, and per-key creation is serialized through a fixed set of lock stripes, so
+    a warm instance's memory stays bounded.
+
+Configuration:
+  GEMINI_CONTEXT_CACHE              1 (default) | 0
+  GEMINI_CONTEXT_CACHE_TTL          seconds (default 3600)
+  GEMINI_CONTEXT_CACHE_MAX_ENTRIES  keys remembered per instance (default 5000)
+"""
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from google.genai import errors, types
+
+CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE", "1").strip().lower() not in ("0", "false", "no", "off")
+CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+MAX_ENTRIES = int(os.environ.get("GEMINI_CONTEXT_CACHE_MAX_ENTRIES", "5000"))
+KEY_LOCK_STRIPES = 64
+# Entries are treated as expired this long before Gemini drops them, so a request never
+# references a cache that disappears mid-call.
+EXPIRY_MARGIN_SECONDS = 120
+DISPLAY_NAME_PREFIX = "gp-ctx-"
+# Listing of other instances' entries: how long it is reused and how many caches it reads.
+REMOTE_INDEX_REFRESH_SECONDS = 60
+REMOTE_INDEX_MAX_ENTRIES = 500
+
+
+def context_key(model, system_prompt, invariant_json):
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(system_prompt.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(json.dumps(invariant_json, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class _Entry:
+    def __init__(self, name, expires_at):
+        self.name = name              # cachedContents/..., or None when uncacheable
+        self.expires_at = expires_at  # epoch seconds, inf for a key that can never be cached
+
+    def valid(self):
+        return time.time() < self.expires_at - EXPIRY_MARGIN_SECONDS
+
+
+class GradingContextCache:
+    def __init__(self, client_factory, ttl_seconds=CACHE_TTL_SECONDS, enabled=CACHE_ENABLED,
+                 max_entries=MAX_ENTRIES):
+        self._client_factory = client_factory
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self._entries = OrderedDict()     # key -> _Entry
+        self._scope_keys = OrderedDict()  # question scope -> current key
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+        self._lock = threading.Lock()
+        self._remote_index = {}  # display name -> (name, expires_at), from the last listing
+        self._remote_index_at = 0.0
+        self._remote_lock = threading.Lock()
+        self.stats = {"hits": 0, "created": 0, "found_remote": 0, "uncacheable": 0, "invalidated": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _key_lock(self, key):
+        return self._key_locks[int(key[:8], 16) % len(self._key_locks)]
+
+    def _remember(self, key, entry, scope):
+        """Stores the entry for `key` (and `scope`'s current key), evicting the least recently used."""
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._scope_keys[scope] = key
+            self._scope_keys.move_to_end(scope)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            while len(self._scope_keys) > self.max_entries:
+                self._scope_keys.popitem(last=False)
+
+    def get(self, model, system_prompt, invariant_json, scope, build_contents):
+        """
+        Returns the cached-content name for this exam-invariant context, creating it if
+        needed, or None when caching is disabled or not possible (callers then send the
+        full prompt). `build_contents()` is only called when an entry must be created.
+        `scope` identifies the question across edits (e.g. its sub-question ids).
+        """
+        if not self.enabled:
+            return None
+        key = context_key(model, system_prompt, invariant_json)
+
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+            if entry is not None and entry.valid():
+                if entry.name:
+                    self._count("hits")
+                return entry.name
+
+            self._invalidate_superseded(scope, key)
+            client = self._client_factory()
+            name, expires_at = self._find_remote(client, key)
+            if name is None:
+                name, expires_at = self._create(client, model, system_prompt, key, build_contents)
+            self._remember(key, _Entry(name, expires_at), scope)
+            return name
+
+    def _find_remote(self, client, key):
+        """(name, expires_at) of a live entry another instance created for `key`, or (None, None)."""
+        with self._remote_lock:
+            if time.time() - self._remote_index_at >= REMOTE_INDEX_REFRESH_SECONDS:
+                self._remote_index = self._list_remote(client)
+                self._remote_index_at = time.time()
+            found = self._remote_index.get(f"{DISPLAY_NAME_PREFIX}{key[:48]}")
+        if found is None or found[1] - EXPIRY_MARGIN_SECONDS <= time.time():
+            return None, None
+        self._count("found_remote")
+        return found
+
+    @staticmethod
+    def _list_remote(client):
+        index = {}
+        try:
+            listing = client.caches.list(config=types.ListCachedContentsConfig(page_size=100))
+            for cached in itertools.islice(listing, REMOTE_INDEX_MAX_ENTRIES):
+                display_name = getattr(cached, "display_name", None) or ""
+                expire_time = getattr(cached, "expire_time", None)
+                if display_name.startswith(DISPLAY_NAME_PREFIX) and expire_time is not None:
+                    index[display_name] = (cached.name, expire_time.timestamp())
+        except Exception as e:
+            print(f"Warning: could not list Gemini caches: {e}")
+        return index
+
+    def _create(self, client, model, system_prompt, key, build_contents):
+        try:
+            cached = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"{DISPLAY_NAME_PREFIX}{key[:48]}",
+                    system_instruction=system_prompt,
+                    contents=build_contents(),
+                    ttl=f"{self.ttl_seconds}s",
+                ),
+            )
+        except Exception as e:
+            # A 400 is typically a prefix below the model's minimum cacheable token count,
+            # which holds for this key for good; anything else may succeed after one TTL.
+            permanent = isinstance(e, errors.ClientError) and e.code == 400
+            print(f"Context cache not created for {key[:12]} (sending uncached"
+                  f"{'' if permanent else f' for {self.ttl_seconds}s'}): {e}")
+            self._count("uncacheable")
+            return None, float("inf") if permanent else time.time() + self.ttl_seconds
+        print(f"Created Gemini context cache {cached.name} for {key[:12]}.")
+        self._count("created")
+        expire_time = getattr(cached, "expire_time", None)
+        return cached.name, expire_time.timestamp() if expire_time is not None else time.time() + self.ttl_seconds
+
+    def _invalidate_superseded(self, scope, key):
+        with self._lock:
+            old_key = self._scope_keys.get(scope)
+            old_entry = self._entries.pop(old_key, None) if old_key and old_key != key else None
+        if old_entry is None or not old_entry.name:
+            return
+        try:
+            self._client_factory().caches.delete(name=old_entry.name)
+            print(f"Deleted superseded context cache {old_entry.name}.")
+        except Exception as e:
+            print(f"Warning: could not delete superseded cache {old_entry.name}: {e}")
+        self._count("invalidated")
+
+    def forget(self, name):
+        """Drops a cache name that Gemini rejected (e.g. expired early), so the next call recreates it."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.name == name:
+                    del self._entries[key]
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=sum(1 for e in self._entries.values() if e.name))
@@ -0,0 +1,382 @@
+"""
+URL-keyed cache of normalized image bytes for grading requests.
+
+The same context/component visuals are sent with every student's request, so each
+instance downloads an exam diagram once and serves it from the cache afterwards.
+
+  - Tiers: an in-process LRU (bounded by total bytes) in front of a /tmp disk tier
+    (note: /tmp is memory-backed on Cloud Functions), both evicting least recently used.
+  - Keys are normalized URLs: scheme and host lowercased, default ports, fragments and
+    query parameter order ignored.
+  - Entries younger than IMAGE_CACHE_FRESH_SECONDS are served without a request. Older
+    entries are revalidated with If-None-Match / If-Modified-Since; a 304 keeps the
+    cached bytes, and a failed revalidation serves the stale copy.
+  - Downloads above IMAGE_MAX_DOWNLOAD_BYTES are rejected. Images are EXIF-rotated,
+    downscaled to IMAGE_MAX_DIMENSION and re-encoded (JPEG stays JPEG, everything else
+    becomes PNG), so Gemini always gets a bounded, well-formed image.
+  - Concurrent requests for the same URL wait for a single download (single flight).
+
+Configuration:
+  IMAGE_CACHE                1 (default) | 0
+  IMAGE_CACHE_MEMORY_BYTES   in-memory tier size (default 128 MiB)
+  IMAGE_CACHE_DIR            disk tier directory (default /tmp/generate-points-image-cache, '' disables)
+  IMAGE_CACHE_DISK_BYTES     disk tier size (default 512 MiB)
+  IMAGE_CACHE_FRESH_SECONDS  serve without revalidation for this long (default 300)
+  IMAGE_MAX_DOWNLOAD_BYTES   largest accepted download (default 20 MiB)
+  IMAGE_MAX_DIMENSION        longest side after normalization (default 2048)
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+CACHE_ENABLED = os.environ.get("IMAGE_CACHE", "1").strip().lower() not in ("0", "false", "no", "off")
+MEMORY_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MEMORY_BYTES", str(128 * 1024 * 1024)))
+DISK_DIR = os.environ.get("IMAGE_CACHE_DIR", "/tmp/generate-points-image-cache")
+DISK_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+FRESH_SECONDS = int(os.environ.get("IMAGE_CACHE_FRESH_SECONDS", "300"))
+MAX_DOWNLOAD_BYTES = int(os.environ.get("IMAGE_MAX_DOWNLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "2048"))
+JPEG_QUALITY = 90
+
+
+def normalize_url(url):
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def cache_key(url):
+    return hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def normalize_image(data):
+    """Returns (bytes, mime_type) of the rotated, bounded, re-encoded image. Raises on undecodable data."""
+    with Image.open(io.BytesIO(data)) as img:
+        source_format = img.format
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
+        out = io.BytesIO()
+        if source_format == "JPEG":
+            img.convert("RGB").save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+            return out.getvalue(), "image/jpeg"
+        if img.mode not in ("1", "L", "LA", "RGB", "RGBA", "P"):
+            img = img.convert("RGBA")
+        img.save(out, format="PNG", optimize=True)
+        return out.getvalue(), "image/png"
+
+
+def sniff_mime_type(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+# --- Tiers ---
+# An entry is (meta, data); meta holds url, etag, last_modified, fetched_at and mime_type.
+
+class _MemoryTier:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if len(entry[1]) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[1])
+            self._entries[key] = entry
+            self._size += len(entry[1])
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[1])
+
+    @property
+    def size(self):
+        return self._size
+
+
+class _DiskTier:
+    """
+    One file per key: a JSON metadata line followed by the image bytes. Recency is
+    tracked via file mtime, which is bumped on every hit.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.img")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+            os.utime(path, None)
+            return meta, data
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: dropping unreadable image cache file {path}: {e}")
+            self.delete(key)
+            return None
+
+    def put(self, key, entry):
+        meta, data = entry
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(meta).encode("utf-8") + b"\n")
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: could not write image cache file {path}: {e}")
+            return
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(".img"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+
+# --- Cache ---
+
+class ImageCache:
+    def __init__(self, enabled=CACHE_ENABLED, memory_bytes=MEMORY_MAX_BYTES, disk_dir=DISK_DIR,
+                 disk_bytes=DISK_MAX_BYTES, fresh_seconds=FRESH_SECONDS):
+        self.enabled = enabled
+        self.fresh_seconds = fresh_seconds
+        self._memory = _MemoryTier(memory_bytes)
+        self._disk = None
+        if enabled and disk_dir:
+            try:
+                self._disk = _DiskTier(disk_dir, disk_bytes)
+            except OSError as e:
+                print(f"Warning: image cache disk tier disabled ({disk_dir}): {e}")
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0, "revalidated": 0, "changed": 0,
+            "stale_served": 0, "errors": 0, "too_large": 0, "bytes_downloaded": 0, "bytes_served_from_cache": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _lookup(self, key):
+        entry = self._memory.get(key)
+        if entry is not None:
+            return entry, "memory_hits"
+        if self._disk is not None:
+            entry = self._disk.get(key)
+            if entry is not None:
+                self._memory.put(key, entry)
+                return entry, "disk_hits"
+        return None, None
+
+    def _store(self, key, entry):
+        self._memory.put(key, entry)
+        if self._disk is not None:
+            self._disk.put(key, entry)
+
+    # The network step is passed in so the async entry point can use its own HTTP client.
+    # fetch(url, headers) -> (status, response_headers, body); status 304 means "not modified".
+
+    def get(self, url, fetch=None, timeout=10):
+        """Normalized image bytes for `url`, or None if it cannot be fetched or decoded."""
+        fetch = fetch or (lambda u, h: _urllib_fetch(u, h, timeout))
+        if not self.enabled:
+            return self._finish(None, None, self._download(url, fetch, None))
+        key = cache_key(url)
+        with self._key_lock(key):
+            entry, data = self._begin(key)
+            if data is not None:
+                return data
+            return self._finish(key, entry, self._download(url, fetch, entry))
+
+    async def get_async(self, url, fetch):
+        """
+        Same as get() with `fetch` a coroutine function. There is no single flight across
+        tasks here; the async entry point already starts one download per URL.
+        """
+        if not self.enabled:
+            return self._finish(None, None, await self._download_async(url, fetch, None))
+        key = cache_key(url)
+        entry, data = self._begin(key)
+        if data is not None:
+            return data
+        return self._finish(key, entry, await self._download_async(url, fetch, entry))
+
+    def _begin(self, key):
+        """Returns (cached entry or None, bytes if that entry is fresh enough to serve)."""
+        entry, tier = self._lookup(key)
+        if entry is None:
+            self._count("misses")
+            return None, None
+        if time.time() - entry[0]["fetched_at"] < self.fresh_seconds:
+            self._count(tier)
+            self._count("bytes_served_from_cache", len(entry[1]))
+            return entry, entry[1]
+        return entry, None
+
+    def _finish(self, key, cached, new_entry):
+        if new_entry is None:
+            if cached is None:
+                return None
+            self._count("stale_served")
+            return cached[1]
+        if key is not None:
+            self._store(key, new_entry)
+        return new_entry[1]
+
+    def _download(self, url, fetch, cached):
+        """Returns a fresh (meta, data) entry, the revalidated `cached` entry, or None."""
+        try:
+            response = fetch(url, _conditional_headers(cached))
+        except Exception as exc:
+            return self._failed(url, exc)
+        return self._entry_from_response(url, cached, response)
+
+    async def _download_async(self, url, fetch, cached):
+        try:
+            response = await fetch(url, _conditional_headers(cached))
+        except Exception as exc:
+            return self._failed(url, exc)
+        return self._entry_from_response(url, cached, response)
+
+    def _failed(self, url, exc):
+        if isinstance(exc, ImageTooLarge):
+            print(f"[WARN] image '{url}' rejected: {exc}")
+            self._count("too_large")
+        else:
+            print(f"[WARN] could not fetch image '{url}': {exc}")
+            self._count("errors")
+        return None
+
+    def _entry_from_response(self, url, cached, response):
+        status, resp_headers, body = response
+        if status == 304 and cached is not None:
+            self._count("revalidated")
+            self._count("bytes_served_from_cache", len(cached[1]))
+            return dict(cached[0], fetched_at=time.time()), cached[1]
+        self._count("bytes_downloaded", len(body))
+        try:
+            data, mime_type = normalize_image(body)
+        except Exception as exc:
+            return self._failed(url, exc)
+        if cached is not None:
+            self._count("changed")
+        meta = {
+            "url": url,
+            "etag": resp_headers.get("ETag"),
+            "last_modified": resp_headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+            "mime_type": mime_type,
+        }
+        return meta, data
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        # Every lookup is a miss, a fresh hit, or a stale entry that was revalidated,
+        # replaced (changed) or served after a failed revalidation.
+        cached = stats["memory_hits"] + stats["disk_hits"] + stats["revalidated"] + stats["stale_served"]
+        lookups = cached + stats["misses"] + stats["changed"]
+        stats["hit_rate"] = round(cached / lookups, 3) if lookups else None
+        stats["memory_bytes"] = self._memory.size
+        return stats
+
+
+def _conditional_headers(cached):
+    headers = {}
+    if cached is not None:
+        if cached[0].get("etag"):
+            headers["If-None-Match"] = cached[0]["etag"]
+        if cached[0].get("last_modified"):
+            headers["If-Modified-Since"] = cached[0]["last_modified"]
+    return headers
+
+
+def _urllib_fetch(url, headers, timeout):
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            length = resp.headers.get("Content-Length")
+            if length and int(length) > MAX_DOWNLOAD_BYTES:
+                raise ImageTooLarge(f"{length} bytes > {MAX_DOWNLOAD_BYTES}")
+            body = resp.read(MAX_DOWNLOAD_BYTES + 1)
+            if len(body) > MAX_DOWNLOAD_BYTES:
+                raise ImageTooLarge(f"more than {MAX_DOWNLOAD_BYTES} bytes")
+            return resp.status, resp.headers, body
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, e.headers, b""
+        raise
@@ -1,8 +1,16 @@
-import os, json, base64, io, concurrent.futures, urllib.request   # + urllib.request
-from flask import abort, jsonify, make_response
+import os, json, base64, hashlib, io, asyncio, concurrent.futures, threading, time, urllib.parse, urllib.request   # + urllib.request
+from flask import Response, abort, jsonify, make_response
 import functions_framework
-from google import genai
+import httpx
 from google.genai import types
+
+import answer_cache
+import context_cache
+import image_cache
+import llm_clients
+import mcq_grader
+import tracing
+import usage
 # ------------------------------------------------------------------
 
 
@@ -10,6 +18,31 @@ from google.genai import types
 # ---------- CONFIG -------------------------------------------------
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")      # <-- set!
 GEMINI_MODEL   = "gemini-2.5-pro"
+
+# Exam-invariant context (rules, question, answer model, context visuals) is cached
+# once per question on Gemini and shared by all students (see context_cache.py).
+CONTEXT_CACHE = context_cache.GradingContextCache(lambda: llm_clients.gemini_client(GEMINI_API_KEY))
+CONTEXT_VISUAL_KEYS = ("context_visual", "component_visual")
+STUDENT_VISUAL_KEYS = ("answer_visual",)
+
+# Results for textually identical answers are shared across students (see answer_cache.py).
+ANSWER_CACHE = answer_cache.AnswerCache()
+
+# Downloaded images are normalized and kept per instance (memory + /tmp, see image_cache.py).
+IMAGE_CACHE = image_cache.ImageCache()
+
+# generate_points_batch: one pool for all (student, question) jobs of a cohort. After
+# GRADING_BATCH_TIMEOUT queued jobs are cancelled and the ones already grading finish, so
+# deploy the batch entry point with a function timeout of at least this plus one question.
+BATCH_MAX_WORKERS = int(os.environ.get("GRADING_BATCH_WORKERS", "32"))
+BATCH_TIMEOUT_S   = int(os.environ.get("GRADING_BATCH_TIMEOUT", "240"))
+
+# generate_points_async: one pooled async HTTP client per request for image downloads.
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get("GRADING_ASYNC_HTTP_CONNECTIONS", "32"))
+IMAGE_TIMEOUT_S            = 10
+
+# Per-question limit for generate_points (incl. NDJSON streaming) and generate_points_async.
+QUESTION_TIMEOUT_S = 300
 # ------------------------------------------------------------------
 
 SYSTEM_PROMPT_TEMPLATE = """{rules}
@@ -62,60 +95,486 @@ Return only the following JSON structure. **Do not include the "questions" wrapp
 
 
 def _download_image(url:str, timeout:int=10) -> bytes|None:
-    """Return raw image bytes or None on any failure."""
-    try:
-        with urllib.request.urlopen(url, timeout=timeout) as resp:
-            return resp.read()
-    except Exception as exc:
-        print(f"[WARN] could not fetch image '{url}': {exc}")
-        return None
+    """Return normalized image bytes (cached per instance) or None on any failure."""
+    with tracing.span("image.fetch", url=url) as fetch_span:
+        data = IMAGE_CACHE.get(url, timeout=timeout)
+        fetch_span.set(bytes=len(data) if data else 0)
+    return data
+
+
+
+# ------------- images uploaded with the request -------------------
+def _url_filename(url):
+    """Last path segment, decoded like getFilenameFromUrl() in config.js."""
+    return urllib.parse.unquote(urllib.parse.urlsplit(url).path.rsplit('/', 1)[-1])
+
+
+class _UploadedImages:
+    """
+    Content-addressed view of the image parts grading.js attaches to the form (one part
+    per unique visual, named after the last segment of its URL). Calling it resolves an
+    image URL against the uploads and only downloads what is missing, so each image
+    crosses the wire once per grading call.
+
+    Filenames shared by several different URLs in `referenced_urls` are ambiguous and
+    always downloaded.
+    """
+
+    def __init__(self, files, referenced_urls, fallback=None):
+        self._blobs = {}      # sha256 of the uploaded bytes -> normalized bytes
+        self._by_name = {}    # filename -> sha256
+        self._fallback = fallback or _download_image
+        self._lock = threading.Lock()
+        self.stats = {"parts": 0, "unique": 0, "rejected": 0, "from_upload": 0, "downloaded": 0}
+
+        urls_by_name = {}
+        for url in referenced_urls:
+            urls_by_name.setdefault(_url_filename(url), set()).add(image_cache.normalize_url(url))
+        ambiguous = {name for name, urls in urls_by_name.items() if len(urls) > 1}
+
+        for field in files:
+            for storage in files.getlist(field):
+                self.stats["parts"] += 1
+                name = storage.filename or field
+                data = storage.stream.read(image_cache.MAX_DOWNLOAD_BYTES + 1)
+                if len(data) > image_cache.MAX_DOWNLOAD_BYTES or name in ambiguous:
+                    self.stats["rejected"] += 1
+                    continue
+                digest = hashlib.sha256(data).hexdigest()
+                if digest not in self._blobs:
+                    try:
+                        self._blobs[digest] = image_cache.normalize_image(data)[0]
+                    except Exception as exc:
+                        print(f"[WARN] ignoring uploaded image '{name}': {exc}")
+                        self.stats["rejected"] += 1
+                        continue
+                self._by_name[name] = digest
+        self.stats["unique"] = len(self._blobs)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def lookup(self, url):
+        """Uploaded bytes for `url`, or None (counted as a download) when it was not uploaded."""
+        digest = self._by_name.get(_url_filename(url))
+        if digest is None:
+            self._count("downloaded")
+            return None
+        self._count("from_upload")
+        return self._blobs[digest]
+
+    def __call__(self, url):
+        data = self.lookup(url)
+        return data if data is not None else self._fallback(url)
+
+
+# ------------- split a question into shared / per-student ---------
+def _collect_visual_urls(node, keys, found=None):
+    """All http(s) URLs stored under any of `keys`, in document order, without duplicates."""
+    if found is None:
+        found = []
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k in keys and isinstance(v, str) and v.startswith("http") and v not in found:
+                found.append(v)
+            else:
+                _collect_visual_urls(v, keys, found)
+    elif isinstance(node, list):
+        for item in node:
+            _collect_visual_urls(item, keys, found)
+    return found
+
+
+def split_question(question_for_ai):
+    """
+    Returns (exam_part, student_part): the question without any student answers (identical
+    for every student, so it can be cached) and just the student's answers per sub-question.
+    """
+    exam_part = json.loads(json.dumps(question_for_ai))  # deep copy
+    student_part = {"question_number": question_for_ai.get("question_number"), "sub_questions": []}
+    for sq in exam_part.get('sub_questions', []):
+        student_part["sub_questions"].append({
+            "sub_question_id": sq.get('sub_question_id'),
+            "student_answers": sq.pop('student_answers', []),
+        })
+    return exam_part, student_part
 
 
+def _image_parts(urls, label, download=None):
+    parts = []
+    for url in urls:
+        img = (download or _download_image)(url)
+        if img:           # only keep successfully downloaded images
+            parts.append(types.Part.from_text(text=f"{label}: {url.rsplit('/', 1)[-1]}"))
+            parts.append(types.Part.from_bytes(mime_type=image_cache.sniff_mime_type(img), data=img))
+    return parts
+
 
 # ----------------- (1)  call_gemini  ------------------------------
-def call_gemini(json_for_one_question, image_bytes_list, grading_rules):
+class GradingRequest:
     """
-    Single synchronous Gemini request.
-    image_bytes_list  – list[bytes], each entry already fetched from URL.
+    One question's grading request, split for the context cache: the exam part (rules,
+    question, answer model, context visuals) and the student part (answers, answer
+    visuals). Shared by the threaded and the asyncio entry points.
+    `download(url) -> bytes|None` supplies image bytes (default: _download_image).
+    Sub-questions in `graded_ids` (graded locally) are left out of the student part and
+    the model is told to skip them; the exam part stays complete so the cache is shared.
     """
 
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    def __init__(self, json_for_one_question, grading_rules, extra_image_urls=(), download=None, graded_ids=()):
+        question = json_for_one_question["questions"][0]
+        self.question_number = question.get("question_number")
+        self.system_prompt = SYSTEM_PROMPT_TEMPLATE.format(rules=grading_rules or "")
+        self.exam_part, self.student_part = split_question(question)
+        self.graded_ids = [sq_id for sq_id in graded_ids]
+        if self.graded_ids:
+            self.student_part["sub_questions"] = [
+                sq for sq in self.student_part["sub_questions"] if sq["sub_question_id"] not in self.graded_ids
+            ]
+        self.scope = (self.question_number, tuple(sq.get("sub_question_id") for sq in self.exam_part.get("sub_questions", [])))
+        self.exam_image_urls = _collect_visual_urls(self.exam_part, CONTEXT_VISUAL_KEYS)
+        self.answer_image_urls = _collect_visual_urls(self.student_part, STUDENT_VISUAL_KEYS)
+        self.extra_image_urls = list(extra_image_urls)
+        self.download = download
+
+    @property
+    def image_urls(self):
+        return self.exam_image_urls + self.answer_image_urls + self.extra_image_urls
 
-    parts = [types.Part.from_text(text=json.dumps(json_for_one_question, ensure_ascii=False))]
+    def exam_parts(self):
+        return [
+            types.Part.from_text(text="EXAM QUESTION AND ANSWER MODEL:\n" + json.dumps({"questions": [self.exam_part]}, ensure_ascii=False)),
+            *_image_parts(self.exam_image_urls, "context_visual", self.download),
+        ]
 
-    # Attach every downloaded image – no filenames/captions
-    for img_bytes in image_bytes_list:
-        parts.append(
-            types.Part.from_bytes(
-                mime_type="image/png",   # works for jpeg/png; gemini ignores exact mime
-                data=img_bytes
-            )
+    def student_parts(self):
+        skip = []
+        if self.graded_ids:
+            skip.append(types.Part.from_text(
+                text="Already graded, leave these sub_question_ids out of your output: " + json.dumps(self.graded_ids)))
+        return [
+            *skip,
+            types.Part.from_text(text="STUDENT'S ATTEMPT:\n" + json.dumps({"questions": [self.student_part]}, ensure_ascii=False)),
+            *_image_parts(self.answer_image_urls, "answer_visual", self.download),
+            *_image_parts(self.extra_image_urls, "image", self.download),
+        ]
+
+    def context_cache_name(self):
+        """Cached-content name for the exam part, or None (see context_cache.py). May block."""
+        return CONTEXT_CACHE.get(
+            GEMINI_MODEL, self.system_prompt, self.exam_part, self.scope,
+            lambda: [types.Content(role="user", parts=self.exam_parts())],
         )
 
-    contents = [types.Content(role="user", parts=parts)]
+    def cached_call(self, cache_name, student_parts):
+        """kwargs for generate_content when the exam part comes from `cache_name`."""
+        return dict(
+            model=GEMINI_MODEL,
+            contents=[types.Content(role="user", parts=student_parts)],
+            config=types.GenerateContentConfig(
+                temperature=0,
+                response_mime_type="application/json",
+                cached_content=cache_name,
+            ),
+        )
 
-    cfg = types.GenerateContentConfig(
-        temperature=0,
-        response_mime_type="application/json",
-        system_instruction=[
-            types.Part.from_text(
-                text=SYSTEM_PROMPT_TEMPLATE.format(rules=grading_rules or "")
-            )
-        ]
-    )
+    def uncached_call(self, student_parts):
+        """kwargs for generate_content with the full prompt."""
+        return dict(
+            model=GEMINI_MODEL,
+            contents=[types.Content(role="user", parts=self.exam_parts() + student_parts)],
+            config=types.GenerateContentConfig(
+                temperature=0,
+                response_mime_type="application/json",
+                system_instruction=[types.Part.from_text(text=self.system_prompt)]
+            ),
+        )
 
-    resp = client.models.generate_content(
-        model=GEMINI_MODEL,
-        contents=contents,
-        config=cfg
-    )
 
+def _image_count(call):
+    """Images sent by a generate_content call built by GradingRequest."""
+    return sum(1 for content in call["contents"] for part in content.parts if part.inline_data)
+
+
+def call_gemini(json_for_one_question, grading_rules, extra_image_urls=(), download=None, graded_ids=()):
+    """
+    Single synchronous Gemini request for one question.
+    The exam part (rules, question, answer model, context visuals) comes from the
+    context cache when possible; only the student's answers and answer visuals are sent.
+    Falls back to one uncached request with the full prompt.
+    `download(url) -> bytes|None` replaces _download_image (the batch endpoint shares one).
+    """
+
+    client = llm_clients.gemini_client(GEMINI_API_KEY)   # shared, keep-alive
+    req = GradingRequest(json_for_one_question, grading_rules, extra_image_urls, download, graded_ids)
+    student_parts = req.student_parts()
+
+    with tracing.span("context_cache") as cache_span:
+        cache_name = req.context_cache_name()
+        cache_span.set(cached=bool(cache_name))
+    if cache_name:
+        try:
+            call = req.cached_call(cache_name, student_parts)
+            with tracing.span("llm.gemini", task="grade", model=GEMINI_MODEL, cached=True), \
+                    usage.call("gemini", GEMINI_MODEL, "grade", images=_image_count(call)) as metered:
+                resp = client.models.generate_content(**call)
+                metered.record(resp)
+            return json.loads(resp.text)
+        except json.JSONDecodeError:
+            raise
+        except Exception as exc:
+            print(f"[WARN] cached request failed for {cache_name}, retrying uncached: {exc}")
+            CONTEXT_CACHE.forget(cache_name)
+
+    call = req.uncached_call(student_parts)
+    with tracing.span("llm.gemini", task="grade", model=GEMINI_MODEL, cached=False), \
+            usage.call("gemini", GEMINI_MODEL, "grade", images=_image_count(call)) as metered:
+        resp = client.models.generate_content(**call)
+        metered.record(resp)
     return json.loads(resp.text)
 
 
+def _pre_grade(question, grading_rules, extra_image_urls):
+    """
+    Sub-questions that need no Gemini call of their own: ({sub_question_id: student_answers}
+    graded locally or found in the answer cache, answer_cache.Lookup for the rest).
+    Questions with extra image_urls are not looked up, their images are not in the key.
+    """
+    graded = mcq_grader.grade_question(question)
+    if extra_image_urls:
+        lookup = answer_cache.Lookup(ANSWER_CACHE)
+    else:
+        lookup = ANSWER_CACHE.lookup(question, grading_rules, skip=graded)
+    graded.update(lookup.hits)
+    return graded, lookup
+
+
+def _skip_ids(question, keep):
+    """Sub-question ids Gemini should leave out so that it only grades `keep`."""
+    return [sq.get("sub_question_id") for sq in question.get("sub_questions", [])
+            if sq.get("sub_question_id") not in keep]
+
+
+def _combine_results(first, second):
+    if first is None or second is None:
+        return first if second is None else second
+    return {**first, "sub_questions": first.get("sub_questions", []) + second.get("sub_questions", [])}
+
+
+def grade_question(json_for_one_question, grading_rules, extra_image_urls=(), download=None):
+    """
+    Grades MCQ sub-questions locally (see mcq_grader.py), reuses results of identical
+    answers from other students (see answer_cache.py) and sends only the rest to Gemini;
+    a question with nothing left to grade makes no call.
+    """
+    question = json_for_one_question["questions"][0]
+    with tracing.span("question", question_number=question.get("question_number")) as question_span:
+        return _grade_question(json_for_one_question, grading_rules, extra_image_urls, download, question_span)
+
+
+def _grade_question(json_for_one_question, grading_rules, extra_image_urls, download, question_span):
+    question = json_for_one_question["questions"][0]
+    graded, lookup = _pre_grade(question, grading_rules, extra_image_urls)
+    question_span.set(pre_graded=len(graded), waiting=len(lookup.waiting))
+
+    def gemini(keep):
+        if not keep:
+            return None
+        return call_gemini(json_for_one_question, grading_rules, extra_image_urls, download,
+                           graded_ids=_skip_ids(question, keep))
+
+    result = None
+    try:
+        result = gemini(set(_skip_ids(question, set(graded) | set(lookup.waiting))))
+    finally:
+        lookup.publish(result)
+
+    # Answers another request was grading at the same time; grade them here if that failed.
+    graded.update(lookup.wait())
+    retry = [sq_id for sq_id in lookup.waiting if sq_id not in graded]
+    result = _combine_results(result, gemini(set(retry)))
+    return mcq_grader.merge(question, result, graded)
+
+
+
+# ------------- per-question request / response shaping ------------
+def prepare_question(original_question):
+    """
+    Returns ({"questions": [question_for_ai]}, image_urls) for one question as
+    sent by the frontend (sub-question 'id' renamed to 'sub_question_id').
+    """
+    # ---------------------------------------------------------
+    # Gather *all* image URLs found in this specific question
+    # ---------------------------------------------------------
+    image_urls = []
+
+    # 1. any top-level list like  "image_urls": ["..."]
+    if isinstance(original_question.get('image_urls'), list):
+        image_urls.extend(original_question['image_urls'])
+
+    # 2.  possible single string "image_url": "..."
+    if isinstance(original_question.get('image_url'), str):
+        image_urls.append(original_question['image_url'])
+
+    # 3. inside sub-questions
+    for sq in original_question.get('sub_questions', []):
+        if isinstance(sq.get('image_urls'), list):
+            image_urls.extend(sq['image_urls'])
+        if isinstance(sq.get('image_url'), str):
+            image_urls.append(sq['image_url'])
+
+    # ---------------------------------------------------------
+    # Build the clean JSON that will be sent to Gemini
+    # ---------------------------------------------------------
+    question_for_ai = json.loads(json.dumps(original_question))  # deep copy
+    # RENAME the 'id' key to 'sub_question_id' to match the prompt's example
+    for sq in question_for_ai.get('sub_questions', []):
+        if 'id' in sq:
+            sq['sub_question_id'] = sq.pop('id') # Rename for clarity
+        if 'student_answers' in sq and sq['student_answers']:
+            sq['student_answers'][0].pop('id', None)
+
+    single_json_for_ai = {"questions": [question_for_ai]}
+    return single_json_for_ai, image_urls
+
+
+def merge_question_result(original_q, get_result):
+    """
+    Maps Gemini's answer for one question back onto the original sub-question ids.
+    `get_result()` returns the parsed Gemini JSON or raises; every sub-question that
+    could not be graded gets a zero-point "ERROR: ..." feedback comment.
+    """
+    merged_q = {
+        "question_number": original_q["question_number"],
+        "sub_questions": []
+    }
+    try:
+        gemini_result_q = get_result()
+        # --- MODIFICATION START ---
+        # Build the map using the stable sub_question_id
+        gemini_sq_map = {
+            sq.get('sub_question_id'): sq
+            for sq in gemini_result_q.get('sub_questions', [])
+            if sq.get('sub_question_id') # Only include if ID is present
+        }
+
+        for original_sq in original_q.get('sub_questions', []):
+            # Look up using the original sub-question's ID
+            graded_sq_data = gemini_sq_map.get(original_sq.get('id'))
+
+            final_sq_data = {
+                "sub_question_id": original_sq.get('id'),
+                "sub_q_text_content": original_sq.get('sub_q_text_content')
+            }
+
+            # Check if the lookup was successful and if it has the answers
+            if graded_sq_data and graded_sq_data.get('student_answers'):
+                final_sq_data["student_answers"] = graded_sq_data['student_answers']
+            else:
+                # The failure path remains the same
+                final_sq_data["student_answers"] = {
+                    "sub_points_awarded": 0,
+                    "feedback_comment": (
+                        f"ERROR: AI failed to grade this sub-question "
+                        f"(ID: {original_sq.get('id')})."
+                    )
+                }
+            merged_q["sub_questions"].append(final_sq_data)
+        # --- MODIFICATION END ---
+
+    except Exception as e:
+        print(f"ERROR processing question {original_q['question_number']}: {e}")
+        for original_sq in original_q.get('sub_questions', []):
+            merged_q["sub_questions"].append({
+                "sub_question_id": original_sq.get('id'),
+                "sub_q_text_content": original_sq.get('sub_q_text_content'),
+                "student_answers": {
+                    "sub_points_awarded": 0,
+                    "feedback_comment": (
+                        "ERROR: AI processing failed for the entire question "
+                        f"(ID: {original_sq.get('id')})."
+                    )
+                }
+            })
+    return merged_q
+
+
+def _referenced_urls(big_json, prepared):
+    """Every image URL a grading_data payload can ask for: visuals plus explicit image_urls."""
+    urls = _collect_visual_urls(big_json, CONTEXT_VISUAL_KEYS + STUDENT_VISUAL_KEYS)
+    for _, _, image_urls in prepared:
+        urls.extend(image_urls)
+    return urls
+
+
+def _log_request_stats(uploads):
+    print(f"LLM client reuse: {llm_clients.stats()}")
+    print(f"Context cache: {CONTEXT_CACHE.snapshot()}")
+    print(f"Image cache: {IMAGE_CACHE.snapshot()}")
+    print(f"Uploaded images: {uploads.stats}")
+    print(f"MCQ grading: {mcq_grader.stats()}")
+    print(f"Answer cache: {ANSWER_CACHE.snapshot()}")
+
+
+# ------------- NDJSON streaming ------------------------------------
+def _wants_ndjson(request):
+    """Form field stream=ndjson or an Accept header asking for application/x-ndjson."""
+    return (request.form.get('stream') == 'ndjson'
+            or 'application/x-ndjson' in request.headers.get('Accept', ''))
+
+
+def _ndjson_results(ex, jobs, uploads, ledger=None):
+    """
+    Yields {"type": "question", "question": {...}} per question in completion order, each
+    shaped like an entry of the JSON response's "questions", then one
+    {"type": "summary", ...} record with the LLM usage from `ledger`, which is finished
+    when the stream ends. Questions still running after QUESTION_TIMEOUT_S are emitted
+    with ERROR feedback.
+    """
+    started = time.monotonic()
+    pending = {fut: original_q for original_q, fut in jobs}
+    failed = 0
+
+    def record(payload):
+        return json.dumps(payload, ensure_ascii=False) + "\n"
+
+    try:
+        try:
+            for fut in concurrent.futures.as_completed(list(pending), timeout=QUESTION_TIMEOUT_S):
+                original_q = pending.pop(fut)
+                failed += fut.exception() is not None
+                yield record({"type": "question", "question": merge_question_result(original_q, fut.result)})
+        except concurrent.futures.TimeoutError:
+            pass
+
+        def timed_out():
+            raise TimeoutError(f"not graded within {QUESTION_TIMEOUT_S}s")
+
+        for fut, original_q in pending.items():
+            fut.cancel()
+            failed += 1
+            yield record({"type": "question", "question": merge_question_result(original_q, timed_out)})
+
+        yield record({
+            "type": "summary",
+            "questions": len(jobs),
+            "failed": failed,
+            "seconds": round(time.monotonic() - started, 1),
+            "usage": ledger.summary() if ledger is not None else None,
+        })
+    finally:
+        # Also reached when the client disconnects mid-stream.
+        ex.shutdown(wait=False, cancel_futures=True)
+        _log_request_stats(uploads)
+        if ledger is not None:
+            ledger.finish()
+
 
 # ----------------- (2)  Cloud-Function entry point ----------------
 @functions_framework.http
+@tracing.traced_request("generate-points")
+@usage.metered_request("generate-points")
 def generate_points(request):
     # ---- CORS pre-flight
     if request.method == 'OPTIONS':
@@ -143,127 +602,468 @@ def generate_points(request):
     grading_rules = big_json.get('grading_regulations')
 
     # ----------------------------------------------------------------
-    # NOTE: we completely IGNORE any files that might have been
-    #       uploaded in `request.files`.
+    # Images uploaded in `request.files` are used directly; only the
+    # ones that are missing are downloaded from their URLs.
     # ----------------------------------------------------------------
+    prepared = [(q, *prepare_question(q)) for q in big_json['questions']]
+    uploads = _UploadedImages(request.files, _referenced_urls(big_json, prepared))
 
     jobs = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as ex:
-        for original_question in big_json['questions']:
-
-            # ---------------------------------------------------------
-            # Gather *all* image URLs found in this specific question
-            # ---------------------------------------------------------
-            image_urls = []
-
-            # 1. any top-level list like  "image_urls": ["..."]
-            if isinstance(original_question.get('image_urls'), list):
-                image_urls.extend(original_question['image_urls'])
-
-            # 2.  possible single string "image_url": "..."
-            if isinstance(original_question.get('image_url'), str):
-                image_urls.append(original_question['image_url'])
-
-            # 3. inside sub-questions
-            for sq in original_question.get('sub_questions', []):
-                if isinstance(sq.get('image_urls'), list):
-                    image_urls.extend(sq['image_urls'])
-                if isinstance(sq.get('image_url'), str):
-                    image_urls.append(sq['image_url'])
-
-            # Download them right here (synchronously – still cheap, few per Q)
-            img_bytes_list = []
-            for url in image_urls:
-                img = _download_image(url)
-                if img:           # only keep successfully downloaded images
-                    img_bytes_list.append(img)
-
-            # ---------------------------------------------------------
-            # Build the clean JSON that will be sent to Gemini
-            # ---------------------------------------------------------
-            question_for_ai = json.loads(json.dumps(original_question))  # deep copy
-            # RENAME the 'id' key to 'sub_question_id' to match the prompt's example
-            for sq in question_for_ai.get('sub_questions', []):
-                if 'id' in sq:
-                    sq['sub_question_id'] = sq.pop('id') # Rename for clarity
-                if 'student_answers' in sq and sq['student_answers']:
-                    sq['student_answers'][0].pop('id', None)
-
-            single_json_for_ai = {"questions": [question_for_ai]}
-
-            fut = ex.submit(
-                call_gemini,
-                single_json_for_ai,
-                img_bytes_list,           # <-- our freshly downloaded images
-                grading_rules
-            )
-            jobs.append((original_question, fut))
+    ex = concurrent.futures.ThreadPoolExecutor(max_workers=20)
+    for original_question, single_json_for_ai, image_urls in prepared:
+
+        # Images are resolved inside the worker; exam visuals only on a cache miss.
+        fut = ex.submit(
+            tracing.bind(grade_question),
+            single_json_for_ai,
+            grading_rules,
+            image_urls,
+            uploads
+        )
+        jobs.append((original_question, fut))
+
+    # ---- streaming mode: one NDJSON record per question as it finishes
+    if _wants_ndjson(request):
+        return Response(
+            _ndjson_results(ex, jobs, uploads, usage.detach()),
+            200,
+            {**headers, 'Content-Type': 'application/x-ndjson; charset=utf-8', 'X-Accel-Buffering': 'no'}
+        )
+
+    ex.shutdown(wait=True)
 
     # ----------------------------------------------------------------
     # The remainder of the function (merging IDs back, error handling,
     # final JSON) is identical to before
     # ----------------------------------------------------------------
-    out_questions = []
-    for original_q, fut in jobs:
-        merged_q = {
-            "question_number": original_q["question_number"],
-            "sub_questions": []
+    out_questions = [
+        merge_question_result(original_q, lambda fut=fut: fut.result(timeout=QUESTION_TIMEOUT_S))
+        for original_q, fut in jobs
+    ]
+
+    final_payload = {"questions": out_questions}
+    _log_request_stats(uploads)
+
+
+    return (
+        json.dumps(final_payload, ensure_ascii=False),
+        200,
+        {**headers, 'Content-Type': 'application/json; charset=utf-8'}
+    )
+
+
+
+# ----------------- (3)  cohort batch entry point ------------------
+class _SharedDownloads:
+    """Downloads each URL once per batch; concurrent requests for the same URL wait for it."""
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.requested = 0
+
+    def __call__(self, url):
+        with self._lock:
+            self.requested += 1
+            fut = self._futures.get(url)
+            owner = fut is None
+            if owner:
+                fut = concurrent.futures.Future()
+                self._futures[url] = fut
+        if owner:
+            fut.set_result(_download_image(url))
+        return fut.result()
+
+    @property
+    def downloaded(self):
+        return len(self._futures)
+
+
+def _student_question(exam_question, answers_by_sq):
+    """The exam question with one student's answers filled in, shaped like grading.js sends it."""
+    question = json.loads(json.dumps(exam_question))  # deep copy
+    for sq in question.get('sub_questions', []):
+        answer = answers_by_sq.get(sq.get('id'))
+        sq['student_answers'] = [answer] if answer else []
+    return question
+
+
+@functions_framework.http
+@tracing.traced_request("generate-points-batch")
+@usage.metered_request("generate-points-batch")
+def generate_points_batch(request):
+    """
+    Grades a whole cohort for one exam in a single request.
+
+    JSON body (or form field "batch_data"):
+      {
+        "exam_id": "...", "teacher_id": "...",   (optional, label the LLM usage)
+        "grading_regulations": "...",
+        "questions": [ ...exam questions as in grading_data, without student_answers... ],
+        "students": [
+          {"student_exam_id": "...",
+           "answers": [{"id", "sub_question_id", "answer_text", "answer_visual"}, ...]},
+          ...
+        ]
+      }
+
+    The exam data is sent once, images are downloaded once per URL for the whole batch,
+    and every (student, question) job runs on one pool of GRADING_BATCH_WORKERS threads.
+    Returns {"students": [{"student_exam_id", "questions": [...]}], "stats": {...}} where each
+    student's "questions" has the same shape as the generate_points response and
+    stats["usage"] is the batch's LLM usage (see usage.py).
+    """
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST,OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
         }
-        try:
-            gemini_result_q = fut.result(timeout=300)
-            # --- MODIFICATION START ---
-            # Build the map using the stable sub_question_id
-            gemini_sq_map = {
-                sq.get('sub_question_id'): sq
-                for sq in gemini_result_q.get('sub_questions', [])
-                if sq.get('sub_question_id') # Only include if ID is present
-            }
+        return ('', 204, headers)
+
+    headers = {'Access-Control-Allow-Origin': '*'}
+
+    if request.method != 'POST':
+        return ('Only POST is allowed', 405, headers)
+
+    try:
+        if 'batch_data' in request.form:
+            batch = json.loads(request.form['batch_data'])
+        else:
+            batch = request.get_json(force=True)
+    except Exception as e:
+        return (f'Invalid JSON: {e}', 400, headers)
 
-            for original_sq in original_q.get('sub_questions', []):
-                # Look up using the original sub-question's ID
-                graded_sq_data = gemini_sq_map.get(original_sq.get('id'))
-                
-                final_sq_data = {
-                    "sub_question_id": original_sq.get('id'),
-                    "sub_q_text_content": original_sq.get('sub_q_text_content')
+    if not isinstance(batch, dict) or not isinstance(batch.get('questions'), list) \
+            or not isinstance(batch.get('students'), list):
+        return ('Body must contain "questions" and "students" lists', 400, headers)
+
+    usage.label(exam_id=batch.get('exam_id'), teacher_id=batch.get('teacher_id'))
+    grading_rules = batch.get('grading_regulations')
+    exam_questions = batch['questions']
+    students = batch['students']
+    downloads = _SharedDownloads()
+    started = time.monotonic()
+
+    jobs = []  # (student_index, original_question, future)
+    ex = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS)
+    try:
+        # Question-major order: the first job of each question creates its context cache
+        # entry and later students' jobs for that question find it ready.
+        for exam_question in exam_questions:
+            for student_index, student in enumerate(students):
+                answers_by_sq = {
+                    answer.get('sub_question_id'): {k: v for k, v in answer.items() if k != 'sub_question_id'}
+                    for answer in student.get('answers', [])
                 }
+                original_question = _student_question(exam_question, answers_by_sq)
+                single_json_for_ai, image_urls = prepare_question(original_question)
+                fut = ex.submit(tracing.bind(grade_question), single_json_for_ai, grading_rules, image_urls, downloads)
+                jobs.append((student_index, original_question, fut))
 
-                # Check if the lookup was successful and if it has the answers
-                if graded_sq_data and graded_sq_data.get('student_answers'):
-                    final_sq_data["student_answers"] = graded_sq_data['student_answers']
-                else:
-                    # The failure path remains the same
-                    final_sq_data["student_answers"] = {
-                        "sub_points_awarded": 0,
-                        "feedback_comment": (
-                            f"ERROR: AI failed to grade this sub-question "
-                            f"(ID: {original_sq.get('id')})."
-                        )
-                    }
-                merged_q["sub_questions"].append(final_sq_data)
-            # --- MODIFICATION END ---
-
-        except Exception as e:
-            print(f"ERROR processing question {original_q['question_number']}: {e}")
-            for original_sq in original_q.get('sub_questions', []):
-                merged_q["sub_questions"].append({
-                    "sub_question_id": original_sq.get('id'),
-                    "sub_q_text_content": original_sq.get('sub_q_text_content'),
-                    "student_answers": {
-                        "sub_points_awarded": 0,
-                        "feedback_comment": (
-                            "ERROR: AI processing failed for the entire question "
-                            f"(ID: {original_sq.get('id')})."
-                        )
-                    }
-                })
-        out_questions.append(merged_q)
+        concurrent.futures.wait([fut for _, _, fut in jobs], timeout=BATCH_TIMEOUT_S)
+    finally:
+        # At the timeout queued jobs are cancelled (and reported as timed out); running ones
+        # are waited for, so no job is still recording LLM usage when the ledger is finished.
+        ex.shutdown(wait=True, cancel_futures=True)
 
-    final_payload = {"questions": out_questions}
+    results = [{"student_exam_id": s.get('student_exam_id'), "questions": []} for s in students]
+    failed_jobs = 0
+
+    def job_result(fut):
+        if fut.cancelled() or not fut.done():
+            raise TimeoutError("batch timeout reached before this question was graded")
+        return fut.result()
+
+    for student_index, original_question, fut in jobs:
+        if not fut.done() or fut.cancelled() or fut.exception() is not None:
+            failed_jobs += 1
+        results[student_index]["questions"].append(
+            merge_question_result(original_question, lambda fut=fut: job_result(fut))
+        )
 
+    stats = {
+        "students": len(students),
+        "questions": len(exam_questions),
+        "jobs": len(jobs),
+        "failed_jobs": failed_jobs,
+        "workers": BATCH_MAX_WORKERS,
+        "image_requests": downloads.requested,
+        "images_downloaded": downloads.downloaded,
+        "seconds": round(time.monotonic() - started, 1),
+        "context_cache": CONTEXT_CACHE.snapshot(),
+        "image_cache": IMAGE_CACHE.snapshot(),
+        "mcq": mcq_grader.stats(),
+        "answer_cache": ANSWER_CACHE.snapshot(),
+        "usage": usage.summary(),
+    }
+    print(f"Batch graded: {stats}")
 
     return (
-        json.dumps(final_payload, ensure_ascii=False),
+        json.dumps({"students": results, "stats": stats}, ensure_ascii=False),
         200,
         {**headers, 'Content-Type': 'application/json; charset=utf-8'}
     )
+
+
+
+# ----------------- (4)  asyncio entry point -----------------------
+class _AsyncDownloads:
+    """
+    One download task per URL on a shared httpx.AsyncClient, started as soon as the URL is
+    known. Also callable as GradingRequest's `download`: on the event loop it returns the
+    bytes of an already awaited URL, from worker threads (context cache creation) it waits.
+    """
+
+    def __init__(self, http, uploads=None):
+        self._http = http
+        self._uploads = uploads
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._tasks = {}
+        self.failed = 0
+
+    def start(self, url):
+        task = self._tasks.get(url)
+        if task is None:
+            task = self._tasks[url] = asyncio.ensure_future(self._fetch(url))
+        return task
+
+    async def _fetch(self, url):
+        data = self._uploads.lookup(url) if self._uploads is not None else None
+        if data is not None:
+            return data
+        data = await IMAGE_CACHE.get_async(url, self._http_fetch)
+        if data is None:
+            self.failed += 1
+        return data
+
+    async def _http_fetch(self, url, headers):
+        with tracing.span("image.fetch", url=url) as fetch_span:
+            async with self._http.stream("GET", url, headers=headers) as resp:
+                fetch_span.set(**{"http.status_code": resp.status_code})
+                if resp.status_code == 304:
+                    return 304, resp.headers, b""
+                resp.raise_for_status()
+                body = bytearray()
+                async for chunk in resp.aiter_bytes():
+                    body += chunk
+                    if len(body) > image_cache.MAX_DOWNLOAD_BYTES:
+                        raise image_cache.ImageTooLarge(f"more than {image_cache.MAX_DOWNLOAD_BYTES} bytes")
+                fetch_span.set(bytes=len(body))
+                return resp.status_code, resp.headers, bytes(body)
+
+    async def fetch(self, url):
+        return await self.start(url)
+
+    async def wait(self, urls):
+        await asyncio.gather(*(self.start(url) for url in urls))
+
+    def __call__(self, url):
+        if threading.get_ident() != self._loop_thread:
+            return asyncio.run_coroutine_threadsafe(self.fetch(url), self._loop).result()
+        task = self._tasks.get(url)
+        return task.result() if task is not None and task.done() else None
+
+    @property
+    def downloaded(self):
+        return len(self._tasks)
+
+
+async def _grade_question_async(req, downloads, gemini, timing):
+    """
+    Grades one question as soon as its own student images are in, on `gemini`, this
+    event loop's async client. Exam visuals are only awaited when the context cache has
+    to be created or the request goes uncached.
+    Adds the time spent waiting on downloads, the context cache and Gemini to `timing`.
+    """
+    def lap(key, since):
+        now = time.monotonic()
+        timing[key] = round(timing[key] + now - since, 3)
+        return now
+
+    t = time.monotonic()
+    await downloads.wait(req.answer_image_urls + req.extra_image_urls)
+    t = lap("download_wait_s", t)
+    student_parts = req.student_parts()
+
+    with tracing.span("context_cache") as cache_span:
+        cache_name = await asyncio.to_thread(req.context_cache_name)
+        cache_span.set(cached=bool(cache_name))
+    t = lap("context_cache_s", t)
+
+    if cache_name:
+        try:
+            call = req.cached_call(cache_name, student_parts)
+            with tracing.span("llm.gemini", task="grade", model=GEMINI_MODEL, cached=True), \
+                    usage.call("gemini", GEMINI_MODEL, "grade", images=_image_count(call)) as metered:
+                resp = await gemini.models.generate_content(**call)
+                metered.record(resp)
+            lap("model_s", t)
+            return json.loads(resp.text)
+        except json.JSONDecodeError:
+            raise
+        except Exception as exc:
+            print(f"[WARN] cached request failed for {cache_name}, retrying uncached: {exc}")
+            CONTEXT_CACHE.forget(cache_name)
+        t = lap("model_s", t)
+
+    await downloads.wait(req.exam_image_urls)
+    t = lap("download_wait_s", t)
+    call = req.uncached_call(student_parts)
+    with tracing.span("llm.gemini", task="grade", model=GEMINI_MODEL, cached=False), \
+            usage.call("gemini", GEMINI_MODEL, "grade", images=_image_count(call)) as metered:
+        resp = await gemini.models.generate_content(**call)
+        metered.record(resp)
+    lap("model_s", t)
+    return json.loads(resp.text)
+
+
+def _unwrap(result):
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+async def _grade_questions_async(questions, grading_rules, files=None, big_json=None):
+    """
+    Returns (merged questions, timing report, per-question timings) for one student's
+    grading_data. Images found in `files` (the request's uploads) are not downloaded.
+    """
+    started = time.monotonic()
+    limits = httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS)
+    # Both clients belong to this request's event loop (asyncio.run) and close with it.
+    async with httpx.AsyncClient(limits=limits, timeout=IMAGE_TIMEOUT_S, follow_redirects=True) as http, \
+            llm_clients.gemini_async_client(GEMINI_API_KEY) as gemini:
+        question_inputs = [(q, *prepare_question(q)) for q in questions]
+        uploads = None
+        if files:
+            uploads = _UploadedImages(files, _referenced_urls(big_json or {"questions": questions}, question_inputs))
+        downloads = _AsyncDownloads(http, uploads)
+
+        # Start every download before the first Gemini call so they all overlap.
+        prepared = []
+        for original_question, single_json_for_ai, image_urls in question_inputs:
+            question = single_json_for_ai["questions"][0]
+            graded, lookup = _pre_grade(question, grading_rules, image_urls)
+            keep = set(_skip_ids(question, set(graded) | set(lookup.waiting)))
+            req = None  # None: nothing left for Gemini, no call needed
+            if keep:
+                req = GradingRequest(single_json_for_ai, grading_rules, image_urls, downloads, _skip_ids(question, keep))
+                for url in req.image_urls:
+                    downloads.start(url)
+            timing = {"question_number": original_question.get("question_number"),
+                      "download_wait_s": 0.0, "context_cache_s": 0.0, "model_s": 0.0}
+            prepared.append((original_question, single_json_for_ai, image_urls, graded, lookup, req, timing))
+
+        async def run(single_json_for_ai, image_urls, graded, lookup, req, timing):
+            question = single_json_for_ai["questions"][0]
+            with tracing.span("question", question_number=question.get("question_number"), pre_graded=len(graded),
+                              waiting=len(lookup.waiting)):
+                return await grade(question, single_json_for_ai, image_urls, graded, lookup, req, timing)
+
+        async def grade(question, single_json_for_ai, image_urls, graded, lookup, req, timing):
+            try:
+                result = None
+                try:
+                    if req is not None:
+                        result = await asyncio.wait_for(_grade_question_async(req, downloads, gemini, timing),
+                                                        QUESTION_TIMEOUT_S)
+                finally:
+                    lookup.publish(result)
+                if lookup.waiting:
+                    # Answers another request was grading at the same time; grade them here if that failed.
+                    graded.update(await asyncio.to_thread(lookup.wait))
+                    retry = [sq_id for sq_id in lookup.waiting if sq_id not in graded]
+                    if retry:
+                        retry_req = GradingRequest(single_json_for_ai, grading_rules, image_urls, downloads,
+                                                   _skip_ids(question, set(retry)))
+                        result = _combine_results(result, await asyncio.wait_for(
+                            _grade_question_async(retry_req, downloads, gemini, timing), QUESTION_TIMEOUT_S))
+                return mcq_grader.merge(question, result, graded)
+            finally:
+                timing["finished_s"] = round(time.monotonic() - started, 3)
+
+        results = await asyncio.gather(*(run(*args) for _, *args in prepared),
+                                       return_exceptions=True)
+
+    out_questions = [
+        merge_question_result(original_q, lambda result=result: _unwrap(result))
+        for (original_q, *_), result in zip(prepared, results)
+    ]
+
+    timings = [timing for *_, timing in prepared]
+    critical = max(timings, key=lambda t: t["finished_s"], default=None)
+    report = {
+        "wall_s": round(time.monotonic() - started, 3),
+        "questions": len(timings),
+        "images": downloads.downloaded,
+        "images_failed": downloads.failed,
+        "uploads": uploads.stats if uploads is not None else None,
+        # The question that finished last bounds the response time; split its time.
+        "critical_path": critical and {
+            "question_number": critical["question_number"],
+            "download_wait_s": critical["download_wait_s"],
+            "context_cache_s": critical["context_cache_s"],
+            "model_s": critical["model_s"],
+        },
+    }
+    return out_questions, report, timings
+
+
+@functions_framework.http
+@tracing.traced_request("generate-points-async")
+@usage.metered_request("generate-points-async")
+def generate_points_async(request):
+    """
+    Same request and response as generate_points, run on asyncio: all images are fetched
+    concurrently with one pooled httpx.AsyncClient and each question's Gemini call starts
+    as soon as its own images have arrived, overlapping with the remaining downloads.
+    The critical-path split (download wait vs. context cache vs. model) is logged and
+    returned in the X-Timing-Report header.
+    """
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST,OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {'Access-Control-Allow-Origin': '*',
+               'Access-Control-Expose-Headers': 'X-Timing-Report'}
+
+    if request.method != 'POST':
+        return ('Only POST is allowed', 405, headers)
+
+    if 'grading_data' not in request.form:
+        return ('grading_data field missing', 400, headers)
+
+    try:
+        big_json = json.loads(request.form['grading_data'])
+    except Exception as e:
+        return (f'Invalid JSON: {e}', 400, headers)
+
+    out_questions, report, timings = asyncio.run(
+        _grade_questions_async(big_json.get('questions', []), big_json.get('grading_regulations'),
+                               request.files, big_json)
+    )
+
+    print(f"Timing report: {report}")
+    print(f"Per-question timings: {timings}")
+    print(f"MCQ grading: {mcq_grader.stats()}")
+    print(f"Answer cache: {ANSWER_CACHE.snapshot()}")
+    print(f"LLM client reuse: {llm_clients.stats()}")
+    print(f"Context cache: {CONTEXT_CACHE.snapshot()}")
+    print(f"Image cache: {IMAGE_CACHE.snapshot()}")
+
+    return (
+        json.dumps({"questions": out_questions}, ensure_ascii=False),
+        200,
+        {**headers,
+         'Content-Type': 'application/json; charset=utf-8',
+         'X-Timing-Report': json.dumps(report)}
+    )
@@ -0,0 +1,158 @@
+"""
+Deterministic grading of multiple-choice sub-questions, so they skip Gemini.
+
+A sub-question is graded locally only when nothing about it needs judgement:
+  - it has mcq_options and every model alternative is a single component that names
+    exactly one option (by letter, or by the option's exact text),
+  - no alternative carries an extra_comment and the question has none either,
+  - the student answered in text only (no answer_visual) and the answer names exactly
+    one option after normalization ("B", "b)", "(B)", "b.", "Answer: B", or the
+    option's text), or left it empty.
+A correct choice earns the matching alternative's component_points (capped at
+max_sub_points), anything else earns 0. Every other sub-question is left for the LLM.
+
+Feedback is language-neutral ("✓ B", "✗ C → B", "– → B"), since the LLM writes its
+feedback in the exam's language and this module does not know it.
+
+Configuration:
+  MCQ_LOCAL_GRADING  1 (default) | 0
+"""
+import os
+import re
+import threading
+
+LOCAL_GRADING_ENABLED = os.environ.get("MCQ_LOCAL_GRADING", "1").strip().lower() not in ("0", "false", "no", "off")
+
+_PREFIX_RE = re.compile(r"^(?:answer|antwoord|option|optie|choice|keuze)\s*[:\-]?\s*", re.IGNORECASE)
+_LETTER_RE = re.compile(r"^[\(\[]?\s*([a-z])\s*[\)\]\.:]?$", re.IGNORECASE)
+
+_stats = {"graded_locally": 0, "forwarded": 0, "questions_skipped": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _normalize_text(text):
+    return " ".join(str(text).split()).strip(" .;").lower()
+
+
+def _choice(text, options):
+    """The option letter `text` names, or None when it names none or several."""
+    if text is None:
+        return None
+    cleaned = _PREFIX_RE.sub("", str(text).strip()).strip()
+    match = _LETTER_RE.match(cleaned)
+    if match and match.group(1).lower() in options:
+        return match.group(1).lower()
+    by_content = [letter for letter, content in options.items() if content and content == _normalize_text(cleaned)]
+    return by_content[0] if len(by_content) == 1 else None
+
+
+def _options(sub_question):
+    options = {}
+    for option in sub_question.get("mcq_options") or []:
+        letter = str(option.get("mcq_letter") or "").strip().lower()
+        if len(letter) != 1:
+            return None
+        options[letter] = _normalize_text(option.get("mcq_content") or "")
+    return options or None
+
+
+def _answer_key(sub_question, options):
+    """{letter: points} from the model alternatives, or None if any alternative needs judgement."""
+    key = {}
+    alternatives = sub_question.get("model_alternatives") or []
+    if not alternatives:
+        return None
+    max_points = sub_question.get("max_sub_points")
+    for alternative in alternatives:
+        components = alternative.get("model_components") or []
+        if alternative.get("extra_comment") or len(components) != 1:
+            return None
+        component = components[0]
+        if component.get("component_visual"):
+            return None
+        letter = _choice(component.get("component_text"), options)
+        points = component.get("component_points")
+        if points is None:
+            points = max_points
+        if letter is None or points is None:
+            return None
+        if max_points is not None:
+            points = min(points, max_points)
+        key[letter] = max(key.get(letter, 0), points)
+    return key
+
+
+def grade_sub_question(sub_question):
+    """{"sub_points_awarded", "feedback_comment"} or None when the LLM has to grade it."""
+    options = _options(sub_question)
+    if options is None:
+        return None
+    key = _answer_key(sub_question, options)
+    if key is None:
+        return None
+
+    answers = sub_question.get("student_answers") or []
+    answer = answers[0] if answers else {}
+    if answer.get("answer_visual"):
+        return None
+    text = answer.get("answer_text")
+    correct = ", ".join(letter.upper() for letter in sorted(key))
+    if text is None or not str(text).strip():
+        return {"sub_points_awarded": 0, "feedback_comment": f"– → {correct}"}
+
+    letter = _choice(text, options)
+    if letter is None:
+        return None
+    if letter in key:
+        return {"sub_points_awarded": key[letter], "feedback_comment": f"✓ {letter.upper()}"}
+    return {"sub_points_awarded": 0, "feedback_comment": f"✗ {letter.upper()} → {correct}"}
+
+
+def grade_question(question_for_ai):
+    """
+    {sub_question_id: student_answers} for the sub-questions of one question (as sent to
+    Gemini, with 'sub_question_id') that can be graded locally.
+    """
+    if not LOCAL_GRADING_ENABLED or question_for_ai.get("extra_comment"):
+        return {}
+    graded = {}
+    mcq_forwarded = 0
+    for sq in question_for_ai.get("sub_questions", []):
+        result = grade_sub_question(sq) if sq.get("mcq_options") else None
+        if result is not None:
+            graded[sq.get("sub_question_id")] = result
+        elif sq.get("mcq_options"):
+            mcq_forwarded += 1
+    _count("graded_locally", len(graded))
+    _count("forwarded", mcq_forwarded)
+    if graded and len(graded) == len(question_for_ai.get("sub_questions", [])):
+        _count("questions_skipped")
+    return graded
+
+
+def merge(question_for_ai, llm_result, local):
+    """The LLM's result for one question with the locally graded sub-questions filled in."""
+    sub_questions = [
+        sq for sq in (llm_result or {}).get("sub_questions", [])
+        if sq.get("sub_question_id") not in local
+    ]
+    for sq in question_for_ai.get("sub_questions", []):
+        sq_id = sq.get("sub_question_id")
+        if sq_id in local:
+            sub_questions.append({
+                "sub_question_id": sq_id,
+                "sub_q_text_content": sq.get("sub_q_text_content"),
+                "student_answers": local[sq_id],
+            })
+    return {**(llm_result or {"question_number": question_for_ai.get("question_number")}),
+            "sub_questions": sub_questions}
@@ -0,0 +1,205 @@
+import threading
+
+import answer_cache
+
+RULES = "Award full points for the right unit."
+
+
+def _question(*answers, question_text="What is the speed of light?"):
+    return {
+        "question_number": "1",
+        "question_text": question_text,
+        "sub_questions": [
+            {
+                "sub_question_id": f"sq{i}",
+                "sub_q_text_content": "In m/s",
+                "max_sub_points": 2,
+                "student_answers": [answer if isinstance(answer, dict) else {"answer_text": answer}],
+            }
+            for i, answer in enumerate(answers, start=1)
+        ],
+    }
+
+
+def _result(points=2, feedback="Correct."):
+    return {"sub_points_awarded": points, "feedback_comment": feedback}
+
+
+def _llm_result(**by_id):
+    return {"sub_questions": [{"sub_question_id": sq_id, "student_answers": r} for sq_id, r in by_id.items()]}
+
+
+def test_normalize_answer():
+    assert answer_cache.normalize_answer("  3 × 10⁸\n m/s ") == "3 × 108 m/s"
+    assert answer_cache.normalize_answer("ｍ/s") == "m/s"
+    assert answer_cache.normalize_answer("KM") != answer_cache.normalize_answer("km")
+    assert answer_cache.normalize_answer(None) == ""
+
+
+def test_answer_key():
+    question = _question("3e8", " 3e8 ", "3E8")
+    sq1, sq2, sq3 = question["sub_questions"]
+    assert answer_cache.answer_key(RULES, question, sq1) == answer_cache.answer_key(RULES, question, sq2)
+    assert answer_cache.answer_key(RULES, question, sq1) != answer_cache.answer_key(RULES, question, sq3)
+    assert answer_cache.answer_key(RULES, question, sq1) != answer_cache.answer_key("Other rules", question, sq1)
+    other_question = _question("3e8", question_text="What is the speed of sound?")
+    assert (answer_cache.answer_key(RULES, question, sq1)
+            != answer_cache.answer_key(RULES, other_question, other_question["sub_questions"][0]))
+
+
+def test_answer_key_includes_sibling_answers():
+    question = _question("3e8", "1.5e8")
+    other_student = _question("3e8", "2e8")
+    key = answer_cache.answer_key(RULES, question, question["sub_questions"][1])
+    assert key != answer_cache.answer_key(RULES, other_student, other_student["sub_questions"][1])
+    # Follow-through: even the identical first answer is graded in the context of the second.
+    assert (answer_cache.answer_key(RULES, question, question["sub_questions"][0])
+            != answer_cache.answer_key(RULES, other_student, other_student["sub_questions"][0]))
+    assert (answer_cache.answer_key(RULES, question, question["sub_questions"][0], "sub_question")
+            == answer_cache.answer_key(RULES, other_student, other_student["sub_questions"][0], "sub_question"))
+
+
+def test_sibling_with_visual_is_not_cached():
+    question = _question("3e8", {"answer_text": "see sketch", "answer_visual": "https://example.com/a.png"})
+    assert answer_cache.answer_key(RULES, question, question["sub_questions"][0]) is None
+    assert answer_cache.answer_key(RULES, question, question["sub_questions"][0], "sub_question") is not None
+
+
+def test_sub_question_scope_shares_results_across_siblings():
+    cache = answer_cache.AnswerCache(enabled=True, scope="sub_question")
+    cache.lookup(_question("3e8", "1.5e8"), RULES).publish(_llm_result(sq1=_result(), sq2=_result(0, "Wrong.")))
+    assert cache.lookup(_question("3e8", "2e8"), RULES).hits == {"sq1": _result()}
+    question_scope = answer_cache.AnswerCache(enabled=True)
+    question_scope.lookup(_question("3e8", "1.5e8"), RULES).publish(_llm_result(sq1=_result(), sq2=_result()))
+    assert question_scope.lookup(_question("3e8", "2e8"), RULES).hits == {}
+
+
+def test_answer_with_visual_is_not_cached():
+    cache = answer_cache.AnswerCache(enabled=True)
+    question = _question({"answer_text": "3e8", "answer_visual": "https://example.com/a.png"})
+    assert answer_cache.answer_key(RULES, question, question["sub_questions"][0]) is None
+    lookup = cache.lookup(question, RULES)
+    assert (lookup.hits, lookup.owned, lookup.waiting) == ({}, {}, {})
+    assert cache.snapshot()["uncacheable"] == 1
+
+
+def test_disabled_cache_looks_nothing_up():
+    lookup = answer_cache.AnswerCache(enabled=False).lookup(_question("3e8"), RULES)
+    assert (lookup.hits, lookup.owned, lookup.waiting) == ({}, {}, {})
+
+
+def test_published_result_is_a_hit_for_the_next_student():
+    cache = answer_cache.AnswerCache(enabled=True)
+    first = cache.lookup(_question("3e8"), RULES)
+    assert list(first.owned) == ["sq1"]
+    first.publish(_llm_result(sq1=_result()))
+
+    second = cache.lookup(_question(" 3e8"), RULES)
+    assert second.hits == {"sq1": _result()}
+    assert (second.owned, second.waiting) == ({}, {})
+    snapshot = cache.snapshot()
+    assert (snapshot["hits"], snapshot["misses"], snapshot["stored"], snapshot["entries"]) == (1, 1, 1, 1)
+    assert snapshot["per_sub_question"]["sq1"] == {"hits": 1, "lookups": 2, "hit_rate": 0.5}
+
+
+def test_skip_leaves_sub_questions_out():
+    cache = answer_cache.AnswerCache(enabled=True)
+    lookup = cache.lookup(_question("3e8", "c"), RULES, skip={"sq1"})
+    assert list(lookup.owned) == ["sq2"]
+
+
+def test_identical_answers_in_one_question_wait_for_the_first():
+    cache = answer_cache.AnswerCache(enabled=True)
+    lookup = cache.lookup(_question("3e8", "3e8"), RULES)
+    assert list(lookup.owned) == ["sq1"] and list(lookup.waiting) == ["sq2"]
+    lookup.publish(_llm_result(sq1=_result()))
+    assert lookup.wait(timeout=0) == {"sq2": _result()}
+
+
+def test_single_flight_waiter_gets_the_published_result():
+    cache = answer_cache.AnswerCache(enabled=True)
+    owner = cache.lookup(_question("3e8"), RULES)
+    waiter = cache.lookup(_question("3e8"), RULES)
+    assert list(owner.owned) == ["sq1"]
+    assert list(waiter.waiting) == ["sq1"] and waiter.owned == {}
+
+    results = {}
+    started = threading.Event()
+
+    def wait():
+        started.set()
+        results.update(waiter.wait(timeout=5))
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    started.wait()
+    thread.join(0.1)
+    assert thread.is_alive(), "the waiter must block until the owner publishes"
+
+    owner.publish(_llm_result(sq1=_result()))
+    thread.join(5)
+    assert not thread.is_alive()
+    assert results == {"sq1": _result()}
+    assert cache.snapshot()["waited"] == 1
+
+
+def test_single_flight_many_concurrent_requests_grade_once():
+    cache = answer_cache.AnswerCache(enabled=True)
+    barrier = threading.Barrier(8)
+    graded = []
+    results = []
+    lock = threading.Lock()
+
+    def request():
+        barrier.wait()
+        lookup = cache.lookup(_question("3e8"), RULES)
+        found = dict(lookup.hits)
+        if lookup.owned:
+            with lock:
+                graded.append(1)
+            found["sq1"] = _result()
+            lookup.publish(_llm_result(**found))
+        found.update(lookup.wait(timeout=5))
+        with lock:
+            results.append(found)
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(graded) == 1
+    assert results == [{"sq1": _result()}] * 8
+
+
+def test_failed_grading_releases_waiters_and_is_not_stored():
+    cache = answer_cache.AnswerCache(enabled=True)
+    owner = cache.lookup(_question("3e8"), RULES)
+    waiter = cache.lookup(_question("3e8"), RULES)
+    owner.publish(_llm_result(sq1=_result(feedback="ERROR: grading failed")))
+    assert waiter.wait(timeout=5) == {}
+    assert cache.snapshot()["wait_failed"] == 1
+
+    retry = cache.lookup(_question("3e8"), RULES)
+    assert list(retry.owned) == ["sq1"]
+    retry.publish(None)
+    assert list(cache.lookup(_question("3e8"), RULES).owned) == ["sq1"]
+    assert cache.snapshot()["stored"] == 0
+
+
+def test_wait_times_out_while_owner_is_still_grading():
+    cache = answer_cache.AnswerCache(enabled=True)
+    cache.lookup(_question("3e8"), RULES)
+    waiter = cache.lookup(_question("3e8"), RULES)
+    assert waiter.wait(timeout=0.01) == {}
+
+
+def test_lru_eviction():
+    cache = answer_cache.AnswerCache(enabled=True, max_entries=2)
+    for answer in ("a", "b"):
+        cache.lookup(_question(answer), RULES).publish(_llm_result(sq1=_result()))
+    assert cache.lookup(_question("a"), RULES).hits  # "a" becomes most recently used
+    cache.lookup(_question("c"), RULES).publish(_llm_result(sq1=_result()))
+    assert cache.lookup(_question("a"), RULES).hits
+    assert cache.lookup(_question("b"), RULES).owned
+    assert cache.snapshot()["entries"] == 2
@@ -0,0 +1,78 @@
+import datetime
+import types as pytypes
+
+from google.genai import errors
+
+import context_cache
+
+
+class FakeCaches:
+    def __init__(self, create_error=None):
+        self.create_error = create_error
+        self.created = []
+        self.deleted = []
+
+    def list(self, config=None):
+        return iter(())
+
+    def create(self, model, config):
+        self.created.append(config.display_name)
+        if self.create_error is not None:
+            raise self.create_error
+        expire_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        return pytypes.SimpleNamespace(name=f"cachedContents/{len(self.created)}", expire_time=expire_time)
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+
+def _cache(caches, **kwargs):
+    client = pytypes.SimpleNamespace(caches=caches)
+    return context_cache.GradingContextCache(lambda: client, enabled=True, **kwargs)
+
+
+def _get(cache, question, scope=None):
+    return cache.get("gemini-2.5-flash", "rules", {"question": question}, scope or question, lambda: [])
+
+
+def test_entry_is_reused():
+    caches = FakeCaches()
+    cache = _cache(caches)
+    assert _get(cache, "q1") == _get(cache, "q1") == "cachedContents/1"
+    assert len(caches.created) == 1
+    assert cache.snapshot()["hits"] == 1
+
+
+def test_undersized_prefix_is_not_retried():
+    too_small = errors.ClientError(400, {"error": {"code": 400, "message": "Cached content is too small",
+                                                   "status": "INVALID_ARGUMENT"}})
+    caches = FakeCaches(create_error=too_small)
+    cache = _cache(caches, ttl_seconds=0)
+    assert [_get(cache, "q1") for _ in range(3)] == [None, None, None]
+    assert len(caches.created) == 1
+
+
+def test_other_failures_are_retried_after_the_ttl():
+    caches = FakeCaches(create_error=RuntimeError("connection reset"))
+    cache = _cache(caches, ttl_seconds=0)
+    assert [_get(cache, "q1") for _ in range(2)] == [None, None]
+    assert len(caches.created) == 2
+
+
+def test_entries_and_scopes_are_bounded():
+    caches = FakeCaches()
+    cache = _cache(caches, max_entries=2)
+    for question in ("q1", "q2", "q3"):
+        _get(cache, question)
+    assert cache.snapshot()["entries"] == 2
+    assert len(cache._scope_keys) == 2
+    _get(cache, "q1")  # evicted, so created again
+    assert len(caches.created) == 4
+
+
+def test_edited_question_deletes_superseded_entry():
+    caches = FakeCaches()
+    cache = _cache(caches)
+    first = _get(cache, "q1 v1", scope="q1")
+    _get(cache, "q1 v2", scope="q1")
+    assert caches.deleted == [first]
@@ -0,0 +1,112 @@
+import pytest
+
+import mcq_grader
+
+OPTIONS = {"a": "paris", "b": "london", "c": "berlin"}
+
+
+def _sub_question(answer_text=None, *, correct="B", points=2, max_points=2, answer_visual=None,
+                  extra_comment=None, components=None):
+    if components is None:
+        components = [{"component_text": correct, "component_points": points}]
+    answer = {"answer_text": answer_text}
+    if answer_visual:
+        answer["answer_visual"] = answer_visual
+    return {
+        "sub_question_id": "sq1",
+        "max_sub_points": max_points,
+        "mcq_options": [
+            {"mcq_letter": "A", "mcq_content": "Paris"},
+            {"mcq_letter": "B", "mcq_content": "London"},
+            {"mcq_letter": "C", "mcq_content": "Berlin"},
+        ],
+        "model_alternatives": [{"model_components": components, "extra_comment": extra_comment}],
+        "student_answers": [answer],
+    }
+
+
+@pytest.mark.parametrize("text", ["B", "b", "b)", "(B)", "[b]", "b.", "B:", " b ", "Answer: B",
+                                  "antwoord - b", "Optie b", "London", "  london. "])
+def test_choice_normalizations(text):
+    assert mcq_grader._choice(text, OPTIONS) == "b"
+
+
+@pytest.mark.parametrize("text", [None, "", "B and C", "B, C", "I think B", "E", "Londen", "b because"])
+def test_choice_names_no_single_option(text):
+    assert mcq_grader._choice(text, OPTIONS) is None
+
+
+def test_choice_ambiguous_content():
+    assert mcq_grader._choice("same", {"a": "same", "b": "same"}) is None
+
+
+def test_correct_answer_earns_points():
+    assert mcq_grader.grade_sub_question(_sub_question("(b)")) == {"sub_points_awarded": 2, "feedback_comment": "✓ B"}
+
+
+def test_correct_answer_by_content():
+    assert mcq_grader.grade_sub_question(_sub_question("London"))["sub_points_awarded"] == 2
+
+
+def test_points_capped_at_max_sub_points():
+    assert mcq_grader.grade_sub_question(_sub_question("B", points=5, max_points=3))["sub_points_awarded"] == 3
+
+
+def test_missing_component_points_default_to_max():
+    assert mcq_grader.grade_sub_question(_sub_question("B", points=None, max_points=4))["sub_points_awarded"] == 4
+
+
+def test_model_alternative_names_option_by_text():
+    assert mcq_grader.grade_sub_question(_sub_question("b", correct="London"))["sub_points_awarded"] == 2
+
+
+def test_incorrect_answer():
+    assert mcq_grader.grade_sub_question(_sub_question("c")) == {"sub_points_awarded": 0, "feedback_comment": "✗ C → B"}
+
+
+@pytest.mark.parametrize("text", [None, "", "   "])
+def test_empty_answer(text):
+    assert mcq_grader.grade_sub_question(_sub_question(text)) == {"sub_points_awarded": 0, "feedback_comment": "– → B"}
+
+
+def test_several_accepted_options():
+    sq = _sub_question("a")
+    sq["model_alternatives"].append({"model_components": [{"component_text": "A", "component_points": 1}]})
+    assert mcq_grader.grade_sub_question(sq) == {"sub_points_awarded": 1, "feedback_comment": "✓ A"}
+    assert mcq_grader.grade_sub_question(_sub_question("c") | {"model_alternatives": sq["model_alternatives"]}) == {
+        "sub_points_awarded": 0, "feedback_comment": "✗ C → A, B"}
+
+
+@pytest.mark.parametrize("sub_question", [
+    _sub_question("B and C"),
+    _sub_question("I think B"),
+    _sub_question("B", answer_visual="https://example.com/answer.png"),
+    _sub_question("B", extra_comment="Also accept C if explained"),
+    _sub_question("B", components=[{"component_text": "B", "component_points": 1},
+                                   {"component_text": "because ...", "component_points": 1}]),
+    _sub_question("B", components=[{"component_text": "B", "component_visual": "https://example.com/b.png"}]),
+    _sub_question("B", correct="Explain why London"),
+    _sub_question("B", points=None, max_points=None),
+    _sub_question("B") | {"mcq_options": []},
+    _sub_question("B") | {"mcq_options": [{"mcq_letter": "i.", "mcq_content": "x"}]},
+    _sub_question("B") | {"model_alternatives": []},
+])
+def test_forwarded_to_llm(sub_question):
+    assert mcq_grader.grade_sub_question(sub_question) is None
+
+
+def test_grade_question_skips_question_with_extra_comment():
+    question = {"extra_comment": "Use the formula sheet", "sub_questions": [_sub_question("B")]}
+    assert mcq_grader.grade_question(question) == {}
+
+
+def test_grade_question_and_merge():
+    forwarded = _sub_question("I think B") | {"sub_question_id": "sq2"}
+    question = {"question_number": "1", "sub_questions": [_sub_question("B"), forwarded]}
+    local = mcq_grader.grade_question(question)
+    assert local == {"sq1": {"sub_points_awarded": 2, "feedback_comment": "✓ B"}}
+
+    llm_result = {"question_number": "1", "sub_questions": [{"sub_question_id": "sq2", "student_answers": "llm"}]}
+    merged = mcq_grader.merge(question, llm_result, local)
+    assert [sq["sub_question_id"] for sq in merged["sub_questions"]] == ["sq2", "sq1"]
+    assert merged["sub_questions"][1]["student_answers"] == local["sq1"]
@@ -0,0 +1,105 @@
+"""
+Compares the two ways consumers can run the image parser on the same documents:
+
+  inprocess  image_parsing.parse_uploads(), results stay in memory
+  http       POST to IMAGE_PARSER_URL, then unzip the response (what call_image_parser +
+             extract_files_from_zip do in the consumer functions)
+
+Usage:
+  python benchmark_parser_modes.py exam.pdf appendix.pdf [--runs 3] [--modes inprocess,http]
+                                   [--url https://...image-parser]
+
+The page cache is disabled for the in-process runs (PAGE_CACHE_BACKEND=none) so every run
+does the real work; make sure the deployed parser is configured the same way when comparing.
+Both modes need the usual API keys; the HTTP mode additionally needs IMAGE_PARSER_URL or --url.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+import zipfile
+
+os.environ.setdefault("PAGE_CACHE_BACKEND", "none")
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def run_inprocess(uploads):
+    import image_parsing
+
+    start = time.perf_counter()
+    result = image_parsing.parse_uploads(uploads)
+    elapsed = time.perf_counter() - start
+    files = list(result.files())
+    return {
+        "seconds": elapsed,
+        "files": len(files),
+        "payload_bytes": sum(len(f.data) for f in files),
+        "transfer_bytes": 0,
+    }
+
+
+def run_http(uploads, url):
+    import requests
+
+    start = time.perf_counter()
+    response = requests.post(
+        url,
+        files=[("files", (name, io.BytesIO(data), "application/octet-stream")) for name, data in uploads],
+        timeout=1000,
+    )
+    response.raise_for_status()
+    body = response.content
+    with zipfile.ZipFile(io.BytesIO(body)) as zf:
+        contents = [zf.read(name) for name in zf.namelist() if name != "parser_manifest.json"]
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "files": len(contents),
+        "payload_bytes": sum(len(c) for c in contents),
+        "transfer_bytes": len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--modes", default="inprocess,http")
+    parser.add_argument("--url", default=os.environ.get("IMAGE_PARSER_URL"))
+    args = parser.parse_args()
+
+    uploads = []
+    for path in args.paths:
+        with open(path, "rb") as f:
+            uploads.append((os.path.basename(path), f.read()))
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    if "http" in modes and not args.url:
+        print("Skipping http mode: no --url and IMAGE_PARSER_URL is not set.")
+        modes.remove("http")
+
+    rss_before = _rss_bytes()
+    for mode in modes:
+        samples = []
+        for run in range(args.runs):
+            sample = run_inprocess(uploads) if mode == "inprocess" else run_http(uploads, args.url)
+            samples.append(sample)
+            print(f"{mode} run {run + 1}: {sample['seconds']:.2f}s, {sample['files']} files, "
+                  f"{sample['payload_bytes']} payload bytes, {sample['transfer_bytes']} bytes over the wire")
+        times = [s["seconds"] for s in samples]
+        print(f"== {mode}: median {statistics.median(times):.2f}s, min {min(times):.2f}s, max {max(times):.2f}s, "
+              f"RSS growth {(_rss_bytes() - rss_before) / 1e6:.1f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""
+Importable image/PDF parser shared by the image-parser Cloud Function and, in
+in-process mode, by the functions that used to call it over HTTP.
+
+    from image_parsing import parse_uploads
+    result = parse_uploads([(filename, file_bytes), ...])
+    for page in result.pages:
+        page.transcription, page.image_files
+
+Each call returns the same files (same names) that the HTTP endpoint puts in its
+ZIP, plus the manifest, without the ZIP/HTTP round trip. Hosts continue their trace
+into the parser with `with image_parsing.tracing.continue_from(headers): ...`; the
+LLM usage of a run is in its manifest under "usage" (see usage.py).
+"""
+from . import tracing
+from . import usage
+from .parser import MANIFEST_FILENAME, ParseRun, parse_uploads, process_single_image
+from .results import PageResult, ParsedFile, ParseResult
+
+__all__ = [
+    "MANIFEST_FILENAME",
+    "PageResult",
+    "ParseResult",
+    "ParseRun",
+    "ParsedFile",
+    "parse_uploads",
+    "process_single_image",
+    "tracing",
+    "usage",
+]
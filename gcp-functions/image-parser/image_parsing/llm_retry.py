@@ -0,0 +1,288 @@
+"""
+Retries, jittered exponential backoff and hedged requests for LLM calls.
+
+`ResilientCaller.submit(provider, fn, *args, counters=...)` runs fn through the
+LLMScheduler and returns a Future for its eventual result:
+
+  - Failures are classified (rate_limited, server, timeout, connection, malformed,
+    transport, client, config, encoding, internal). Transient classes, including
+    unrecognised SDK/transport exceptions, are retried with full-jitter exponential
+    backoff, honouring Retry-After when the provider sends one; client, config,
+    encoding and internal (programming) errors fail immediately.
+  - When hedging is enabled and an attempt has been running longer than the
+    provider's recent latency percentile, one duplicate request is fired and the
+    first successful answer wins.
+
+Backoff waits and hedge checks use timers and future callbacks rather than
+blocking a thread, so a sleeping retry never holds a scheduler worker.
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class LLMConfigError(Exception):
+    """Raised when a call cannot be made at all (e.g. missing API key). Never retried."""
+
+
+class LLMEncodingError(Exception):
+    """Raised when the request payload (e.g. the page image) cannot be encoded. Never retried."""
+
+
+RETRYABLE_CLASSES = {"rate_limited", "server", "timeout", "connection", "malformed", "transport"}
+
+# Bugs in our own code, which a retry cannot fix.
+_INTERNAL_ERRORS = (TypeError, AttributeError, KeyError, IndexError, NameError, AssertionError,
+                    NotImplementedError)
+
+
+def _status_code(exc):
+    for attr in ("status_code", "code", "status"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def classify_error(exc):
+    """Maps an exception from the Gemini or OpenAI-compatible SDKs to an error class."""
+    if isinstance(exc, LLMConfigError):
+        return "config"
+    if isinstance(exc, LLMEncodingError):
+        return "encoding"
+    if isinstance(exc, (json.JSONDecodeError, ValueError)) and not _status_code(exc):
+        return "malformed"
+
+    status = _status_code(exc)
+    if status is not None:
+        if status == 429:
+            return "rate_limited"
+        if status == 408:
+            return "timeout"
+        if status >= 500:
+            return "server"
+        if 400 <= status < 500:
+            return "client"
+
+    # SDK-specific transport errors, matched by name to avoid importing every SDK here.
+    name = type(exc).__name__.lower()
+    if isinstance(exc, TimeoutError) or "timeout" in name:
+        return "timeout"
+    if isinstance(exc, ConnectionError) or "connect" in name or "network" in name or "remoteprotocol" in name:
+        return "connection"
+    if "ratelimit" in name or "resourceexhausted" in name:
+        return "rate_limited"
+    if "servererror" in name or "internalserver" in name or "unavailable" in name:
+        return "server"
+    if isinstance(exc, _INTERNAL_ERRORS):
+        return "internal"
+    # Anything else without a status code (SSL errors, dropped streams, SDK errors that
+    # carry no code) is most likely transient.
+    return "transport"
+
+
+def _retry_after_seconds(exc):
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=20.0, rate_limit_base_delay=2.0,
+                 max_malformed_attempts=2):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limit_base_delay = rate_limit_base_delay
+        self.max_malformed_attempts = max_malformed_attempts
+
+    def should_retry(self, error_class, attempt):
+        """`attempt` is the number of attempts already made."""
+        if error_class not in RETRYABLE_CLASSES:
+            return False
+        if error_class == "malformed":
+            return attempt < self.max_malformed_attempts
+        return attempt < self.max_attempts
+
+    def delay(self, error_class, attempt, exc=None):
+        """Full-jitter exponential backoff; Retry-After wins when it is longer."""
+        base = self.rate_limit_base_delay if error_class == "rate_limited" else self.base_delay
+        delay = random.uniform(0, min(self.max_delay, base * (2 ** (attempt - 1))))
+        retry_after = _retry_after_seconds(exc) if exc is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+class LatencyTracker:
+    """Recent successful call latencies per provider, used for the hedge threshold."""
+
+    def __init__(self, window=200):
+        self._samples = {}
+        self._window = window
+        self._lock = threading.Lock()
+
+    def record(self, provider, seconds):
+        with self._lock:
+            self._samples.setdefault(provider, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, provider, pct, min_samples):
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(pct * len(samples)))]
+
+
+class HedgePolicy:
+    def __init__(self, enabled=False, percentile=0.9, min_samples=20, min_delay=2.0):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+
+
+def new_call_counters():
+    return {"attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "errors": {}, "queue_wait_ms": 0.0}
+
+
+class _ResilientCall:
+    def __init__(self, caller, provider, fn, args, kwargs, counters):
+        self.caller = caller
+        self.provider = provider
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.counters = counters
+        self.result = Future()
+        self.result.set_running_or_notify_cancel()
+        self.lock = threading.Lock()
+        self.attempts_made = 0
+        self.in_flight = 0
+        self.hedged = False
+
+    # -- launching -------------------------------------------------------
+    def launch(self, hedge=False):
+        with self.lock:
+            if self.result.done():
+                return
+            self.in_flight += 1
+            if hedge:
+                self.hedged = True
+                self.counters["hedges"] += 1
+            else:
+                self.attempts_made += 1
+            self.counters["attempts"] += 1
+        future = self.caller.scheduler.submit(self.provider, self.fn, *self.args, **self.kwargs)
+        future.add_done_callback(lambda f: self._on_done(f, hedge))
+        if not hedge:
+            self._arm_hedge_timer(future, self.caller.hedge.min_delay)
+
+    def _arm_hedge_timer(self, future, delay):
+        policy = self.caller.hedge
+        if not policy.enabled or self.hedged:
+            return
+        timer = threading.Timer(delay, self._check_hedge, args=(future,))
+        timer.daemon = True
+        timer.start()
+
+    def _check_hedge(self, future):
+        if future.done() or self.result.done() or self.hedged:
+            return
+        policy = self.caller.hedge
+        threshold = self.caller.latencies.percentile(self.provider, policy.percentile, policy.min_samples)
+        if threshold is None:
+            return
+        threshold = max(threshold, policy.min_delay)
+        started_at = getattr(future, "started_at", None)
+        if started_at is None:
+            # Still queued; hedging now would only add to the same queue.
+            self._arm_hedge_timer(future, threshold)
+            return
+        running_for = time.monotonic() - started_at
+        if running_for < threshold:
+            self._arm_hedge_timer(future, threshold - running_for)
+            return
+        print(f"Hedging slow {self.provider} call (running {running_for:.1f}s, p{int(policy.percentile * 100)}={threshold:.1f}s).")
+        self.launch(hedge=True)
+
+    # -- completion ------------------------------------------------------
+    def _on_done(self, future, hedge):
+        exc = future.exception()
+        with self.lock:
+            self.in_flight -= 1
+            if getattr(future, "queue_wait_s", None) is not None:
+                self.counters["queue_wait_ms"] = round(self.counters["queue_wait_ms"] + 1000 * future.queue_wait_s, 1)
+            if self.result.done():
+                return
+            if exc is None:
+                if hedge:
+                    self.counters["hedge_wins"] += 1
+                started_at = getattr(future, "started_at", None)
+                if started_at is not None:
+                    self.caller.latencies.record(self.provider, time.monotonic() - started_at)
+                self.result.set_result(future.result())
+                return
+
+            error_class = classify_error(exc)
+            self.counters["errors"][error_class] = self.counters["errors"].get(error_class, 0) + 1
+            if self.in_flight > 0:
+                # The other (hedged or primary) attempt may still succeed.
+                return
+            if not self.caller.retry.should_retry(error_class, self.attempts_made):
+                self.result.set_exception(exc)
+                return
+            delay = self.caller.retry.delay(error_class, self.attempts_made, exc)
+            self.counters["retries"] += 1
+        print(f"Retrying {self.provider} call after {error_class} error in {delay:.1f}s: {exc}")
+        timer = threading.Timer(delay, self.launch)
+        timer.daemon = True
+        timer.start()
+
+
+class ResilientCaller:
+    def __init__(self, scheduler, retry=None, hedge=None):
+        self.scheduler = scheduler
+        self.retry = retry or RetryPolicy()
+        self.hedge = hedge or HedgePolicy()
+        self.latencies = LatencyTracker()
+
+    def submit(self, provider, fn, *args, counters=None, **kwargs):
+        """
+        Returns a Future for fn(*args, **kwargs) with retries and optional hedging.
+        `counters` (see new_call_counters) is updated in place for the manifest.
+        """
+        call = _ResilientCall(self, provider, fn, args, kwargs,
+                              counters if counters is not None else new_call_counters())
+        call.launch()
+        return call.result
+
+
+def build_caller_from_env(scheduler):
+    """
+    LLM_RETRY_MAX_ATTEMPTS (default 4), LLM_RETRY_BASE_DELAY (1s), LLM_RETRY_MAX_DELAY (20s),
+    LLM_HEDGE (off by default), LLM_HEDGE_PERCENTILE (0.9), LLM_HEDGE_MIN_SAMPLES (20).
+    """
+    retry = RetryPolicy(
+        max_attempts=int(os.environ.get("LLM_RETRY_MAX_ATTEMPTS", "4")),
+        base_delay=float(os.environ.get("LLM_RETRY_BASE_DELAY", "1.0")),
+        max_delay=float(os.environ.get("LLM_RETRY_MAX_DELAY", "20.0")),
+    )
+    hedge = HedgePolicy(
+        enabled=os.environ.get("LLM_HEDGE", "0").strip().lower() in ("1", "true", "yes", "on"),
+        percentile=float(os.environ.get("LLM_HEDGE_PERCENTILE", "0.9")),
+        min_samples=int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20")),
+    )
+    return ResilientCaller(scheduler, retry=retry, hedge=hedge)
@@ -0,0 +1,361 @@
+"""
+Content-addressed cache for per-page image-parser artifacts.
+
+A page's artifacts (its transcription text and its cropped element PNGs) only
+depend on the rendered page pixels, the models that were called and the prompts
+that were sent. The cache key is therefore a hash over exactly those inputs, so a
+teacher re-uploading the same answer model or appendix skips both LLM calls.
+
+Artifacts are stored per page as a small uncompressed ZIP blob whose entry names
+are relative to the page prefix (e.g. "full_transcription.txt", "graph_1.png").
+
+Backends:
+  - MemoryLRUBackend:   in-process LRU, lives as long as the warm instance.
+  - LocalDiskBackend:   files under /tmp (note: /tmp is memory-backed on Cloud Run).
+  - ObjectStoreBackend: interface for blob stores, with a GCS implementation.
+All backends evict least-recently-used entries once `max_bytes` is exceeded.
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+CACHE_SCHEMA_VERSION = "1"
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_DIR = "/tmp/page-artifact-cache"
+
+
+def page_cache_key(pil_image, model_names, prompts):
+    """
+    Builds the content address for one page: sha256 over the rendered pixels
+    (plus mode and size) combined with the model names and a hash of the prompts.
+    """
+    pixel_hash = hashlib.sha256()
+    pixel_hash.update(f"{pil_image.mode}:{pil_image.size[0]}x{pil_image.size[1]}".encode("utf-8"))
+    pixel_hash.update(pil_image.tobytes())
+
+    prompt_hash = hashlib.sha256()
+    for prompt in prompts:
+        prompt_hash.update(prompt.encode("utf-8"))
+        prompt_hash.update(b"\x00")
+
+    key = hashlib.sha256()
+    key.update(CACHE_SCHEMA_VERSION.encode("utf-8"))
+    key.update(pixel_hash.digest())
+    key.update("|".join(model_names).encode("utf-8"))
+    key.update(prompt_hash.digest())
+    return key.hexdigest()
+
+
+def _pack_artifacts(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+        for name, data in files:
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _unpack_artifacts(blob):
+    with zipfile.ZipFile(io.BytesIO(blob), "r") as zf:
+        return [(name, zf.read(name)) for name in zf.namelist()]
+
+
+# --- Backends ---
+
+class CacheBackend:
+    """Minimal blob store interface used by PageArtifactCache."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryLRUBackend(CacheBackend):
+    """In-process LRU keyed by cache key, bounded by total blob size."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+
+
+class LocalDiskBackend(CacheBackend):
+    """
+    One file per key under `directory`. Recency is tracked via file mtime, which is
+    bumped on every hit, so eviction survives across requests on a warm instance.
+    """
+
+    def __init__(self, directory=DEFAULT_DISK_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.zip")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path, None)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(".zip"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+
+class ObjectStoreBackend(CacheBackend):
+    """
+    Base class for blob stores (GCS, S3, ...). Subclasses implement the four
+    `_*_object` primitives; this class handles size accounting and LRU eviction.
+
+    Object stores are shared between instances, so the size index is seeded from a
+    listing on first use and then maintained locally. Other instances' writes are
+    picked up on the next listing, which happens whenever the local view overflows.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._index = None  # key -> (last_used, size)
+        self._lock = threading.Lock()
+
+    # Primitives for subclasses
+    def _read_object(self, key):
+        raise NotImplementedError
+
+    def _write_object(self, key, data):
+        raise NotImplementedError
+
+    def _delete_object(self, key):
+        raise NotImplementedError
+
+    def _list_objects(self):
+        """Yields (key, size, last_modified_epoch) for every stored object."""
+        raise NotImplementedError
+
+    def _load_index(self):
+        return {key: (updated, size) for key, size, updated in self._list_objects()}
+
+    def get(self, key):
+        data = self._read_object(key)
+        if data is not None:
+            with self._lock:
+                if self._index is not None:
+                    self._index[key] = (time.time(), len(data))
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self._write_object(key, data)
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+            self._index[key] = (time.time(), len(data))
+            total = sum(size for _, size in self._index.values())
+            if total <= self.max_bytes:
+                return
+            # Refresh from the store before deleting anything, other instances may have written.
+            self._index = self._load_index()
+            self._index[key] = (time.time(), len(data))
+            total = sum(size for _, size in self._index.values())
+            for evict_key, (_, size) in sorted(self._index.items(), key=lambda item: item[1][0]):
+                if total <= self.max_bytes:
+                    break
+                if evict_key == key:
+                    continue
+                self._delete_object(evict_key)
+                del self._index[evict_key]
+                total -= size
+
+    def delete(self, key):
+        self._delete_object(key)
+        with self._lock:
+            if self._index is not None:
+                self._index.pop(key, None)
+
+
+class GCSBackend(ObjectStoreBackend):
+    """Google Cloud Storage implementation. Requires `google-cloud-storage`."""
+
+    def __init__(self, bucket_name, prefix="page-artifact-cache/", max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(max_bytes=max_bytes)
+        from google.cloud import storage  # imported lazily, only needed for this backend
+
+        self._bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix
+
+    def _read_object(self, key):
+        blob = self._bucket.blob(f"{self.prefix}{key}.zip")
+        try:
+            return blob.download_as_bytes()
+        except Exception:
+            return None
+
+    def _write_object(self, key, data):
+        self._bucket.blob(f"{self.prefix}{key}.zip").upload_from_string(data, content_type="application/zip")
+
+    def _delete_object(self, key):
+        try:
+            self._bucket.blob(f"{self.prefix}{key}.zip").delete()
+        except Exception:
+            pass
+
+    def _list_objects(self):
+        for blob in self._bucket.list_blobs(prefix=self.prefix):
+            name = blob.name[len(self.prefix):]
+            if name.endswith(".zip"):
+                updated = blob.updated.timestamp() if blob.updated else 0
+                yield name[:-len(".zip")], blob.size or 0, updated
+
+
+# --- Cache facade ---
+
+class PageArtifactCache:
+    """Stores and returns a page's generated files, keyed by `page_cache_key`."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns a list of (relative_name, bytes) or None. Backend errors count as misses."""
+        try:
+            blob = self.backend.get(key)
+            files = _unpack_artifacts(blob) if blob is not None else None
+        except Exception as e:
+            print(f"Warning: page cache read failed for {key[:12]}: {e}")
+            files = None
+        with self._lock:
+            if files is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return files
+
+    def put(self, key, files):
+        try:
+            self.backend.put(key, _pack_artifacts(files))
+        except Exception as e:
+            print(f"Warning: page cache write failed for {key[:12]}: {e}")
+
+
+def build_cache_from_env():
+    """
+    Creates the process-wide cache from environment variables:
+      PAGE_CACHE_BACKEND   memory (default) | disk | gcs | none
+      PAGE_CACHE_MAX_BYTES size budget for the backend (default 256 MiB)
+      PAGE_CACHE_DIR       directory for the disk backend
+      PAGE_CACHE_BUCKET    bucket for the gcs backend (PAGE_CACHE_PREFIX optional); the
+                           backend needs google-cloud-storage, which requirements.txt does
+                           not install, so add it to the deployment when using gcs
+    Returns None when caching is disabled or the backend cannot be created.
+    """
+    backend_name = os.environ.get("PAGE_CACHE_BACKEND", "memory").strip().lower()
+    if backend_name in ("", "none", "off"):
+        return None
+
+    try:
+        max_bytes = int(os.environ.get("PAGE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        if backend_name == "memory":
+            backend = MemoryLRUBackend(max_bytes=max_bytes)
+        elif backend_name == "disk":
+            backend = LocalDiskBackend(os.environ.get("PAGE_CACHE_DIR", DEFAULT_DISK_DIR), max_bytes=max_bytes)
+        elif backend_name == "gcs":
+            bucket = os.environ.get("PAGE_CACHE_BUCKET")
+            if not bucket:
+                print("Error: PAGE_CACHE_BACKEND=gcs but PAGE_CACHE_BUCKET is not set. Page cache disabled.")
+                return None
+            backend = GCSBackend(
+                bucket,
+                prefix=os.environ.get("PAGE_CACHE_PREFIX", "page-artifact-cache/"),
+                max_bytes=max_bytes,
+            )
+        else:
+            print(f"Warning: Unknown PAGE_CACHE_BACKEND '{backend_name}'. Page cache disabled.")
+            return None
+    except Exception as e:
+        print(f"Failed to initialize page cache backend '{backend_name}': {e}")
+        return None
+
+    print(f"Page artifact cache enabled (backend={backend_name}, max_bytes={max_bytes}).")
+    return PageArtifactCache(backend)
@@ -0,0 +1,924 @@
+"""
+Core image/PDF parsing pipeline: renders pages, transcribes them (PDF text layer or
+Qwen), finds visual elements (locally or with Gemini) and crops them.
+
+Used in-process through `parse_uploads` / `ParseRun`, and over HTTP by the
+image-parser Cloud Function in ../main.py, which streams the same results as a ZIP.
+"""
+import os
+import json
+import re
+import io
+import concurrent.futures
+import itertools
+import threading
+from PIL import Image, UnidentifiedImageError
+import fitz
+from google.genai import types
+
+from . import image_encoding
+from . import llm_clients
+from . import llm_retry
+from . import llm_scheduler
+from . import page_cache
+from . import pdf_elements
+from . import tracing
+from . import usage
+from .results import PageResult, ParsedFile, ParseResult
+
+# --- Configuration ---
+PARASAIL_API_KEY = os.environ.get("PARASAIL_API_KEY")
+OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+DASHSCOPE_API_KEY = os.environ.get("DASHSCOPE_API_KEY")  # <-- add this
+
+# Model for Element Extraction (via Parasail/Gemini)
+EXTRACTION_MODEL_NAME = "gemini-2.5-flash"
+# Model for Transcription (via Qwen)
+TRANSCRIPTION_MODEL_NAME = "qwen3-vl-235b-a22b-instruct"
+
+TEMPERATURE_FOR_JSON = 0
+
+MANIFEST_FILENAME = "parser_manifest.json"
+
+# Maximum number of rendered pages held in memory (and processed) at once per request.
+PAGE_RENDER_WINDOW = int(os.environ.get("PAGE_RENDER_WINDOW", "4"))
+
+# PDF rendering mode:
+#   "target" - render each page directly at the analysis resolution and re-render only the
+#              detected element regions at CROP_DPI via clip rectangles.
+#   "full"   - render every page at CROP_DPI and crop from that bitmap (previous behaviour).
+PDF_RENDER_MODE = os.environ.get("PDF_RENDER_MODE", "target").strip().lower()
+ANALYSIS_MAX_DIMENSION = 2048
+CROP_DPI = 300
+
+# Opt-in: born-digital PDF pages with a usable text layer skip the LLM transcription call.
+# Text inside visual elements is left out and math pages go to the model, but the text layer
+# cannot follow the rest of TRANSCRIPTION_PROMPT (generic instructions are kept verbatim
+# instead of becoming "[LARGE BODY OF IRRELEVANT TEXT]"), so downstream input changes.
+TEXT_LAYER_FAST_PATH = os.environ.get("TEXT_LAYER_FAST_PATH", "0").strip().lower() in ("1", "true", "yes", "on")
+MIN_TEXT_LAYER_CHARS = 40
+
+# PyMuPDF is not thread-safe; every document operation goes through this lock.
+_FITZ_LOCK = threading.Lock()
+
+
+# --- System Prompts ---
+
+ELEMENT_EXTRACTION_PROMPT = """
+Detect items ("diagram", "chart", "graph", "table", "drawing", "photograph"). Capture 0-5 items maximum. Output a json list where each entry contains the 2D bounding box in "box_2d" and a short (two words max, seperated by "_") text label in "label".
+"""
+
+TRANSCRIPTION_PROMPT = """
+You are an expert document transcription assistant. Your sole task is to provide an accurate transcription of the text in the provided image.
+You need to:
+- Transcribe all text that is part of the main body, headings, questions, and general page content.
+- The document could be a school exam. You MUST ALWAYS INCLUDE any question or answer NUMBERS AND THE POINTS AWARDED (typically identified by for example "p", "points") per question if they are present. DO NOT OMIT THIS DATA.
+- The document can also be from an appendix that belongs to the school exam. In this case, it is CRUCIAL that you include the titles of the appendices (e.g.: "B: Graph on Macroeconomics", or "Source A", or "Appendix C - Image of Sobibor during WW2"), as well as the obvious textual elements that are clearly part of the appendix. Each appendix item might also include a textual introduction and/or a short textual explanation. Be sure to include this in your transcription.
+- Another possibility is that the document is the model for correct answers to an exam, in this case also, be sure to include the points awarded per correct answer component, the question number for each bucket of correct answers, and any extra comments relevant to grading the question.
+- If there are any mathematical/physics/etc. equations in the text, use the LaTeX syntax to write these equations. Also, as the text will eventually be shown on HTML pages via the KaTeX library, using single dollar signs ($ ... $) to wrap in-line formulas, and use double dollar signs to wrap block (display) formulas that should be centered on its own line.
+- CRUCIAL: REMEMBER TO PUT THE DOLLAR SIGNS BOTH AT THE BEGINNING AND END OF EACH FORMULA. I'VE NOTICED SOMETIMES YOU FORGET TO PUT THESE SIGNS AT THE END OF A FORMULA, ESPECIALLY IF THERE IS A NEWLINE RIGHT AFTER THE FORMULA.
+- When returning JSON, escape every backslash as \\\\ inside the JSON string, and do not introduce backslashes that aren’t part of LaTeX.
+- CRUCIAL: In certain documents, there are a few pages with introductory text or large bodies of text that explain grading guidelines, general rules, or anything else in that direction. IF there is any text like this, which is NOT specific to any SPECIFIC exam question (meaning also not specific to a certain appendix item, a specific model answer, or a specific answer attempt by a student), then you should not include this in your transcription. Instead of the large body of text, you should just write "[LARGE BODY OF IRRELEVANT TEXT]".
+- IF there is/are any VISUAL ELEMENT(S) in the document provided, EXCLUDE any text that is an integral part of that/those visual element. Do not transcribe axis labels on a graph, data points in a chart, text within a diagram, or content inside a table. Your focus is on the text *surrounding* these elements. This means you'll typically also exclude titles of such visual elements.
+- Despite not being allowed to transcribe anything part of such visual elements, DO NOT OMIT outside references to such elements. For example if the text says something along the lines of: "Refer to source B", you should include it in your transcription.
+
+Output your findings as a single JSON object with one key: "full_transcription". The value should be a single string containing all the transcribed text.
+
+Example Output:
+{
+  "full_transcription": "Lorem ipsum dolor sit amet, consectetur adipiscing elit."
+}
+
+Ensure the JSON is valid. If no text is found, return an empty string for "full_transcription".
+"""
+
+
+# Process-wide page artifact cache (see page_cache.py). None when disabled.
+PAGE_CACHE = page_cache.build_cache_from_env()
+
+# Process-wide LLM scheduler (see llm_scheduler.py), shared by all requests on this instance.
+SCHEDULER = llm_scheduler.build_scheduler_from_env({
+    "gemini": {"concurrency": 8, "rate": 5, "max_queued": 64},
+    "dashscope": {"concurrency": 4, "rate": 2, "max_queued": 64},
+})
+
+# Retries with jittered backoff and optional hedging on top of the scheduler (see llm_retry.py).
+LLM_CALLER = llm_retry.build_caller_from_env(SCHEDULER)
+
+
+# --- Helper Functions ---
+
+def sanitize_filename(title, default_prefix="element"):
+    """Sanitizes a title to be a valid filename."""
+    if not title or title.isspace():
+        return f"{default_prefix}_untitled"
+    sanitized = re.sub(r'[\\/*?:"<>|]', "", title)
+    sanitized = sanitized.replace(" ", "_")
+    sanitized = sanitized[:100]
+    if not sanitized:
+        return f"{default_prefix}_untitled"
+    return sanitized
+
+# --- New Helper Function (Add this to the Helper Functions section) ---
+
+# --- New Helper Function (Add this to the Helper Functions section) ---
+
+def resize_image_for_analysis(pil_image, max_dimension=2048):
+    """
+    Resizes a PIL image to a maximum dimension for consistent LLM analysis,
+    maintaining aspect ratio. Returns the resized image and scaling ratios.
+    """
+    original_width, original_height = pil_image.size
+    
+    if max(original_width, original_height) <= max_dimension:
+        # If the image is already small enough, no resize is needed.
+        # The ratio is 1.0, so coordinates won't be changed.
+        return pil_image, 1.0, 1.0
+
+    if original_width > original_height:
+        # Landscape or square
+        new_width = max_dimension
+        new_height = int(new_width * original_height / original_width)
+    else:
+        # Portrait
+        new_height = max_dimension
+        new_width = int(new_height * original_width / original_height)
+
+    with tracing.span("image.resize", width=new_width, height=new_height):
+        resized_image = pil_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    
+    # Calculate the ratio to scale coordinates back up to the original size
+    width_ratio = original_width / new_width
+    height_ratio = original_height / new_height
+    
+    print(f"Image resized for analysis from {original_width}x{original_height} to {new_width}x{new_height}.")
+    return resized_image, width_ratio, height_ratio
+
+
+# --- API Call Functions ---
+
+def _ensure_gemini_client(task_name=""):
+    if not GEMINI_API_KEY:
+        raise llm_retry.LLMConfigError(f"({task_name}) GEMINI_API_KEY not set.")
+    return llm_clients.gemini_client(GEMINI_API_KEY)
+
+
+def call_gemini_elements_api(pil_image, system_prompt, task_name=""):
+    """
+    Calls the Gemini model for element extraction (cropping) and returns the parsed JSON.
+
+    Expected output format (primary): a JSON list of objects like:
+    [
+      {"box_2d": [y_min, x_min, y_max, x_max], "label": "..."},
+      ...
+    ]
+
+    Back-compat: we also accept an object with key "identified_elements".
+
+    Makes a single attempt and raises on failure; retries and hedging are applied by
+    LLM_CALLER, which classifies the exception.
+    """
+    client = _ensure_gemini_client(task_name)
+
+    generation_config = types.GenerateContentConfig(
+        system_instruction=types.Content(parts=[types.Part(text=system_prompt)]),
+        temperature=TEMPERATURE_FOR_JSON,
+        thinking_config=types.ThinkingConfig(thinking_budget=0),
+        response_mime_type="application/json",
+    )
+
+    try:
+        with tracing.span("image.encode"):
+            encoded = image_encoding.encode_for_llm(pil_image)
+    except Exception as e:
+        raise llm_retry.LLMEncodingError(f"({task_name}) Failed to encode image for Gemini: {e}")
+    contents = [types.Part.from_bytes(data=encoded.data, mime_type=encoded.mime_type)]
+    image_encoding.record_sent(task_name, [encoded])
+
+    print(f"Sending '{task_name}' request to Gemini API (Model: {EXTRACTION_MODEL_NAME})...")
+    with tracing.span("llm.gemini", task=task_name, model=EXTRACTION_MODEL_NAME, request_bytes=len(encoded.data)), \
+            usage.call("gemini", EXTRACTION_MODEL_NAME, task_name, images=1) as metered:
+        response = client.models.generate_content(
+            model=EXTRACTION_MODEL_NAME,
+            contents=contents,
+            config=generation_config,
+        )
+        metered.record(response)
+
+    try:
+        return json.loads(response.text)
+    except json.JSONDecodeError:
+        print(f"Error decoding JSON from Gemini response for {task_name}. Received text: {response.text}")
+        raise
+
+def _ensure_qwen_client(task_name=""):
+    if not DASHSCOPE_API_KEY:
+        raise llm_retry.LLMConfigError(f"({task_name}) DASHSCOPE_API_KEY not set.")
+    return llm_clients.openai_client(DASHSCOPE_API_KEY, llm_clients.DASHSCOPE_BASE_URL, name="dashscope")
+
+
+def call_qwen_transcription_api(pil_image, system_prompt, task_name=""):
+    """
+    Calls the Qwen model (OpenAI-compatible DashScope endpoint) for transcription
+    and returns a JSON object: {"full_transcription": "..."}.
+    The system prompt is passed as a true system message.
+
+    Makes a single attempt and raises on API failure; retries and hedging are applied
+    by LLM_CALLER.
+    """
+    client = _ensure_qwen_client(task_name)
+
+    # Format/quality chosen per page against the byte target; cached, so retries reuse it.
+    try:
+        with tracing.span("image.encode"):
+            encoded = image_encoding.encode_for_llm(pil_image)
+    except Exception as e:
+        raise llm_retry.LLMEncodingError(f"({task_name}) Failed to encode image for Qwen: {e}")
+    data_url = encoded.data_url()
+    image_encoding.record_sent(task_name, [encoded], base64_encoded=True)
+
+    # System prompt is **system** role (not injected into user)
+    with tracing.span("llm.qwen", task=task_name, model=TRANSCRIPTION_MODEL_NAME, request_bytes=len(data_url)), \
+            usage.call("dashscope", TRANSCRIPTION_MODEL_NAME, task_name, images=1) as metered:
+        completion = client.chat.completions.create(
+            model=TRANSCRIPTION_MODEL_NAME,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": data_url}},
+                        {"type": "text", "text": "Analyze the image and provide a transcription following the system instructions."}
+                    ],
+                },
+            ],
+            temperature=0,
+            top_p=0.8,
+        )
+        metered.record(completion)
+
+    content = completion.choices[0].message.content or ""
+    content = content.strip()
+
+    # Try to parse JSON; if not valid, wrap as "full_transcription"
+    try:
+        parsed = json.loads(content)
+        if isinstance(parsed, dict) and "full_transcription" in parsed:
+            return parsed
+        # If it's JSON but doesn't match shape, wrap it
+        return {"full_transcription": content}
+    except json.JSONDecodeError:
+        # Try extracting JSON between backticks if present
+        m = re.search(r"\{[\s\S]*\}", content)
+        if m:
+            try:
+                parsed = json.loads(m.group(0))
+                if isinstance(parsed, dict) and "full_transcription" in parsed:
+                    return parsed
+            except Exception:
+                pass
+        # Fallback: return raw text wrapped in the expected shape
+        return {"full_transcription": content}
+
+
+
+# --- Core Processing Function ---
+
+def process_single_image(original_image_pil, output_prefix="", page_source=None, text_layer=None,
+                         local_elements=None):
+    """
+    Processes a single PIL image by making two concurrent API calls (one for transcription,
+    one for element extraction) and returns the generated files as a list of
+    (filename, data_in_bytes) tuples.
+
+    Changes:
+      - Switched element extraction from OpenRouter/Parasail to Gemini 2.5 Flash.
+      - Supports NEW element format: a list of dicts with:
+          {
+            "box_2d": [y_min, x_min, y_max, x_max],  # vertical-first ordering
+            "label": "photograph"  # used as element type/name
+          }
+      - Backward-compatible with OLD format (identified_elements key using bbox [x_min, y_min, x_max, y_max]).
+      - Pages whose pixels, models and prompts match an earlier run are served from PAGE_CACHE
+        without any API call.
+      - When `page_source` (a PdfPageSource) is given, the image is an analysis-resolution
+        render and element crops are re-rendered from the PDF at CROP_DPI instead of being
+        cut out of a full-resolution bitmap.
+      - When `text_layer` is given (the page's own PDF text lines, already judged usable by
+        assess_text_layer), the lines outside the element boxes are emitted as the
+        transcription and the Qwen call is skipped.
+      - When `local_elements` is non-empty (boxes found by pdf_elements.find_local_elements), they are
+        cropped directly and the Gemini element-detection call is skipped.
+
+    Returns (generated_files, page_report), where page_report is this page's manifest entry.
+    """
+    print(f"\n--- Starting concurrent processing for {output_prefix} ---")
+    generated_files = []
+    page_report = {
+        "prefix": output_prefix,
+        "cache": "disabled",
+        "crops": "pdf_clip" if page_source is not None else "bitmap",
+        "transcription": "text_layer" if text_layer is not None else "llm",
+        "elements": "local" if local_elements else "gemini",
+    }
+
+    if original_image_pil.mode != 'RGB':
+        original_image_pil = original_image_pil.convert("RGB")
+
+    cache_key = None
+    if PAGE_CACHE is not None:
+        cache_key = page_cache.page_cache_key(
+            original_image_pil,
+            model_names=(
+                "local_elements" if local_elements else EXTRACTION_MODEL_NAME,
+                "text_layer" if text_layer is not None else TRANSCRIPTION_MODEL_NAME,
+                image_encoding.config_signature(),
+            ),
+            prompts=(ELEMENT_EXTRACTION_PROMPT, TRANSCRIPTION_PROMPT),
+        )
+        cached_files = PAGE_CACHE.get(cache_key)
+        if cached_files is not None:
+            print(f"Page cache hit for {output_prefix} ({cache_key[:12]}); skipping API calls.")
+            page_report["cache"] = "hit"
+            page_report["transcription"] = "cache"
+            page_report["elements"] = "cache"
+            return [(f"{output_prefix}{name}", data) for name, data in cached_files], page_report
+        page_report["cache"] = "miss"
+
+    # Resize image for consistent analysis and get scaling ratios
+    image_for_analysis, width_ratio, height_ratio = resize_image_for_analysis(original_image_pil)
+
+    # Concurrent API calls through the process-wide scheduler (Gemini elements + Qwen transcription),
+    # each with retries/backoff and optional hedging. Counters end up in this page's manifest entry.
+    llm_counters = {}
+    page_report["llm_calls"] = llm_counters
+    elements_response = None
+    transcription_response = None
+    future_elements = None
+    future_transcription = None
+    if local_elements:
+        print(f"Using {len(local_elements)} locally extracted element(s) for {output_prefix}; skipping Gemini.")
+        elements_response = local_elements
+    else:
+        future_elements = LLM_CALLER.submit(
+            "gemini",
+            tracing.bind(call_gemini_elements_api),
+            image_for_analysis,
+            ELEMENT_EXTRACTION_PROMPT,
+            "Element Extraction",
+            counters=llm_counters.setdefault("gemini", llm_retry.new_call_counters()),
+        )
+    if text_layer is not None:
+        print(f"Using the PDF text layer as transcription for {output_prefix}; skipping Qwen.")
+    else:
+        future_transcription = LLM_CALLER.submit(
+            "dashscope",
+            tracing.bind(call_qwen_transcription_api),
+            original_image_pil,
+            TRANSCRIPTION_PROMPT,
+            "Transcription",
+            counters=llm_counters.setdefault("dashscope", llm_retry.new_call_counters()),
+        )
+
+    if future_elements is not None:
+        try:
+            elements_response = future_elements.result()
+        except Exception as e:
+            print(f"Element extraction task failed for {output_prefix}: {e}")
+
+    if future_transcription is not None:
+        try:
+            transcription_response = future_transcription.result()
+        except Exception as e:
+            print(f"Transcription task failed for {output_prefix}: {e}")
+    elif text_layer is not None:
+        # Like the LLM transcription, leave out text that is part of a visual element.
+        element_boxes = _element_boxes(elements_response if isinstance(elements_response, list) else [])
+        kept_lines = _lines_outside(text_layer, element_boxes)
+        transcription_response = {"full_transcription": "\n".join(text for _, text in kept_lines)}
+
+    # Process Transcription Result
+    if transcription_response:
+        full_transcription = transcription_response.get("full_transcription", "No transcription provided.")
+        transcription_filename = f"{output_prefix}full_transcription.txt"
+        generated_files.append((transcription_filename, full_transcription.encode('utf-8')))
+        print(f"Generated transcription: {transcription_filename}")
+    else:
+        print(f"Failed to get a valid transcription response for {output_prefix}.")
+
+    # Process Element Extraction Result
+    identified_elements = []
+    if elements_response:
+        if isinstance(elements_response, list):
+            identified_elements = elements_response
+        else:
+            print(f"Warning: Expected a JSON array for elements; got {type(elements_response)}. Ignoring.")
+    else:
+        print(f"Failed to get a valid element extraction response for {output_prefix}.")
+
+    if not identified_elements:
+        print(f"\nNo elements were identified by the API for {output_prefix}.")
+    else:
+        print(f"\n--- Processing {len(identified_elements)} Elements Identified for {output_prefix} ---")
+        element_filenames = {}
+
+        for i, element in enumerate(identified_elements):
+            label = element.get("label") or element.get("type") or "element"
+            title = element.get("title") or f"{label}_{i+1}"
+            element_type = label
+
+            bbox_data = element.get("box_2d")
+
+            if not bbox_data or not (isinstance(bbox_data, list) and len(bbox_data) == 4):
+                print(f"Warning: Element '{title}' has invalid or missing box_2d data. Skipping crop.")
+                continue
+
+            try:
+                # The format is [y_min, x_min, y_max, x_max]
+                # These are NORMALIZED coordinates on a 0-1000 scale.
+                y_min_norm, x_min_norm, y_max_norm, x_max_norm = bbox_data
+
+                # Get the dimensions of the ORIGINAL image, not the resized one.
+                orig_width, orig_height = original_image_pil.size
+
+                # Convert normalized coordinates to absolute pixel coordinates on the ORIGINAL image
+                x_min_orig = int((x_min_norm / 1000.0) * orig_width)
+                y_min_orig = int((y_min_norm / 1000.0) * orig_height)
+                x_max_orig = int((x_max_norm / 1000.0) * orig_width)
+                y_max_orig = int((y_max_norm / 1000.0) * orig_height)
+
+                # The width_ratio and height_ratio from the resize are no longer needed for this calculation.
+
+                # Margin (this part is fine)
+                MARGIN_RATIO = 0.03
+                element_width = x_max_orig - x_min_orig
+                element_height = y_max_orig - y_min_orig
+
+                margin_x = max(0, int(element_width * MARGIN_RATIO))
+                margin_y = max(0, int(element_height * MARGIN_RATIO))
+
+                crop_box = (
+                    max(0, x_min_orig - margin_x),
+                    max(0, y_min_orig - margin_y),
+                    min(orig_width, x_max_orig + margin_x),
+                    min(orig_height, y_max_orig + margin_y),
+                )
+
+                if crop_box[0] >= crop_box[2] or crop_box[1] >= crop_box[3]:
+                    print(f"Warning: Invalid bounding box for '{title}' after scaling. Skipping crop.")
+                    continue
+
+                if page_source is not None:
+                    crop_png = page_source.render_clip((
+                        crop_box[0] / orig_width,
+                        crop_box[1] / orig_height,
+                        crop_box[2] / orig_width,
+                        crop_box[3] / orig_height,
+                    ))
+                else:
+                    img_byte_arr = io.BytesIO()
+                    original_image_pil.crop(crop_box).save(img_byte_arr, format='PNG')
+                    crop_png = img_byte_arr.getvalue()
+
+                filename_title_part = sanitize_filename(title, default_prefix=element_type)
+                base_filename = f"{output_prefix}{filename_title_part}.png"
+
+                if base_filename in element_filenames:
+                    element_filenames[base_filename] += 1
+                    output_filename = f"{output_prefix}{filename_title_part}_{element_filenames[base_filename]}.png"
+                else:
+                    element_filenames[base_filename] = 1
+                    output_filename = base_filename
+
+                generated_files.append((output_filename, crop_png))
+                print(f"Generated cropped element: {output_filename}")
+
+            except (ValueError, TypeError) as e:
+                print(f"Warning: Element '{title}' has invalid bbox data: {e}. Skipping.")
+
+    # Only cache pages where both calls answered; failures should be retried next time.
+    if cache_key is not None and transcription_response and elements_response is not None:
+        PAGE_CACHE.put(
+            cache_key,
+            [(filename[len(output_prefix):], data) for filename, data in generated_files],
+        )
+
+    return generated_files, page_report
+
+
+# --- Page Rendering ---
+
+_MATH_CHAR_RANGES = ((0x2200, 0x22FF), (0x27C0, 0x27EF), (0x2980, 0x2AFF), (0x1D400, 0x1D7FF))
+
+# Formulas typed in plain ASCII, which the LLM transcription would have written in LaTeX.
+_ASCII_FORMULA = re.compile(
+    r"[A-Za-z0-9)\]]\s*[\^_]\s*[-A-Za-z0-9({]"                 # powers and indices: x^2, a_n
+    r"|\b(?:sqrt|sin|cos|tan|log|ln|exp|lim)\s*\("              # functions: sqrt(2), sin(x)
+    r"|(?<![A-Za-z])\d*[A-Za-z]\s*(?:=|<|>|<=|>=)\s*[-+(]?\d"    # x = 5, y = 2x + 1, n > 3
+    r"|(?<![A-Za-z])\d+[A-Za-z]\s*[-+*/]\s*\(?(?:\d+[A-Za-z]?|[A-Za-z])(?![A-Za-z])"  # 3x + 5, 2a - b
+)
+
+
+def _element_boxes(elements):
+    """(x0, y0, x1, y1) page fractions of elements with a valid 0-1000 "box_2d"."""
+    boxes = []
+    for element in elements:
+        box = element.get("box_2d") if isinstance(element, dict) else None
+        try:
+            y_min, x_min, y_max, x_max = (float(value) / 1000.0 for value in box)
+        except (TypeError, ValueError):
+            continue
+        boxes.append((x_min, y_min, x_max, y_max))
+    return boxes
+
+
+def _lines_outside(lines, boxes):
+    """The (box, text) lines that do not overlap any of `boxes` (all page fractions)."""
+    return [
+        (line_box, text) for line_box, text in lines
+        if not any(
+            min(line_box[2], box[2]) > max(line_box[0], box[0])
+            and min(line_box[3], box[3]) > max(line_box[1], box[1])
+            for box in boxes
+        )
+    ]
+
+
+def assess_text_layer(page, local_elements=()):
+    """
+    Extracts a PDF page's embedded text line by line and decides whether it can replace the
+    LLM transcription. Returns (lines_or_None, reason), where lines are (box, text) pairs
+    with the box as (x0, y0, x1, y1) fractions of the page.
+
+    Lines overlapping an embedded image or one of `local_elements` (pdf_elements.find_local_elements
+    output) are left out, as the transcription prompt excludes text that belongs to a
+    visual element; process_single_image does the same for Gemini's element boxes. The
+    remaining text is rejected when it is:
+      - too short (likely a scan, or a page that is mostly visuals),
+      - an OCR layer over a full-page scan (the scan is better read by the model),
+      - garbled (replacement characters, control characters, or too few real words,
+        which is what broken font encodings produce),
+      - math (Unicode math symbols, or ASCII formulas such as "x^2 + 3x = 5"); the
+        transcription must use LaTeX, which a text layer cannot give.
+    """
+    page_rect = page.rect
+    width, height = page_rect.width or 1, page_rect.height or 1
+
+    def fraction(bbox):
+        return ((bbox[0] - page_rect.x0) / width, (bbox[1] - page_rect.y0) / height,
+                (bbox[2] - page_rect.x0) / width, (bbox[3] - page_rect.y0) / height)
+
+    visual_boxes = _element_boxes(local_elements)
+    for info in page.get_image_info():
+        image_box = fraction(info["bbox"])
+        if (image_box[2] - image_box[0]) * (image_box[3] - image_box[1]) > 0.8:
+            return None, "scanned_page"
+        visual_boxes.append(image_box)
+
+    lines = []
+    for block in page.get_text("dict", sort=True)["blocks"]:
+        for line in block.get("lines", ()):
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            if text:
+                lines.append((fraction(line["bbox"]), text))
+    lines = _lines_outside(lines, visual_boxes)
+
+    text = "\n".join(line_text for _, line_text in lines)
+    if len(text) < MIN_TEXT_LAYER_CHARS:
+        return None, "too_little_text"
+
+    visible = [ch for ch in text if not ch.isspace()]
+    bad = sum(1 for ch in visible if ch == "\ufffd" or not ch.isprintable())
+    if bad / len(visible) > 0.01:
+        return None, "garbled_characters"
+
+    words = text.split()
+    wordlike = sum(1 for word in words if sum(ch.isalpha() for ch in word) >= max(1, len(word) // 2))
+    if wordlike / len(words) < 0.6:
+        return None, "few_real_words"
+
+    math_chars = sum(1 for ch in visible if any(lo <= ord(ch) <= hi for lo, hi in _MATH_CHAR_RANGES))
+    if math_chars / len(visible) > 0.005 or any(_ASCII_FORMULA.search(line_text) for _, line_text in lines):
+        return None, "math_content"
+
+    return lines, "ok"
+
+
+class PdfDocument:
+    """
+    One open PyMuPDF document, shared by the page rendering loop and the PdfPageSource of
+    each of its pages so element crops do not re-parse the PDF. Each holder calls
+    release() when done; the document is closed with the last one.
+    """
+
+    def __init__(self, pdf_bytes):
+        with _FITZ_LOCK:
+            self._document = fitz.open(stream=pdf_bytes, filetype="pdf")
+            self.page_count = self._document.page_count
+        self._holders = 1
+
+    def __getitem__(self, page_index):
+        # Callers hold _FITZ_LOCK while using the page.
+        return self._document[page_index]
+
+    def retain(self):
+        with _FITZ_LOCK:
+            self._holders += 1
+        return self
+
+    def release(self):
+        with _FITZ_LOCK:
+            self._holders -= 1
+            if self._holders == 0:
+                self._document.close()
+
+
+class PdfPageSource:
+    """
+    Vector source of one PDF page, used to re-render element regions at CROP_DPI from
+    the upload's open PdfDocument. Call close() once the page is processed.
+    """
+
+    def __init__(self, document, page_index):
+        self.document = document.retain()
+        self.page_index = page_index
+
+    def render_clip(self, fractional_box, dpi=CROP_DPI):
+        """Renders (x0, y0, x1, y1), given as fractions of the page size, to PNG bytes."""
+        x0, y0, x1, y1 = fractional_box
+        with _FITZ_LOCK, tracing.span("pdf.render_clip", page=self.page_index, dpi=dpi):
+            page = self.document[self.page_index]
+            rect = page.rect
+            clip = fitz.Rect(
+                rect.x0 + x0 * rect.width,
+                rect.y0 + y0 * rect.height,
+                rect.x0 + x1 * rect.width,
+                rect.y0 + y1 * rect.height,
+            )
+            return page.get_pixmap(dpi=dpi, clip=clip).tobytes("png")
+
+    def close(self):
+        if self.document is not None:
+            self.document.release()
+            self.document = None
+
+
+def _render_pdf_page(page):
+    """
+    Rasterizes a page according to PDF_RENDER_MODE. In "target" mode the page is rendered
+    straight at ANALYSIS_MAX_DIMENSION on its long side (never above CROP_DPI).
+    """
+    if PDF_RENDER_MODE == "target":
+        zoom = min(ANALYSIS_MAX_DIMENSION / max(page.rect.width, page.rect.height), CROP_DPI / 72)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+    else:
+        pix = page.get_pixmap(dpi=CROP_DPI)
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+
+def iter_pages_to_process(uploads, trace_parent=None):
+    """
+    Lazily yields {"image", "prefix", "source", "text_layer", "text_layer_reason",
+    "local_elements"} for every page of every upload (see PdfPageSource, assess_text_layer
+    and pdf_elements.find_local_elements). PDF pages are rasterized one at a time, only when the caller
+    asks for the next page, so memory is bounded by how many pages the caller keeps in flight.
+    Render spans are children of `trace_parent`, since a generator has no stable context.
+    """
+    for filename, file_bytes in uploads:
+        if filename.lower().endswith('.pdf'):
+            try:
+                pdf_document = PdfDocument(file_bytes)
+            except Exception as e:
+                print(f"Error opening PDF file '{filename}' with PyMuPDF: {e}")
+                continue
+            try:
+                for i in range(pdf_document.page_count):
+                    try:
+                        with _FITZ_LOCK, tracing.span("pdf.render_page", parent=trace_parent,
+                                                      file=filename, page=i + 1, mode=PDF_RENDER_MODE):
+                            page = pdf_document[i]
+                            page_image = _render_pdf_page(page)
+                            found_elements = (
+                                pdf_elements.find_local_elements(page)
+                                if pdf_elements.LOCAL_ELEMENT_PASS or TEXT_LAYER_FAST_PATH else []
+                            )
+                            text_layer, text_layer_reason = (
+                                assess_text_layer(page, found_elements) if TEXT_LAYER_FAST_PATH else (None, "disabled")
+                            )
+                            local_elements = found_elements if pdf_elements.LOCAL_ELEMENT_PASS else []
+                    except Exception as e:
+                        print(f"Error converting page {i+1} of PDF file '{filename}' with PyMuPDF: {e}")
+                        continue
+                    yield {
+                        "image": page_image,
+                        "prefix": f"{os.path.splitext(filename)[0]}_page_{i+1}_",
+                        "source": PdfPageSource(pdf_document, i) if PDF_RENDER_MODE == "target" else None,
+                        "text_layer": text_layer,
+                        "text_layer_reason": text_layer_reason,
+                        "local_elements": local_elements,
+                    }
+            finally:
+                pdf_document.release()  # pages still being processed keep it open
+        else:
+            try:
+                with tracing.span("image.decode", parent=trace_parent, file=filename):
+                    image = Image.open(io.BytesIO(file_bytes))
+                    image.load()
+            except (UnidentifiedImageError, OSError) as e:
+                print(f"Error opening image file '{filename}': {e}")
+                continue
+            yield {
+                "image": image,
+                "prefix": f"{os.path.splitext(filename)[0]}_",
+                "source": None,
+                "text_layer": None,
+                "text_layer_reason": "not_a_pdf",
+                "local_elements": [],
+            }
+
+
+def _current_rss_bytes():
+    """Resident set size of this process, or 0 where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class PageMemoryTracker:
+    """
+    Per-request memory accounting. Tracks the bytes of page bitmaps currently in
+    flight (exact, from image dimensions) and samples process RSS (which also
+    includes other concurrent requests on the same instance).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.inflight_bytes = 0
+        self.peak_inflight_bytes = 0
+        self.peak_rss_bytes = _current_rss_bytes()
+
+    @staticmethod
+    def _image_bytes(pil_image):
+        return pil_image.width * pil_image.height * len(pil_image.getbands())
+
+    def acquire(self, pil_image):
+        with self._lock:
+            self.inflight_bytes += self._image_bytes(pil_image)
+            self.peak_inflight_bytes = max(self.peak_inflight_bytes, self.inflight_bytes)
+        self.sample_rss()
+
+    def release(self, pil_image):
+        with self._lock:
+            self.inflight_bytes -= self._image_bytes(pil_image)
+
+    def sample_rss(self):
+        rss = _current_rss_bytes()
+        with self._lock:
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+
+    def report(self, window):
+        return {
+            "render_window": window,
+            "peak_inflight_page_bytes": self.peak_inflight_bytes,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+
+
+# --- Parse Runs ---
+
+class ParseRun:
+    """
+    Parses a list of (filename, bytes) uploads page by page with a bounded window.
+
+    Iterating yields a PageResult per page, in upload/page order, as soon as that page
+    and every page before it are done. A page keeps its window slot until the caller
+    has taken its result, so at most `window` bitmaps or page results are resident,
+    even if an early page is slow. Call manifest() once iteration has finished.
+    """
+
+    def __init__(self, uploads, window=None):
+        self.window = max(1, window or PAGE_RENDER_WINDOW)
+        self.memory = PageMemoryTracker()
+        self.page_reports = []
+        self.pages_seen = 0
+        self.files_produced = 0
+        # Pages are rendered and processed while the caller iterates (possibly while a
+        # response streams), so spans hang off the span that created the run.
+        self._trace_parent = tracing.current()
+        # LLM calls of all pages; the image-parser function's request ledger when there
+        # is one, otherwise the run's own (reported in the manifest for in-process hosts).
+        self.usage = usage.current() or usage.Ledger("image-parser")
+        self._items = iter_pages_to_process(uploads, trace_parent=self._trace_parent)
+        self._first_item = None
+
+    def has_pages(self):
+        """Renders the first page if needed; False when no upload yields any page."""
+        if self._first_item is None:
+            self._first_item = next(self._items, None)
+        return self._first_item is not None
+
+    def _run_page(self, item):
+        try:
+            with usage.recording(self.usage), tracing.span("page", prefix=item['prefix']) as page_span:
+                processed_files, page_report = process_single_image(
+                    item['image'],
+                    output_prefix=item['prefix'],
+                    page_source=item['source'],
+                    text_layer=item['text_layer'],
+                    local_elements=item['local_elements'],
+                )
+                page_report["text_layer"] = item['text_layer_reason']
+                page_span.set(cache=page_report.get("cache"), transcription=page_report.get("transcription"),
+                              elements=page_report.get("elements"))
+            return processed_files, page_report
+        finally:
+            self.memory.release(item['image'])
+            item['image'].close()
+            if item['source'] is not None:
+                item['source'].close()
+
+    def _page_result(self, index, prefix, future):
+        try:
+            processed_files, page_report = future.result()
+        except Exception as exc:
+            print(f"--- An exception occurred while processing {prefix}: {exc} ---")
+            page_report = {"prefix": prefix, "index": index, "error": str(exc)}
+            self.page_reports.append(page_report)
+            return PageResult(index=index, prefix=prefix, report=page_report, error=str(exc))
+
+        page_report["index"] = index
+        self.page_reports.append(page_report)
+        if processed_files:
+            print(f"--- Successfully finished processing for {prefix} ---")
+        else:
+            print(f"--- Processing for {prefix} returned no files. ---")
+        files = [ParsedFile(name, data) for name, data in processed_files or []]
+        self.files_produced += len(files)
+        return PageResult(index=index, prefix=prefix, files=files, report=page_report)
+
+    def __iter__(self):
+        self.has_pages()
+        items = itertools.chain([self._first_item] if self._first_item is not None else [], self._items)
+        self._first_item = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.window) as executor:
+            pending = {}  # page index -> (prefix, future), contiguous from next_index
+            next_index = 0
+
+            def take_next():
+                nonlocal next_index
+                prefix, future = pending.pop(next_index)
+                concurrent.futures.wait([future])
+                result = self._page_result(next_index, prefix, future)
+                next_index += 1
+                self.memory.sample_rss()
+                return result
+
+            for item in items:
+                while len(pending) >= self.window:
+                    yield take_next()
+                self.memory.acquire(item['image'])
+                pending[self.pages_seen] = (item['prefix'], executor.submit(tracing.bind(self._run_page, self._trace_parent), item))
+                self.pages_seen += 1
+                item = None  # drop our reference; the worker owns the bitmap now
+
+            while pending:
+                yield take_next()
+
+        memory_report = self.memory.report(self.window)
+        print(
+            f"Processed {self.pages_seen} page(s). Peak in-flight page memory: "
+            f"{memory_report['peak_inflight_page_bytes'] / 1e6:.1f} MB, "
+            f"peak process RSS: {memory_report['peak_rss_bytes'] / 1e6:.1f} MB."
+        )
+
+    def manifest(self):
+        manifest = {
+            "pages": sorted(self.page_reports, key=lambda report: report["index"]),
+            "cache": (
+                {"hits": PAGE_CACHE.hits, "misses": PAGE_CACHE.misses} if PAGE_CACHE is not None else None
+            ),
+            "memory": self.memory.report(self.window),
+            "scheduler": SCHEDULER.stats(),
+            "llm_clients": llm_clients.stats(),
+            "encoding": image_encoding.stats(),
+            "usage": self.usage.summary(),
+        }
+        if self.files_produced == 0:
+            manifest["error"] = "Processing completed, but no output files were generated."
+        return manifest
+
+
+def parse_uploads(uploads, window=None):
+    """
+    Parses (filename, bytes) uploads in-process and returns a ParseResult with every
+    page's files in memory. Raises ValueError when no upload contains a usable page.
+    """
+    run = ParseRun(uploads, window=window)
+    if not run.has_pages():
+        raise ValueError("No valid image or PDF files could be processed.")
+    pages = list(run)
+    return ParseResult(pages=pages, manifest=run.manifest())
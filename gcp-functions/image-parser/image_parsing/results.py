@@ -0,0 +1,75 @@
+"""
+Typed, in-memory results of a parse, so in-process callers get pages and files
+directly instead of unpacking the ZIP that the HTTP endpoint returns.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+TRANSCRIPTION_SUFFIX = "full_transcription.txt"
+
+
+@dataclass
+class ParsedFile:
+    """One output file. `name` includes the page prefix, exactly as in the ZIP archive."""
+    name: str
+    data: bytes
+
+    @property
+    def is_text(self) -> bool:
+        return self.name.endswith(".txt")
+
+    @property
+    def mime_type(self) -> str:
+        if self.is_text:
+            return "text/plain"
+        lowered = self.name.lower()
+        if lowered.endswith((".jpg", ".jpeg")):
+            return "image/jpeg"
+        return "image/png"
+
+    def text(self) -> str:
+        return self.data.decode("utf-8")
+
+
+@dataclass
+class PageResult:
+    """Everything produced for one page. `report` is the page's parser_manifest.json entry."""
+    index: int
+    prefix: str
+    files: List[ParsedFile] = field(default_factory=list)
+    report: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def transcription(self) -> Optional[str]:
+        for parsed_file in self.files:
+            if parsed_file.name.endswith(TRANSCRIPTION_SUFFIX):
+                return parsed_file.text()
+        return None
+
+    @property
+    def text_files(self) -> List[ParsedFile]:
+        return [f for f in self.files if f.is_text]
+
+    @property
+    def image_files(self) -> List[ParsedFile]:
+        return [f for f in self.files if not f.is_text]
+
+
+@dataclass
+class ParseResult:
+    """All pages in upload order plus the run's manifest (same content as parser_manifest.json)."""
+    pages: List[PageResult]
+    manifest: Dict[str, Any]
+
+    def files(self) -> Iterator[ParsedFile]:
+        for page in self.pages:
+            yield from page.files
+
+    @property
+    def text_files(self) -> List[ParsedFile]:
+        return [f for page in self.pages for f in page.text_files]
+
+    @property
+    def image_files(self) -> List[ParsedFile]:
+        return [f for page in self.pages for f in page.image_files]
@@ -1,5 +1,4 @@
 import os
-import base64
 import json
 import re
 import sys
@@ -10,9 +9,14 @@ import concurrent.futures
 from flask import request, send_file
 from PIL import Image, UnidentifiedImageError
 import fitz
-from google import genai
 from google.genai import types
-from openai import OpenAI
+
+import image_encoding
+import llm_clients
+import llm_scheduler
+import pdf_elements
+import tracing
+import usage
 
 
 # --- Configuration ---
@@ -28,6 +32,12 @@ QWEN_TRANSCRIPTION_MODEL_NAME = "qwen3-vl-32b-instruct"
 
 TEMPERATURE_FOR_JSON = 0
 
+# Process-wide LLM scheduler (see llm_scheduler.py), shared by all requests on this instance.
+SCHEDULER = llm_scheduler.build_scheduler_from_env({
+    "gemini": {"concurrency": 8, "rate": 5, "max_queued": 64},
+    "dashscope": {"concurrency": 4, "rate": 2, "max_queued": 64},
+})
+
 # --- System Prompts ---
 # Switched to the simpler prompt used by the Gemini reference implementation.
 ELEMENT_EXTRACTION_PROMPT = """
@@ -75,38 +85,6 @@ You must adhere to the following rules:
 
 # --- Helper Functions ---
 
-def encode_image_to_base64(pil_image):
-    """Encodes a PIL Image object to a base64 string."""
-    try:
-        buffered = io.BytesIO()
-        image_format = pil_image.format if pil_image.format else 'PNG'
-        img_to_save = pil_image
-        if image_format == 'JPEG' and img_to_save.mode != 'RGB':
-            img_to_save = img_to_save.convert('RGB')
-        elif image_format not in ['PNG', 'JPEG', 'WEBP', 'GIF']:
-            image_format = 'PNG'
-
-        img_to_save.save(buffered, format=image_format)
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    except Exception as e:
-        print(f"Error encoding PIL image: {e}")
-        return None
-
-def get_image_mime_type(pil_image):
-    """Determines common image MIME types from PIL Image format."""
-    img_format = pil_image.format
-    if img_format == "PNG":
-        return "image/png"
-    elif img_format == "JPEG":
-        return "image/jpeg"
-    elif img_format == "WEBP":
-        return "image/webp"
-    elif img_format == "GIF":
-        return "image/gif"
-    print(f"Warning: PIL image format is '{img_format}', defaulting to image/png for MIME type.")
-    return "image/png"
-
-
 def sanitize_filename(title, default_prefix="element"):
     """Sanitizes a title to be a valid filename."""
     if not title or title.isspace():
@@ -136,7 +114,8 @@ def resize_image_for_analysis(pil_image, max_dimension=2048):
         new_height = max_dimension
         new_width = int(new_height * original_width / original_height)
 
-    resized_image = pil_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    with tracing.span("image.resize", width=new_width, height=new_height):
+        resized_image = pil_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
     width_ratio = original_width / new_width
     height_ratio = original_height / new_height
@@ -152,7 +131,7 @@ def _ensure_gemini_client(task_name=""):
         print(f"Error ({task_name}): GEMINI_API_KEY not set.")
         return None
     try:
-        return genai.Client(api_key=GEMINI_API_KEY)
+        return llm_clients.gemini_client(GEMINI_API_KEY)
     except Exception as e:
         print(f"Failed to init Gemini client for {task_name}: {e}")
         return None
@@ -180,14 +159,20 @@ def call_gemini_elements_api(pil_image, system_prompt, task_name=""):
             response_mime_type="application/json",
         )
 
-        contents = pil_image
+        with tracing.span("image.encode"):
+            encoded = image_encoding.encode_for_llm(pil_image)
+        contents = [types.Part.from_bytes(data=encoded.data, mime_type=encoded.mime_type)]
+        image_encoding.record_sent(task_name, [encoded])
 
         print(f"Sending '{task_name}' request to Gemini API (Model: {EXTRACTION_MODEL_NAME})...")
-        response = client.models.generate_content(
-            model=EXTRACTION_MODEL_NAME,
-            contents=contents,
-            config=generation_config,
-        )
+        with tracing.span("llm.gemini", task=task_name, model=EXTRACTION_MODEL_NAME, request_bytes=len(encoded.data)), \
+                usage.call("gemini", EXTRACTION_MODEL_NAME, task_name, images=1) as metered:
+            response = client.models.generate_content(
+                model=EXTRACTION_MODEL_NAME,
+                contents=contents,
+                config=generation_config,
+            )
+            metered.record(response)
 
         return json.loads(response.text)
     except json.JSONDecodeError as jde:
@@ -206,10 +191,7 @@ def _ensure_qwen_client(task_name=""):
         print(f"Error ({task_name}): DASHSCOPE_API_KEY not set.")
         return None
     try:
-        return OpenAI(
-            api_key=DASHSCOPE_API_KEY,
-            base_url="https://dashscope-intl.aliyuncs.com/compatible-mode/v1",
-        )
+        return llm_clients.openai_client(DASHSCOPE_API_KEY, llm_clients.DASHSCOPE_BASE_URL, name="dashscope")
     except Exception as e:
         print(f"Failed to init Qwen client for {task_name}: {e}")
         return None
@@ -237,22 +219,20 @@ def call_qwen_api_for_transcription(pil_images, system_prompt, task_name=""):
             }
         ]
 
+        encoded_images = []
         for im in pil_images:
             try:
-                if im.mode not in ("RGB", "RGBA"):
-                    im = im.convert("RGB")
-                b64 = encode_image_to_base64(im)
-                if not b64:
-                    print("Warning: Failed to base64-encode an image; skipping.")
-                    continue
-                mime = get_image_mime_type(im)
-                data_url = f"data:{mime};base64,{b64}"
+                # Format/quality chosen per page against the byte target (see image_encoding.py).
+                with tracing.span("image.encode"):
+                    encoded = image_encoding.encode_for_llm(im)
                 content_parts.append({
                     "type": "image_url",
-                    "image_url": {"url": data_url},
+                    "image_url": {"url": encoded.data_url()},
                 })
+                encoded_images.append(encoded)
             except Exception as e:
                 print(f"Warning: Failed to prepare an image for Qwen: {e}")
+        image_encoding.record_sent(task_name, encoded_images, base64_encoded=True)
 
         # System message holds your full rules + strict JSON requirement
         system_content = system_prompt
@@ -264,20 +244,29 @@ def call_qwen_api_for_transcription(pil_images, system_prompt, task_name=""):
 
         print(f"Sending '{task_name}' request to Qwen API with {len(pil_images)} images (Model: {QWEN_TRANSCRIPTION_MODEL_NAME})...")
 
-        completion = client.chat.completions.create(
-            model=QWEN_TRANSCRIPTION_MODEL_NAME,
-            messages=messages,
-            stream=True,
-            temperature=0,
-            # If DashScope supports it, you can try enforcing JSON:
-            response_format={"type": "json_object"},
-        )
+        with tracing.span("llm.qwen", task=task_name, model=QWEN_TRANSCRIPTION_MODEL_NAME,
+                          images=len(encoded_images)) as llm_span, \
+                usage.call("dashscope", QWEN_TRANSCRIPTION_MODEL_NAME, task_name, images=len(encoded_images)) as metered:
+            completion = client.chat.completions.create(
+                model=QWEN_TRANSCRIPTION_MODEL_NAME,
+                messages=messages,
+                stream=True,
+                # The token counts arrive in a final chunk without choices.
+                stream_options={"include_usage": True},
+                temperature=0,
+                # If DashScope supports it, you can try enforcing JSON:
+                response_format={"type": "json_object"},
+            )
 
-        full_text = ""
-        for chunk in completion:
-            delta = getattr(chunk.choices[0].delta, "content", None)
-            if delta:
-                full_text += delta
+            full_text = ""
+            for chunk in completion:
+                metered.record(chunk)
+                if not chunk.choices:
+                    continue
+                delta = getattr(chunk.choices[0].delta, "content", None)
+                if delta:
+                    full_text += delta
+            llm_span.set(response_chars=len(full_text))
 
         # Extract and parse the single JSON object
         start = full_text.find('{')
@@ -311,7 +300,7 @@ def call_qwen_api_for_transcription(pil_images, system_prompt, task_name=""):
 
 # --- Core Processing Functions ---
 
-def process_elements_for_single_image(original_image_pil, output_prefix=""):
+def process_elements_for_single_image(original_image_pil, output_prefix="", local_elements=None):
     """
     Processes a single PIL image for element extraction, returning cropped image files.
 
@@ -321,6 +310,8 @@ def process_elements_for_single_image(original_image_pil, output_prefix=""):
         { "box_2d": [y_min, x_min, y_max, x_max] on a 0-1000 normalized grid, "label": "..." }.
       - Uses normalized coordinates mapped directly to the ORIGINAL image size (no ratio scaling needed).
       - Adds a small margin around crops, as in the reference implementation.
+      - When `local_elements` is non-empty (boxes found by pdf_elements.find_local_elements on a
+        born-digital PDF page), they are cropped directly and Gemini is not called.
     """
     print(f"\n--- Starting element extraction for {output_prefix} ---")
     generated_files = []
@@ -331,12 +322,16 @@ def process_elements_for_single_image(original_image_pil, output_prefix=""):
     # Resize image for consistent analysis (mirrors the reference flow). Ratios are not used for Gemini's normalized output.
     image_for_analysis, width_ratio, height_ratio = resize_image_for_analysis(original_image_pil)
 
-    # Call Gemini for element extraction
-    elements_response = call_gemini_elements_api(
-        image_for_analysis,
-        ELEMENT_EXTRACTION_PROMPT,
-        task_name=f"Element Extraction for {output_prefix}"
-    )
+    if local_elements:
+        print(f"Using {len(local_elements)} locally extracted element(s) for {output_prefix}; skipping Gemini.")
+        elements_response = local_elements
+    else:
+        # Call Gemini for element extraction
+        elements_response = call_gemini_elements_api(
+            image_for_analysis,
+            ELEMENT_EXTRACTION_PROMPT,
+            task_name=f"Element Extraction for {output_prefix}"
+        )
 
     identified_elements = []
     if elements_response:
@@ -419,6 +414,8 @@ def process_elements_for_single_image(original_image_pil, output_prefix=""):
 
 # --- Main Cloud Function Entry Point ---
 @functions_framework.http
+@tracing.traced_request("student-image-parser")
+@usage.metered_request("student-image-parser")
 def student_image_parser(request):
     """
     HTTP Cloud Function entry point.
@@ -449,12 +446,14 @@ def student_image_parser(request):
             try:
                 pdf_document = fitz.open(stream=file_bytes, filetype="pdf")
                 for i, page in enumerate(pdf_document):
-                    pix = page.get_pixmap(dpi=300)
-                    page_image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                    with tracing.span("pdf.render_page", file=filename, page=i + 1, dpi=300):
+                        pix = page.get_pixmap(dpi=300)
+                        page_image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
 
                     images_for_element_processing.append({
                         "image": page_image,
-                        "prefix": f"{os.path.splitext(filename)[0]}_page_{i+1}_"
+                        "prefix": f"{os.path.splitext(filename)[0]}_page_{i+1}_",
+                        "local_elements": pdf_elements.find_local_elements(page) if pdf_elements.LOCAL_ELEMENT_PASS else [],
                     })
                     all_pil_images_for_transcription.append(page_image)
 
@@ -464,49 +463,81 @@ def student_image_parser(request):
         else:
             try:
                 image = Image.open(io.BytesIO(file_bytes))
+                # Decode now: the transcription and element lanes read this image concurrently,
+                # and PIL's lazy load() is not thread-safe.
+                image.load()
 
                 images_for_element_processing.append({
                     "image": image,
-                    "prefix": f"{os.path.splitext(filename)[0]}_"
+                    "prefix": f"{os.path.splitext(filename)[0]}_",
+                    "local_elements": [],
                 })
                 all_pil_images_for_transcription.append(image)
 
-            except UnidentifiedImageError as e:
+            except (UnidentifiedImageError, OSError) as e:
                 print(f"Error opening image file '{filename}': {e}")
 
     if not images_for_element_processing:
         return "No valid image or PDF files could be processed.", 400
 
+    # --- Phase 2 is started first: the batched transcription only needs the page images,
+    # so it runs on the DashScope lane while element extraction runs on the Gemini lane.
+    future_transcription = None
+    if all_pil_images_for_transcription:
+        future_transcription = SCHEDULER.submit(
+            "dashscope",
+            tracing.bind(call_qwen_api_for_transcription),
+            all_pil_images_for_transcription,
+            TRANSCRIPTION_PROMPT,
+            "Batched Document Transcription"
+        )
+
     # --- Phase 1: Concurrent Element Extraction (per-image)
+    # Pages with locally found elements need no network call and are cropped inline;
+    # all others are queued on the scheduler's Gemini lane.
     print("\n--- PHASE 1: Starting Concurrent Element Extraction ---")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_prefix = {
-            executor.submit(
-                process_elements_for_single_image,
-                item['image'],
-                output_prefix=item['prefix']
-            ): item['prefix']
-            for item in images_for_element_processing
-        }
-
-        for future in concurrent.futures.as_completed(future_to_prefix):
-            prefix = future_to_prefix[future]
+    future_to_prefix = {}
+    for item in images_for_element_processing:
+        if item['local_elements']:
+            future = concurrent.futures.Future()
             try:
-                processed_files = future.result()
-                if processed_files:
-                    all_output_files.extend(processed_files)
-                    print(f"--- Successfully finished element extraction for {prefix} ---")
+                with tracing.span("page", prefix=item['prefix'], elements="local"):
+                    future.set_result(process_elements_for_single_image(
+                        item['image'],
+                        output_prefix=item['prefix'],
+                        local_elements=item['local_elements'],
+                    ))
             except Exception as exc:
-                print(f"--- An exception occurred during element extraction for {prefix}: {exc} ---")
+                future.set_exception(exc)
+        else:
+            page_span = tracing.start_span("page", prefix=item['prefix'], elements="gemini")
+            future = SCHEDULER.submit(
+                "gemini",
+                tracing.bind(process_elements_for_single_image, page_span),
+                item['image'],
+                output_prefix=item['prefix'],
+            )
+            future.add_done_callback(lambda f, page_span=page_span: page_span.end(error=f.exception()))
+        future_to_prefix[future] = item['prefix']
+
+    for future in concurrent.futures.as_completed(future_to_prefix):
+        prefix = future_to_prefix[future]
+        try:
+            processed_files = future.result()
+            if processed_files:
+                all_output_files.extend(processed_files)
+                print(f"--- Successfully finished element extraction for {prefix} ---")
+        except Exception as exc:
+            print(f"--- An exception occurred during element extraction for {prefix}: {exc} ---")
 
     # --- Phase 2: Batched Transcription (all images at once)
-    print("\n--- PHASE 2: Starting Batched Transcription ---")
-    if all_pil_images_for_transcription:
-        transcription_response = call_qwen_api_for_transcription(
-            all_pil_images_for_transcription,
-            TRANSCRIPTION_PROMPT,
-            "Batched Document Transcription"
-        )
+    print("\n--- PHASE 2: Collecting Batched Transcription ---")
+    if future_transcription is not None:
+        try:
+            transcription_response = future_transcription.result()
+        except Exception as exc:
+            print(f"Batched transcription task failed: {exc}")
+            transcription_response = None
         if transcription_response and "full_transcription" in transcription_response:
             full_transcription = transcription_response.get("full_transcription", "No transcription provided.")
             transcription_filename = "full_document_transcription.txt"
@@ -517,21 +548,40 @@ def student_image_parser(request):
     else:
         print("No images were available for transcription.")
 
+    queue_waits = {
+        # Pages cropped from local elements never queued; their plain Futures have no wait.
+        "gemini": [f.queue_wait_s for f in future_to_prefix if getattr(f, "queue_wait_s", None) is not None],
+        "dashscope": [future_transcription.queue_wait_s] if future_transcription is not None and future_transcription.queue_wait_s is not None else [],
+    }
+    queue_wait_summary = {
+        provider: round(1000 * max(waits), 1) for provider, waits in queue_waits.items() if waits
+    }
+    print(f"Max LLM queue wait for this request (ms): {queue_wait_summary}. Scheduler: {SCHEDULER.stats()}")
+
 
     # --- Final Zipping ---
     if not all_output_files:
         return "Processing completed, but no output files were generated.", 400
 
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for filename, data in all_output_files:
-            zf.writestr(filename, data)
+    with tracing.span("zip.build", files=len(all_output_files)) as zip_span:
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for filename, data in all_output_files:
+                zf.writestr(filename, data)
+        zip_span.set(bytes=zip_buffer.tell())
 
     zip_buffer.seek(0)
 
-    return send_file(
+    response = send_file(
         zip_buffer,
         mimetype='application/zip',
         as_attachment=True,
         download_name='processed_document.zip'
     )
+    response.headers['X-LLM-Queue-Wait-Ms'] = json.dumps(queue_wait_summary)
+    client_stats = llm_clients.stats()
+    response.headers['X-LLM-Client-Reuse'] = json.dumps(
+        {key: client_stats[key] for key in ("clients_created", "acquisitions", "reuse_ratio")}
+    )
+    response.headers['X-Image-Encoding'] = json.dumps(image_encoding.stats())
+    return response
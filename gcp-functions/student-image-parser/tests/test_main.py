@@ -0,0 +1,53 @@
+import io
+import zipfile
+
+import fitz
+import flask
+import pytest
+from PIL import Image
+
+import main
+import pdf_elements
+
+
+def _pdf_with_embedded_image():
+    image = io.BytesIO()
+    Image.new("RGB", (200, 150), (30, 120, 200)).save(image, format="PNG")
+    document = fitz.open()
+    page = document.new_page(width=595, height=842)
+    page.insert_text((72, 72), "Question 1: describe the figure.")
+    page.insert_image(fitz.Rect(100, 200, 400, 425), stream=image.getvalue())
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+@pytest.fixture
+def no_llm_calls(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("Gemini element detection must not run for pages with local elements")
+
+    monkeypatch.setattr(main, "call_gemini_elements_api", fail)
+    monkeypatch.setattr(main, "call_qwen_api_for_transcription",
+                        lambda images, prompt, task_name="": {"full_transcription": "Q1: a figure"})
+
+
+def test_find_local_elements_on_born_digital_page():
+    document = fitz.open(stream=_pdf_with_embedded_image(), filetype="pdf")
+    elements = pdf_elements.find_local_elements(document[0])
+    document.close()
+    assert [element["label"] for element in elements] == ["image"]
+
+
+def test_pdf_with_local_elements(no_llm_calls):
+    app = flask.Flask(__name__)
+    data = {"files": (io.BytesIO(_pdf_with_embedded_image()), "exam.pdf", "application/pdf")}
+    with app.test_request_context("/", method="POST", data=data, content_type="multipart/form-data"):
+        response = main.student_image_parser(flask.request)
+
+    assert response.status_code == 200
+    response.direct_passthrough = False
+    with zipfile.ZipFile(io.BytesIO(response.get_data())) as archive:
+        names = archive.namelist()
+    assert "full_document_transcription.txt" in names
+    assert [name for name in names if name.startswith("exam_page_1_")] == ["exam_page_1_image_1.png"]
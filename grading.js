@@ -36,12 +36,16 @@ gradeAllButton.addEventListener('click', async (e) => {
 
     updateGradingButtonText(`Grading ${ungradedExams.length} submission(s)...\n(~1 min)`);
 
-    const gradingPromises = ungradedExams.map((studentExam) => {
-      const studentIdentifier = studentExam.students.full_name || studentExam.students.student_number;
-      return processSingleStudent(examId, studentExam.id, studentIdentifier);
-    });
-
-    const results = await Promise.all(gradingPromises);
+    let results;
+    if (GRADING_BATCH_GCF_URL) {
+      results = await processStudentBatch(examId, ungradedExams);
+    } else {
+      const gradingPromises = ungradedExams.map((studentExam) => {
+        const studentIdentifier = studentExam.students.full_name || studentExam.students.student_number;
+        return processSingleStudent(examId, studentExam.id, studentIdentifier);
+      });
+      results = await Promise.all(gradingPromises);
+    }
 
     const successCount = results.filter((r) => r.status === 'success').length;
     const failureCount = results.length - successCount;
@@ -123,9 +127,16 @@ async function processSingleStudent(examId, studentExamId, studentIdentifier) {
     console.log(`Fetched ${imageBlobs.size} unique images for ${studentIdentifier}.`);
 
     console.log(`Sending data to AI for grading (${studentIdentifier})...`);
-    const gcfResponse = await callGradingGcf(gradingData, imageBlobs);
-
-    await updateGradingResultsInDb(studentExamId, gcfResponse, subQuestionAnswerIdMap);
+    if (GRADING_STREAM_RESULTS) {
+      let totalPoints = 0;
+      await callGradingGcfStream(gradingData, imageBlobs, examId, async (question) => {
+        totalPoints += await saveQuestionResults([question], subQuestionAnswerIdMap);
+      });
+      await finalizeStudentExam(studentExamId, totalPoints);
+    } else {
+      const gcfResponse = await callGradingGcf(gradingData, imageBlobs, examId);
+      await updateGradingResultsInDb(studentExamId, gcfResponse, subQuestionAnswerIdMap);
+    }
     console.log(`Saved results for ${studentIdentifier}.`);
 
     return { status: 'success', studentExamId };
@@ -136,12 +147,77 @@ async function processSingleStudent(examId, studentExamId, studentIdentifier) {
 }
 
 /**
- * Fetch grading data for the student + exam.
+ * Grade all given student_exams with one call to the cohort batch endpoint.
+ * The exam is fetched and sent once; the server downloads each image once.
  * @param {string} examId
- * @param {string} studentExamId
- * @returns {Promise<{data: any, error: any}>}
+ * @param {Array<{id: string}>} studentExams
+ * @returns {Promise<Array<{status: 'success'|'error', studentExamId: string, error?: string}>>}
  */
-async function fetchGradingDataForStudent(examId, studentExamId) {
+async function processStudentBatch(examId, studentExams) {
+  const examBase = await fetchExamForGrading(examId);
+  const students = [];
+  const answerIdMaps = new Map();
+  const results = [];
+
+  await Promise.all(
+    studentExams.map(async (studentExam) => {
+      const { data: answers, error } = await sb
+        .from('student_answers')
+        .select('id, sub_question_id, answer_text, answer_visual')
+        .eq('student_exam_id', studentExam.id);
+      if (error) {
+        results.push({ status: 'error', studentExamId: studentExam.id, error: error.message });
+        return;
+      }
+      if (!answers || answers.length === 0) {
+        await sb.from('student_exams').update({ total_points_awarded: 0, status: 'graded' }).eq('id', studentExam.id);
+        results.push({ status: 'success', studentExamId: studentExam.id });
+        return;
+      }
+      answerIdMaps.set(studentExam.id, new Map(answers.map((ans) => [ans.sub_question_id, ans.id])));
+      students.push({ student_exam_id: studentExam.id, answers });
+    }),
+  );
+
+  if (students.length === 0) return results;
+
+  console.log(`Sending ${students.length} submission(s) to the batch grading service...`);
+  const response = await fetch(GRADING_BATCH_GCF_URL, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      ...(await usageLabels(examId)),
+      grading_regulations: examBase.grading_regulations,
+      questions: examBase.questions,
+      students,
+    }),
+  });
+  if (!response.ok) {
+    const errorText = await response.text();
+    throw new Error(`Batch grading service failed: ${response.statusText} - ${errorText}`);
+  }
+  const batchResult = await response.json();
+  console.log('Batch grading stats:', batchResult.stats);
+
+  for (const studentResult of batchResult.students || []) {
+    const studentExamId = studentResult.student_exam_id;
+    try {
+      await updateGradingResultsInDb(studentExamId, studentResult, answerIdMaps.get(studentExamId) || new Map());
+      results.push({ status: 'success', studentExamId });
+    } catch (error) {
+      console.error(`Error saving results for student_exam ${studentExamId}:`, error);
+      results.push({ status: 'error', studentExamId, error: error.message });
+    }
+  }
+  return results;
+}
+
+/**
+ * Fetch the exam-level grading data (rules, questions, answer model) shared by all students.
+ * @param {string} examId
+ * @returns {Promise<any>}
+ */
+async function fetchExamForGrading(examId) {
   const { data: examBase, error: baseError } = await sb
     .from('exams')
     .select(
@@ -164,6 +240,17 @@ async function fetchGradingDataForStudent(examId, studentExamId) {
     .single();
 
   if (baseError) throw baseError;
+  return examBase;
+}
+
+/**
+ * Fetch grading data for the student + exam.
+ * @param {string} examId
+ * @param {string} studentExamId
+ * @returns {Promise<{data: any, error: any}>}
+ */
+async function fetchGradingDataForStudent(examId, studentExamId) {
+  const examBase = await fetchExamForGrading(examId);
 
   const { data: studentAnswers, error: answersError } = await sb
     .from('student_answers')
@@ -190,11 +277,13 @@ async function fetchGradingDataForStudent(examId, studentExamId) {
  * Call grading GCF with mixed JSON + files payload.
  * @param {any} gradingData
  * @param {Map<string, Blob>} imageBlobs
+ * @param {string} examId
  * @returns {Promise<any>}
  */
-async function callGradingGcf(gradingData, imageBlobs) {
+async function callGradingGcf(gradingData, imageBlobs, examId) {
   const formData = new FormData();
   formData.append('grading_data', JSON.stringify(gradingData));
+  await appendUsageLabels(formData, examId);
 
   for (const [filename, blob] of imageBlobs.entries()) {
     formData.append(filename, blob, filename);
@@ -212,6 +301,60 @@ async function callGradingGcf(gradingData, imageBlobs) {
   return response.json();
 }
 
+/**
+ * Call grading GCF in NDJSON mode; `onQuestion` runs for every question as soon as it is graded.
+ * @param {any} gradingData
+ * @param {Map<string, Blob>} imageBlobs
+ * @param {string} examId
+ * @param {(question: any) => Promise<void>} onQuestion
+ * @returns {Promise<any>} the summary record
+ */
+async function callGradingGcfStream(gradingData, imageBlobs, examId, onQuestion) {
+  const formData = new FormData();
+  formData.append('grading_data', JSON.stringify(gradingData));
+  await appendUsageLabels(formData, examId);
+  formData.append('stream', 'ndjson');
+
+  for (const [filename, blob] of imageBlobs.entries()) {
+    formData.append(filename, blob, filename);
+  }
+
+  const response = await fetch(GRADING_GCF_URL, {
+    method: 'POST',
+    body: formData,
+  });
+
+  if (!response.ok) {
+    const errorText = await response.text();
+    throw new Error(`Grading service failed: ${response.statusText} - ${errorText}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffered = '';
+  let summary = null;
+
+  const handleLine = async (line) => {
+    if (!line.trim()) return;
+    const record = JSON.parse(line);
+    if (record.type === 'question') await onQuestion(record.question);
+    else if (record.type === 'summary') summary = record;
+  };
+
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffered += decoder.decode(value, { stream: true });
+    const lines = buffered.split('\n');
+    buffered = lines.pop();
+    for (const line of lines) await handleLine(line);
+  }
+  await handleLine(buffered + decoder.decode());
+
+  if (!summary) throw new Error('Grading stream ended before all questions were graded.');
+  return summary;
+}
+
 /**
  * Persist grading results to DB and finalize student_exam status.
  * @param {string} studentExamId
@@ -219,14 +362,25 @@ async function callGradingGcf(gradingData, imageBlobs) {
  * @param {Map<string, string>} subQuestionToAnswerIdMap
  */
 async function updateGradingResultsInDb(studentExamId, gcfResponse, subQuestionToAnswerIdMap) {
-  const answerUpdates = [];
-  let totalPoints = 0;
-
   if (!gcfResponse || !gcfResponse.questions) {
     throw new Error('Invalid response from grading service.');
   }
 
-  const allSubQuestionResults = gcfResponse.questions.flatMap((q) => q.sub_questions || []);
+  const totalPoints = await saveQuestionResults(gcfResponse.questions, subQuestionToAnswerIdMap);
+  await finalizeStudentExam(studentExamId, totalPoints);
+}
+
+/**
+ * Persist the sub-question results of the given graded questions.
+ * @param {Array<any>} questions
+ * @param {Map<string, string>} subQuestionToAnswerIdMap
+ * @returns {Promise<number>} points awarded in these questions
+ */
+async function saveQuestionResults(questions, subQuestionToAnswerIdMap) {
+  const answerUpdates = [];
+  let totalPoints = 0;
+
+  const allSubQuestionResults = questions.flatMap((q) => q.sub_questions || []);
 
   for (const subQResult of allSubQuestionResults) {
     const studentAnswerId = subQuestionToAnswerIdMap.get(subQResult.sub_question_id);
@@ -267,6 +421,15 @@ async function updateGradingResultsInDb(studentExamId, gcfResponse, subQuestionT
     }
   }
 
+  return totalPoints;
+}
+
+/**
+ * Store the total score and mark the student_exam as graded.
+ * @param {string} studentExamId
+ * @param {number} totalPoints
+ */
+async function finalizeStudentExam(studentExamId, totalPoints) {
   const { error: examUpdateError } = await sb
     .from('student_exams')
     .update({
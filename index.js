@@ -234,11 +234,10 @@ examForm.addEventListener('submit', async (e) => {
         for (const file of files) {
             formData.append('files', file);
         }
+        // The exam does not exist yet, so its structuring usage is attributed to the teacher only.
+        formData.append('teacher_id', user.id);
 
-        const gcfResponse = await fetch(GCF_URL, {
-            method: 'POST',
-            body: formData,
-        });
+        const gcfResponse = await fetchPipeline(GCF_URL, formData);
 
         if (!gcfResponse.ok) {
             throw new Error(`Cloud function failed with status: ${gcfResponse.statusText}`);
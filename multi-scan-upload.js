@@ -676,6 +676,7 @@ async function requestBulkSubmissionBoundaries(pdfFile, students) {
     if (Array.isArray(students)) {
       formData.append('students', JSON.stringify(students));
     }
+    await appendUsageLabels(formData, new URLSearchParams(window.location.search).get('id'));
 
     response = await fetch(BULK_BOUNDARY_GCF_URL, {
       method: 'POST',
@@ -0,0 +1,39 @@
+// --- PIPELINE JOBS ---
+// Shared by index.html (index.js) and exam.html (config.js and the upload scripts),
+// which cannot load each other's configuration scripts.
+
+// Run the exam-structurer/add-model/add-appendix/add-student-answers pipelines as polled jobs.
+const PIPELINE_JOBS = false;
+const PIPELINE_JOB_POLL_MS = 3000;
+
+/**
+ * POST to a pipeline function. With PIPELINE_JOBS the pipeline runs as a background job:
+ * the request returns a job id right away and the result is polled, so a dropped
+ * connection does not lose the work. Resolves to a Response like fetch() either way.
+ * @param {string} url
+ * @param {FormData} formData
+ * @param {{signal?: AbortSignal}} [options]
+ * @returns {Promise<Response>}
+ */
+async function fetchPipeline(url, formData, options = {}) {
+  if (!PIPELINE_JOBS) {
+    return fetch(url, { method: 'POST', body: formData, signal: options.signal });
+  }
+
+  formData.append('mode', 'job');
+  const submitResponse = await fetch(url, { method: 'POST', body: formData, signal: options.signal });
+  if (submitResponse.status !== 202) return submitResponse;
+  const job = await submitResponse.json();
+  console.log(`Pipeline job ${job.job_id} queued.`);
+
+  for (;;) {
+    await new Promise((resolve) => setTimeout(resolve, PIPELINE_JOB_POLL_MS));
+    if (options.signal && options.signal.aborted) throw new DOMException('Aborted', 'AbortError');
+    const statusResponse = await fetch(new URL(job.status_path, url), { signal: options.signal });
+    if (!statusResponse.ok) return statusResponse;
+    const { status } = await statusResponse.json();
+    if (status === 'succeeded' || status === 'failed') {
+      return fetch(new URL(job.result_path, url), { signal: options.signal });
+    }
+  }
+}
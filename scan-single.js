@@ -390,6 +390,7 @@ async function processScannedAnswersBackground(scanSession, examId, progressCb =
     progressCb('Downloading images...');
     const formData = new FormData();
     formData.append('exam_structure', JSON.stringify(examStructureForGcf));
+    await appendUsageLabels(formData, examId);
 
     const downloadPromises = scanSession.uploaded_image_paths.map(async (imageUrl) => {
       const url = new URL(imageUrl);
@@ -426,11 +427,7 @@ async function processScannedAnswersBackground(scanSession, examId, progressCb =
     const timeoutId = setTimeout(() => controller.abort(), 300000);
 
     try {
-      const gcfResponse = await fetch(STUDENT_ANSWERS_GCF_URL, {
-        method: 'POST',
-        body: formData,
-        signal: controller.signal,
-      });
+      const gcfResponse = await fetchPipeline(STUDENT_ANSWERS_GCF_URL, formData, { signal: controller.signal });
       clearTimeout(timeoutId);
       if (!gcfResponse.ok) {
         const errorText = await gcfResponse.text();